@@ -1,318 +1,102 @@
 import streamlit as st
-from zhipuai import ZhipuAI
-from openai import OpenAI
-import random
 import time
 from datetime import datetime
-from persona import PERSONAS # Import personas
-from groq import Groq
+import persona_registry
 import compressed_memory as cm
 import detailed_memory as dm
-import os
+import memory_cache
+import batch_generation
+import prefix_stats
+import llm_cache
+import llm_gateway
+import rate_limiter
+import run_timing
+import chat_room
+import chat_view
+
+RUN_STARTED_AT = time.perf_counter() # 本次脚本运行的开始时间
 
 # --- 配置 ---
-MAX_HISTORY_LEN = 20 # LLM 可见的最大消息数
-MAX_BOT_MEMORY_LEN = 20 # 每个机器人工作记忆的最大条目数
-SUMMARY_INTERVAL = 3 # 每隔多少轮总消息进行一次总结
-BOT_RESPONSE_DELAY = (1, 2) # 机器人响应延迟秒数范围（最小值，最大值）
-MEMORY_COMPRESSION_INTERVAL = 3 # 每隔多少次记忆更新压缩一次记忆
+# 对话相关的配置（历史长度、记忆长度、总结间隔等）见 chat_room
+AUTO_TURN_DELAY = 0.0 # 自动对话每轮之间的默认间隔秒数（可在侧边栏调整，0 表示不等待）
+BACKGROUND_JOB_POLL_INTERVAL = 1 # 有后台任务时检查结果的间隔秒数
+STREAM_RESPONSES = True # 机器人回复是否逐字流式显示
+DETAILED_MEMORY_PAGE_SIZE = 20 # 侧边栏详细记忆历史每页显示的条数
+USER_AVATAR = "🧑‍💻" # 用户消息的头像
+DEFAULT_CANDIDATE_COUNT = 3 # 并行候选回复模式下默认的候选角色数
+
+# --- 共享资源：每个进程只创建一次，所有会话和重新运行共用 ---
+@st.cache_resource(show_spinner=False)
+def load_llm_client():
+    """创建共享的LLM客户端（见 chat_room.create_client）"""
+    with run_timing.get_timings().startup_step("LLM客户端"):
+        return chat_room.create_client()
+
+@st.cache_resource(show_spinner=False)
+def load_personas():
+    """加载并校验角色与群组"""
+    with run_timing.get_timings().startup_step("角色注册表"):
+        return persona_registry.get_registry()
+
+@st.cache_resource(show_spinner=False)
+def load_memory_stores():
+    """迁移旧版数据并检查记忆清单；各角色的记忆分片在用到时才读取"""
+    with run_timing.get_timings().startup_step("记忆存储"):
+        dm.ensure_memory_dir()
+        cm.ensure_memory_dir()
+    return memory_cache.get_cache()
 
-# --- Groq API 设置 ---
 try:
-    # client = ZhipuAI(api_key='')
-    # LLM_MODEL = "glm-4-flash" # Zhipu AI model
-    # client = Groq(api_key='')
-    # LLM_MODEL = "llama3-70b-8192" # Groq 模型
-    api_key = os.environ.get("GEMINI_API_KEY")
-    client = OpenAI(api_key=api_key,base_url="https://generativelanguage.googleapis.com/v1beta/")
-    LLM_MODEL = "gemini-2.0-flash" # Groq 模型
-
-except KeyError:
-    st.error("API 密钥未找到。请在 .streamlit/secrets.toml 中设置它")
+    gateway, client = load_llm_client()
+    LLM_MODEL = gateway.model
+except llm_gateway.GatewayConfigError as e:
+    st.error(str(e))
     st.stop()
 
+try:
+    personas = load_personas()
+except persona_registry.PersonaRegistryError as e:
+    st.error(f"角色或群组定义有误：{e}")
+    st.stop()
 
-# --- 辅助函数 ---
+load_memory_stores()
 
-def get_llm_response(persona_name, persona_details, chat_history, bot_memory, compressed_memory_text=""):
-    """
-    根据角色、历史记录和记忆获取 LLM 的响应。
-    增加了压缩记忆参数，为角色提供长期经验。
-    """
-    system_prompt = (
-        f"你是 {persona_name}。{persona_details['description']}\n"
-        f"你的背景：{persona_details['background']}\n"
-    )
-    
-    # 添加压缩记忆（如果有）
-    if compressed_memory_text:
-        system_prompt += f"你的核心经验（长期记忆）：{compressed_memory_text}\n\n"
-    
-    system_prompt += (
-        f"你的最近工作记忆（用于保持一致性）：{bot_memory}\n\n"
-        f"你正在一个聊天室中。以下是最近的对话历史（最后 {MAX_HISTORY_LEN} 条消息）。"
-        f"自然地进行互动。简明扼要。保持角色特性。除非这是你的第一条消息，否则不要问候。"
-    )
 
-    messages_for_llm = [{"role": "system", "content": system_prompt}]
-    
-    # 修复：将所有角色映射为 API 的 "user" 或 "assistant"
-    for msg in chat_history[-MAX_HISTORY_LEN:]:
-        # 如果消息来自当前角色，则是 "assistant" 消息
-        # 否则，是 "user" 消息（无论是来自用户还是其他机器人）
-        if msg["role"] == persona_name:
-            role = "assistant"
-            msg_content = msg["content"]
-        else:
-            role = "user"
-            # 为了上下文，在内容中添加实际发言者的名称
-            msg_content = f"[{msg['role']}]: {msg['content']}"
-        
-        messages_for_llm.append({
-            "role": role, 
-            "content": msg_content
-        })
-
-    try:
-        completion = client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=messages_for_llm,
-            temperature=0.7,
-            max_tokens=500
-        )
-        response = completion.choices[0].message.content.strip()
-        return response
-    except Exception as e:
-        st.error(f"{persona_name} 与 LLM 通信出错：{str(e)}")
-        return f"({persona_name} 思考遇到了困难...)"
+# --- 辅助函数 ---
 
+class StreamlitSink:
+    """把聊天室引擎的错误和提示显示在页面上；新消息在追加时格式化进聊天记录视图"""
 
-def update_bot_memory(persona_name, persona_details, chat_history, current_memory):
-    """
-    使用 LLM 更新机器人的记忆。
-    保持工作记忆在合理长度内（MAX_BOT_MEMORY_LEN条目）。
-    """
-    if not chat_history:
-        return current_memory # 没有新信息
-
-    # 提取与机器人相关的最近对话片段
-    relevant_history_snippet = "\n".join([f"{msg['role']}: {msg['content']}" for msg in chat_history[-MAX_HISTORY_LEN:]])
-
-    prompt = (
-        f"你是一个AI助手，帮助 {persona_name}（{persona_details['description']}）更新其记忆。\n"
-        f"当前记忆：\n{current_memory}\n\n"
-        f"最近对话片段：\n{relevant_history_snippet}\n\n"
-        f"基于此，为 {persona_name} 提供一个简洁的更新记忆。"
-        f"关注 {persona_name} 应该记住的关键新事实、决定或表达/观察到的强烈感受。"
-        f"保持简短，像个人笔记。如果没有重要的内容可添加，可以说'没有重要更新'。"
-    )
-    try:
-        completion = client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": "你是一个有帮助的记忆助手。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=500
-        )
-        update = completion.choices[0].message.content.strip()
-        if "没有重要更新" in update.lower() or "no significant updates" in update.lower():
-            return current_memory
-            
-        # 添加新记忆
-        new_memory_entry = f"- (更新于 {datetime.now().strftime('%H:%M')}) {update}"
-        
-        # 将更新添加到详细记忆（永久存储）
-        dm.append_to_detailed_memory(persona_name, new_memory_entry)
-        
-        # 更新会话工作记忆（保持在MAX_BOT_MEMORY_LEN条以内）
-        memory_lines = current_memory.split('\n')
-        # 保留初始记忆行和最近的MAX_BOT_MEMORY_LEN-1条记忆
-        initial_memory = memory_lines[0] if memory_lines else ""
-        recent_memories = memory_lines[1:] if len(memory_lines) > 1 else []
-        
-        if len(recent_memories) >= MAX_BOT_MEMORY_LEN - 1:
-            recent_memories = recent_memories[-(MAX_BOT_MEMORY_LEN - 2):]
-        
-        updated_memory = initial_memory + "\n" + "\n".join(recent_memories + [new_memory_entry])
-        
-        # 检查是否需要更新压缩记忆
-        if "memory_updates_count" not in st.session_state:
-            st.session_state.memory_updates_count = {}
-        
-        if persona_name not in st.session_state.memory_updates_count:
-            st.session_state.memory_updates_count[persona_name] = 0
-        
-        st.session_state.memory_updates_count[persona_name] += 1
-        
-        # 定期将详细记忆压缩到压缩记忆中
-        if st.session_state.memory_updates_count[persona_name] % MEMORY_COMPRESSION_INTERVAL == 0:
-            # 获取完整的详细记忆用于压缩
-            full_detailed_memory = dm.get_detailed_memory(persona_name,max_entries=MAX_BOT_MEMORY_LEN)
-            # 获取当前压缩记忆
-            current_compressed = cm.get_compressed_memory(persona_name)
-            # 更新压缩记忆
-            cm.update_compressed_memory(client, LLM_MODEL, persona_name, current_compressed, full_detailed_memory)
-            st.toast(f"{persona_name} 的长期记忆已更新！")
-        
-        return updated_memory
-    except Exception as e:
-        st.error(f"更新 {persona_name} 的记忆时出错：{e}")
-        return current_memory
+    def emit(self, event, **data):
+        if event == "message":
+            st.session_state.chat_view.append(
+                data["speaker"], data["content"], data["timestamp"], message_avatar(data["speaker"])
+            )
+        elif event == "error":
+            st.error(data["text"])
+        elif event == "info":
+            st.toast(data["text"])
 
 
-def get_conversation_summary(chat_history_to_summarize):
+def get_avatar_url(persona_name):
     """
-    总结一段对话。
+    Retrieve the avatar URL for a persona from the registry.
     """
-    if not chat_history_to_summarize:
-        return "没有对话可总结。"
+    persona = personas.personas.get(persona_name, {})
+    return persona.get("avatar", f"https://api.dicebear.com/9.x/personas/svg?seed={persona_name}")
 
-    prompt = (
-        "总结以下聊天对话。突出关键话题、决定、任何冲突或协议，以及讨论的整体进展。要简明扼要。\n\n"
-        "对话：\n" + "\n".join([f"{msg['role']}: {msg['content']}" for msg in chat_history_to_summarize])
-    )
-    try:
-        completion = client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": "你是一位总结专家。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
-            max_tokens=500
-        )
-        summary = completion.choices[0].message.content.strip()
-        return summary
-    except Exception as e:
-        st.error(f"生成总结时出错：{e}")
-        return "由于错误，无法生成总结。"
 
+def message_avatar(speaker):
+    """聊天消息使用的头像：角色使用其头像，用户使用固定图标"""
+    return get_avatar_url(speaker) if speaker in personas.personas else USER_AVATAR
 
-def determine_next_speaker(history, available_bots, last_speaker, user_name):
-    """
-    使用LLM作为隐藏导演，根据聊天历史分析，决定下一个发言的机器人。
-    """
-    if not available_bots:
-        return None
-    
-    # 避免同一发言者连续发言的基本规则
-    eligible_bots = [b for b in available_bots if b != last_speaker]
-    if not eligible_bots:
-        eligible_bots = available_bots
-    
-    # 基本情况：如果历史太短，直接随机选择
-    if len(history) < 2:
-        return random.choice(eligible_bots)
-    
-    # 获取最近的消息上下文（受MAX_HISTORY_LEN限制）
-    recent_messages = history[-min(MAX_HISTORY_LEN, len(history)):]
-    recent_history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in recent_messages])
-    
-    # 快速检查：如果明确提及某个机器人，让它来回答
-    last_message = recent_messages[-1]
-    last_content = last_message["content"].lower()
-    for bot_name in available_bots:
-        if bot_name.lower() in last_content and "?" in last_content:
-            return bot_name
-    
-    # 给一定概率随机回复，保持对话活跃性
-    if random.random() < 0.15:  # 15%的概率随机选择
-        return random.choice(eligible_bots)
-    
-    # 使用LLM来决定谁是最合适的下一个发言者
-    try:
-        # 准备可用角色的简短描述，帮助LLM做决定
-        bot_descriptions = []
-        for bot_name in eligible_bots:
-            if bot_name in st.session_state.bot_personas_data:
-                short_desc = st.session_state.bot_personas_data[bot_name].get('description', '')
-                # 仅取简短描述的前30个字符
-                bot_descriptions.append(f"- {bot_name}: {short_desc[:50]}...")
-        
-        bot_info = "\n".join(bot_descriptions)
-        
-        prompt = (
-            f"你是一个聊天室的隐形导演。基于最近的对话历史，请决定谁应该是下一个发言者。\n\n"
-            f"当前聊天室成员：\n{bot_info}\n\n"
-            f"最近的对话历史：\n{recent_history_text}\n\n"
-            f"上一个发言者是：{last_speaker}\n\n"
-            f"请仔细分析对话内容，考虑以下因素：\n"
-            f"1. 谁是对话中被提及或被询问的对象\n"
-            f"2. 谁最适合对最近的话题进行回应（基于角色背景）\n"
-            f"3. 谁可以提供有价值的新观点\n"
-            f"4. 谁在最近几轮对话中发言较少\n\n"
-            f"根据以上分析，从以下列表中选择一个名字作为下一个发言者（只返回名字，不要任何解释）：{', '.join(eligible_bots)}"
-        )
-        
-        # 调用LLM获取推荐的下一个发言者
-        completion = client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": "你是一位对话管理专家，帮助决定谁应该是对话中的下一个发言者。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=50
-        )
-        
-        next_speaker_suggestion = completion.choices[0].message.content.strip()
-        
-        # 清理响应，确保我们得到的是一个有效的发言者名称
-        for bot_name in eligible_bots:
-            if bot_name.lower() in next_speaker_suggestion.lower():
-                return bot_name
-                
-        # 如果LLM没有返回有效的机器人名称，使用备选方案
-        return random.choice(eligible_bots)
-        
-    except Exception as e:
-        st.error(f"使用LLM决定下一个发言者时出错：{e}")
-        # 出错时回退到随机选择
-        return random.choice(eligible_bots)
-    
-def get_avatar_url(persona_name):
-    """
-    Retrieve the avatar URL for a persona from bot_personas_data.
-    """
-    persona = st.session_state.bot_personas_data.get(persona_name, {})
-    return persona.get("avatar", f"https://api.dicebear.com/9.x/personas/svg?seed={persona_name}")
 
-# --- 新增辅助函数 ---
-def generate_conversation_report(chat_history):
-    """
-    生成整个对话历史的综合报告。
-    """
-    if not chat_history:
-        return "没有对话可生成报告。"
-
-    prompt = (
-        "你是一个专业的报告生成助手。请总结以下完整的聊天对话历史，生成一份简洁的报告。\n"
-        "报告应包括以下内容：\n"
-        "1. 对话的主要话题和主题\n"
-        "2. 关键讨论点、决定或结论\n"
-        "3. 参与者的主要观点或角色动态（例如谁主导了讨论，谁提出了关键问题等）\n"
-        "4. 任何明显的冲突或共识\n"
-        "5. 对话的整体进展和结果\n\n"
-        "对话历史：\n" + "\n".join([f"{msg['role']}: {msg['content']} ({msg['timestamp'].strftime('%H:%M:%S')})" for msg in chat_history]) + "\n\n"
-        "请以清晰、结构化的格式生成报告，字数控制在300字以内，适合快速阅读。"
-    )
-    try:
-        completion = client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": "你是一位专业的总结和报告生成专家。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
-            max_tokens=2000
-        )
-        report = completion.choices[0].message.content.strip()
-        return report
-    except Exception as e:
-        st.error(f"生成报告时出错：{e}")
-        return "由于错误，无法生成报告。"
+def render_chat_entries(entries):
+    """渲染已格式化的消息"""
+    for entry in entries:
+        with st.chat_message(entry["role"], avatar=entry["avatar"]):
+            st.markdown(entry["header"])
+            st.write(entry["content"])
 
 # --- Streamlit 应用 ---
 
@@ -320,36 +104,20 @@ st.set_page_config(page_title="LLM 聊天室", layout="wide")
 st.title("🤖💬 LLM 角色聊天室")
 
 # --- 初始化会话状态 ---
-if "messages" not in st.session_state:
-    st.session_state.messages = [] # 完整聊天历史：{"role": "name", "content": "text", "timestamp": datetime}
-if "bot_personas_data" not in st.session_state:
-    st.session_state.bot_personas_data = {p["name"]: p for p in PERSONAS}
-    # Add avatar to each persona if not present
-    for name, details in st.session_state.bot_personas_data.items():
-        if "avatar" not in details:
-            # Generate avatar using DiceBear with persona name as seed
-            details["avatar"] = f"https://api.dicebear.com/9.x/personas/svg?seed={name}"
-if "bot_memories" not in st.session_state:
-    st.session_state.bot_memories = {}
-    # 初始化每个角色的工作记忆，并从压缩记忆加载
-    for name, details in st.session_state.bot_personas_data.items():
-        # 获取压缩记忆（如果有）
-        compressed_memory_text = cm.get_compressed_memory(name)
-        # 创建初始工作记忆
-        st.session_state.bot_memories[name] = f"初始记忆：我的名字是 {name}。{details.get('background', '')}"
-
-if "conversation_rounds" not in st.session_state:
-    st.session_state.conversation_rounds = 0 # 已发送的总消息数
-if "summaries" not in st.session_state:
-    st.session_state.summaries = [] # 总结列表
-if "last_speaker" not in st.session_state:
-    st.session_state.last_speaker = None # 避免立即自我回复
-if "user_name" not in st.session_state:
-    st.session_state.user_name = f"用户_{random.randint(1000, 9999)}"
-if "bots_in_chat" not in st.session_state:
-    st.session_state.bots_in_chat = [p["name"] for p in PERSONAS[:6]] # 以前3个机器人开始
-if "memory_updates_count" not in st.session_state:
-    st.session_state.memory_updates_count = {} # 记录每个角色记忆更新的次数
+# 对话逻辑在 chat_room 引擎中，会话数据直接保存在 st.session_state
+if "chat_view" not in st.session_state:
+    st.session_state.chat_view = chat_view.ChatView() # 已格式化的消息，用于渲染
+candidate_count = 0 # 为 0 时每轮只生成一条回复
+if st.session_state.get("candidate_mode", False):
+    candidate_count = st.session_state.get("candidate_count", DEFAULT_CANDIDATE_COUNT)
+room = chat_room.ChatRoom(
+    client, LLM_MODEL, personas, state=st.session_state, sink=StreamlitSink(),
+    speculative=st.session_state.get("speculative_mode", False),
+    candidate_count=candidate_count
+)
+
+# --- 提交已完成的后台任务，刷新空闲会话的记忆缓冲 ---
+room.commit_ready()
 
 # --- 侧边栏控件 ---
 with st.sidebar:
@@ -383,7 +151,8 @@ with st.sidebar:
                         {"role": "user", "content": prompt}
                     ],
                     temperature=0.5,
-                    max_tokens=300
+                    max_tokens=300,
+                    use_cache=True
                 )
                 result = completion.choices[0].message.content.strip()
                 # print(result)
@@ -401,14 +170,9 @@ with st.sidebar:
                         new_persona = json.loads(new_persona_json)
                         
                         # 验证必要字段
-                        required_fields = ["name", "description", "background", "greeting"]
-                        if all(field in new_persona for field in required_fields):
-                            new_persona["avatar"] = f"https://api.dicebear.com/9.x/personas/svg?seed={new_persona['name']}"
-                            # 直接添加到PERSONAS列表
-                            PERSONAS.append(new_persona)
-                            
-                            # 同时更新会话状态
-                            st.session_state.bot_personas_data[new_persona["name"]] = new_persona
+                        if all(field in new_persona for field in persona_registry.REQUIRED_FIELDS):
+                            # 添加到角色注册表（会校验字段并生成头像）
+                            new_persona = personas.add(new_persona)
                             st.session_state.bots_in_chat.append(new_persona["name"])
                             st.session_state.bot_memories[new_persona["name"]] = (
                                 f"初始记忆：我的名字是 {new_persona['name']}。{new_persona['background']}"
@@ -426,8 +190,7 @@ with st.sidebar:
             st.warning("请提供角色描述后再添加。")
 
     # 新增：预设群组选择
-    from group import GROUPS  # 导入群组定义
-    group_options = ["无预设群组"] + [group["name"] for group in GROUPS]
+    group_options = ["无预设群组"] + personas.group_names
     selected_group = st.selectbox(
         "选择一个预设聊天群组",
         options=group_options,
@@ -437,28 +200,28 @@ with st.sidebar:
 
     # 当群组被选择时，更新bots_in_chat
     if selected_group != "无预设群组":
-        for group in GROUPS:
-            if group["name"] == selected_group:
-                st.session_state.bots_in_chat = group["personas"]
-                st.info(f"已加载 {selected_group}：{group['description']}")
-                break
+        group = personas.group(selected_group) # 成员名在启动时已解析为角色全名
+        st.session_state.bots_in_chat = list(group["personas"])
+        st.info(f"已加载 {selected_group}：{group['description']}")
     else:
         # 如果选择“无预设群组”，保持当前bots_in_chat（用户可以手动选择）
         pass
         
-    available_bots = [p["name"] for p in PERSONAS]
+    available_bots = personas.names
     st.session_state.bots_in_chat = st.multiselect(
         "选择聊天中的机器人",
         options=available_bots,
         default=st.session_state.bots_in_chat
     )
 
+    room.ensure_working_memory()
+
     if not st.session_state.bots_in_chat:
         st.warning("请至少选择一个机器人进行聊天。")
 
     st.subheader("机器人个性与记忆")
     for bot_name in st.session_state.bots_in_chat:
-        persona = st.session_state.bot_personas_data.get(bot_name)
+        persona = personas.personas.get(bot_name)
         if persona:
             with st.expander(f"{bot_name} 的角色与记忆"):
                 st.markdown(f"**描述:** {persona['description']}")
@@ -483,29 +246,100 @@ with st.sidebar:
                 
                 # 添加详细记忆查看按钮
                 if st.button(f"查看 {bot_name} 的完整详细记忆", key=f"view_detailed_{bot_name}"):
-                    detailed_mem = dm.get_detailed_memory(bot_name,get_all=True)
                     st.session_state[f"show_detailed_{bot_name}"] = True
-                    st.session_state[f"detailed_mem_{bot_name}"] = detailed_mem
                 
-                # 显示详细记忆（如果按钮被点击）
+                # 显示详细记忆（如果按钮被点击）：按页读取，只载入当前页的条目
                 if st.session_state.get(f"show_detailed_{bot_name}", False):
                     st.markdown("**详细记忆历史:**")
+                    total_entries = dm.count_entries(bot_name)
+                    total_pages = max(1, -(-total_entries // DETAILED_MEMORY_PAGE_SIZE))
+                    page_key = f"detailed_page_{bot_name}"
+                    # 页码只通过会话状态设置初始值（默认最后一页），不再同时传 value，避免 Streamlit 的警告
+                    if page_key not in st.session_state or st.session_state[page_key] > total_pages:
+                        st.session_state[page_key] = total_pages
+                    page = st.number_input("页码", min_value=1, max_value=total_pages, key=page_key)
+                    page_entries = dm.iter_entries(
+                        bot_name, offset=(page - 1) * DETAILED_MEMORY_PAGE_SIZE, limit=DETAILED_MEMORY_PAGE_SIZE
+                    )
                     st.text_area(f"{bot_name} 的详细记忆历史", 
-                                value=st.session_state.get(f"detailed_mem_{bot_name}", "尚无详细记忆。"), 
+                                value=dm.format_entries(page_entries) or "尚无详细记忆。", 
                                 height=300, 
-                                key=f"detailed_{bot_name}_display", 
+                                key=f"detailed_{bot_name}_display_{page}", 
                                 disabled=True)
+                    st.caption(f"第 {page}/{total_pages} 页，共 {total_entries} 条")
                     if st.button("关闭详细记忆", key=f"close_detailed_{bot_name}"):
                         st.session_state[f"show_detailed_{bot_name}"] = False
 
+    cache_stats = memory_cache.get_stats()
+    st.caption(f"记忆缓存：命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次（命中率 {cache_stats['hit_rate']:.0%}）")
+
     st.subheader("对话总结")
     if st.session_state.summaries:
         for i, summary_text in enumerate(st.session_state.summaries):
-            with st.expander(f"总结 {i+1} (第 { (i+1) * SUMMARY_INTERVAL } 轮后)"):
+            with st.expander(f"总结 {i+1} (第 { (i+1) * chat_room.SUMMARY_INTERVAL } 轮后)"):
                 st.markdown(summary_text)
     else:
         st.caption("尚未生成总结。")
 
+    selection_stats = st.session_state.speaker_selection_stats.summary()
+    st.caption(
+        f"发言者选择：调用导演 {selection_stats['director']} 次，"
+        f"避免导演调用 {selection_stats['avoided']} 次（{selection_stats['avoided_rate']:.0%}）"
+    )
+    prefix_summary = prefix_stats.get_tracker().summary()
+    st.caption(
+        f"提示前缀：{prefix_summary['requests']} 次请求，"
+        f"与之前请求相同的前缀占 {prefix_summary['shared_prefix_ratio']:.0%}，"
+        f"可被服务端缓存的占 {prefix_summary['cacheable_prefix_ratio']:.0%}"
+    )
+    gateway_stats = gateway.stats()
+    st.caption("LLM服务商：" + "，".join(
+        f"{name} 请求 {b['requests']} 次、重试 {b['retries']} 次" + ("（冷却中）" if b['cooling_down'] else "")
+        for name, b in gateway_stats["backends"].items()
+    ) + f"；故障转移 {gateway_stats['failovers']} 次")
+    for backend_name, limiter_stats in rate_limiter.get_stats().items():
+        st.caption(
+            f"请求排队（{backend_name}）：当前 {limiter_stats['queue_depth']} 个，最多 {limiter_stats['max_queue_depth']} 个，"
+            f"限速等待 {limiter_stats['throttled']} 次；" + "，".join(
+                f"{name} 平均等待 {entry['avg_wait']:.1f} 秒" for name, entry in limiter_stats["by_priority"].items()
+            )
+        )
+    timing_summary = run_timing.get_timings().summary()
+    st.caption(
+        f"运行耗时：共享资源初始化 {timing_summary['startup_total'] * 1000:.0f} 毫秒（仅进程启动时一次），"
+        f"重新运行平均 {timing_summary['avg_run'] * 1000:.0f} 毫秒（共 {timing_summary['runs']} 次）"
+    )
+    response_cache_stats = llm_cache.get_cache().stats()
+    st.caption(f"响应缓存：命中 {response_cache_stats['hits']} 次，未命中 {response_cache_stats['misses']} 次")
+    scheduler_stats = st.session_state.memory_scheduler.stats()
+    st.caption(f"记忆更新：{scheduler_stats['bot_messages']} 条机器人消息合并为 {scheduler_stats['flushes']} 次请求")
+
+    st.toggle(
+        "预测下一条回复",
+        key="speculative_mode",
+        help="每轮机器人发言后在后台预测下一位发言者并提前生成回复；聊天没有变化时强制回复几乎立即完成。"
+    )
+    speculation_stats = st.session_state.speculation_stats.summary()
+    st.caption(
+        f"预测回复：命中 {speculation_stats['hits']} 次，未命中 {speculation_stats['misses']} 次，"
+        f"失败 {speculation_stats['failed']} 次，超时 {speculation_stats['timeouts']} 次（命中率 {speculation_stats['hit_rate']:.0%}）"
+    )
+    st.toggle(
+        "并行候选回复",
+        key="candidate_mode",
+        help="每轮为最适合发言的几位角色同时生成回复，在本地选出最合适的一条；未采用的回复留作之后几轮的候选。"
+    )
+    if st.session_state.candidate_mode:
+        st.number_input(
+            "候选角色数", min_value=2, max_value=chat_room.MAX_CANDIDATES,
+            value=DEFAULT_CANDIDATE_COUNT, step=1, key="candidate_count"
+        )
+    candidate_stats = st.session_state.candidate_stats.summary()
+    st.caption(
+        f"候选回复：{candidate_stats['turns']} 轮，新生成 {candidate_stats['generated']} 条，"
+        f"复用 {candidate_stats['seeded']} 条（被选中 {candidate_stats['seed_wins']} 次）"
+    )
+
     if st.button("强制机器人回复"):
         st.session_state.force_bot_turn = True
         st.rerun() # 重新运行以触发机器人回合逻辑
@@ -513,6 +347,15 @@ with st.sidebar:
     # 新增：机器人自动按钮和轮数输入
     st.subheader("自动对话")
     auto_rounds = st.number_input("指定自动对话轮数", min_value=1, max_value=50, value=5, step=1)
+    st.number_input(
+        "每轮间隔（秒）", min_value=0.0, max_value=10.0, value=AUTO_TURN_DELAY, step=0.5, key="auto_turn_delay",
+        help="自动对话每轮之间的等待时间，设为 0 时只受LLM生成速度限制。"
+    )
+    st.checkbox(
+        "批量生成",
+        key="batch_auto_mode",
+        help=f"一次请求生成最多 {batch_generation.BATCH_SIZE} 轮发言，每批只为每个角色更新一次记忆。"
+    )
     if st.button("机器人自动"):
         st.session_state.auto_bot_turns = auto_rounds
         st.session_state.current_auto_turn = 0
@@ -520,54 +363,68 @@ with st.sidebar:
 
 
 # --- 显示聊天消息 ---
+# 只渲染最近 LIVE_WINDOW 条消息；较早的消息折叠起来，打开后按页在片段中渲染，翻页不重新运行整个脚本
+view = st.session_state.chat_view
+view.sync(st.session_state.messages, message_avatar)
+
+@st.fragment
+def render_older_messages():
+    older_count = view.older_count()
+    if not st.toggle(f"显示较早的 {older_count} 条消息", key="show_older_messages"):
+        return
+    total_pages = view.page_count()
+    if "older_messages_page" not in st.session_state or st.session_state.older_messages_page > total_pages:
+        st.session_state.older_messages_page = total_pages
+    page = st.number_input("页码", min_value=1, max_value=total_pages, key="older_messages_page")
+    render_chat_entries(view.page(page))
+    st.caption(f"第 {page}/{total_pages} 页")
+
+if view.older_count():
+    render_older_messages()
+
 chat_container = st.container()
 with chat_container:
-    for msg in st.session_state.messages:
-        avatar = "🧑‍💻" if msg["role"] == st.session_state.user_name else get_avatar_url(msg["role"])
-        with st.chat_message(msg["role"], avatar=avatar):
-            st.markdown(f"**{msg['role']}** ({msg['timestamp'].strftime('%H:%M:%S')}):")
-            st.write(msg["content"])
+    render_chat_entries(view.live())
 
 
 # --- 处理机器人回合（自主聊天）---
 def bot_autonomous_turn():
-    if not st.session_state.bots_in_chat:
-        return False
+    # 预测的回复草稿仍然有效时直接提交
+    if room.commit_draft():
+        with chat_container:
+            render_chat_entries(view.live(1))
+        return True
+
+    # 并行生成多位角色的候选回复，本地排序后提交一条
+    if room.candidate_count > 1:
+        with st.spinner("多位角色正在思考..."):
+            committed = room.candidate_turn()
+        if committed:
+            with chat_container:
+                render_chat_entries(view.live(1))
+            return True
 
     # 使用隐藏导演确定下一个发言者
-    chosen_bot_name = determine_next_speaker(
-        st.session_state.messages, 
-        st.session_state.bots_in_chat,
-        st.session_state.last_speaker,
-        st.session_state.user_name
-    )
-    
-    if chosen_bot_name:
-        persona_details = st.session_state.bot_personas_data[chosen_bot_name]
-        bot_memory = st.session_state.bot_memories[chosen_bot_name]
-        #获取压缩记忆
-        compressed_memory_text = cm.get_compressed_memory(chosen_bot_name)
-        # time.sleep(random.uniform(BOT_RESPONSE_DELAY[0], BOT_RESPONSE_DELAY[1]))
+    chosen_bot_name = room.start_turn()
+    if not chosen_bot_name:
+        return False
 
-        with st.spinner(f"{chosen_bot_name} 正在输入..."):
-            bot_response = get_llm_response(
-                chosen_bot_name,
-                persona_details,
-                st.session_state.messages,
-                bot_memory,
-                compressed_memory_text
-            )
+    reply_inputs = room.reply_inputs(chosen_bot_name)
 
-        if bot_response:
-            timestamp = datetime.now()
-            st.session_state.messages.append({"role": chosen_bot_name, "content": bot_response, "timestamp": timestamp})
-            st.session_state.last_speaker = chosen_bot_name
-            st.session_state.conversation_rounds += 1
+    if STREAM_RESPONSES:
+        # 边生成边显示，完整文本生成后再提交到聊天历史
+        timestamp = datetime.now()
+        with chat_container:
+            with st.chat_message(chosen_bot_name, avatar=get_avatar_url(chosen_bot_name)):
+                st.markdown(f"**{chosen_bot_name}** ({timestamp.strftime('%H:%M:%S')}):")
+                bot_response = st.write_stream(room.stream_llm_response(chosen_bot_name, *reply_inputs))
+        bot_response = bot_response.strip() if isinstance(bot_response, str) else ""
+    else:
+        with st.spinner(f"{chosen_bot_name} 正在输入..."):
+            bot_response = room.get_llm_response(chosen_bot_name, *reply_inputs)
+        timestamp = datetime.now()
 
-            new_memory = update_bot_memory(chosen_bot_name, persona_details, st.session_state.messages, bot_memory)
-            st.session_state.bot_memories[chosen_bot_name] = new_memory
-            return True
-    return False
+    return room.finish_turn(chosen_bot_name, bot_response, timestamp)
 
 # --- 处理强制机器人回合或决定机器人是否应该说话 ---
 if st.session_state.get("force_bot_turn", False):
@@ -579,9 +436,12 @@ if st.session_state.get("force_bot_turn", False):
 # 保持聊天输入框在主布局中
 if prompt := st.chat_input(f"以 {st.session_state.user_name} 的身份聊天..."):
     timestamp = datetime.now()
-    st.session_state.messages.append({"role": st.session_state.user_name, "content": prompt, "timestamp": timestamp})
-    st.session_state.last_speaker = st.session_state.user_name
-    st.session_state.conversation_rounds += 1
+    room.add_message(st.session_state.user_name, prompt, timestamp, is_bot=False)
+    # 先显示用户消息，机器人回复会在其下方流式显示
+    with chat_container:
+        with st.chat_message(st.session_state.user_name, avatar=USER_AVATAR):
+            st.markdown(f"**{st.session_state.user_name}** ({timestamp.strftime('%H:%M:%S')}):")
+            st.write(prompt)
     
     bot_responded_after_user = bot_autonomous_turn()
     st.rerun()
@@ -589,94 +449,74 @@ if prompt := st.chat_input(f"以 {st.session_state.user_name} 的身份聊天...
 # 将报告按钮放在聊天输入框上方或侧边，但不要使用影响聊天输入框位置的列布局
 if st.button("生成对话报告", key="generate_report"):
     with st.spinner("正在生成对话报告..."):
-        report = generate_conversation_report(st.session_state.messages)
+        report = room.generate_conversation_report()
         st.session_state.summaries.append(report)
         st.toast("对话报告已生成并添加到总结列表！")
         st.rerun()
 
 # --- 总结逻辑 ---
-if st.session_state.conversation_rounds > 0 and \
-   st.session_state.conversation_rounds % SUMMARY_INTERVAL == 0 and \
-   (not st.session_state.summaries or len(st.session_state.summaries) * SUMMARY_INTERVAL < st.session_state.conversation_rounds):
-    with st.spinner("正在生成对话总结..."):
-        start_index_for_summary = max(0, len(st.session_state.messages) - SUMMARY_INTERVAL)
-        actual_messages_for_summary = st.session_state.messages[start_index_for_summary : len(st.session_state.messages)]
-        summary_text = get_conversation_summary(actual_messages_for_summary)
-        st.session_state.summaries.append(summary_text)
-        st.toast(f"已为第 {st.session_state.conversation_rounds} 轮生成对话总结！")
-        # 此处不需要重新运行
+room.maybe_schedule_summary() # 在后台生成，此处不需要重新运行
 
 # --- 如果聊天为空，机器人初始问候 ---
-if not st.session_state.messages and st.session_state.bots_in_chat:
-    # 随机选择一个机器人，而不是总是第一个
-    first_bot_name = random.choice(st.session_state.bots_in_chat)
-    persona_details = st.session_state.bot_personas_data[first_bot_name]
-    
-    # 获取压缩记忆
-    compressed_memory_text = cm.get_compressed_memory(first_bot_name)
-    
-    if compressed_memory_text:
-        # 如果有压缩记忆，使用LLM基于压缩记忆生成随机问候
-        prompt = (
-            f"你是一个AI助手，为 {first_bot_name}（{persona_details['description']}）生成一个简短的聊天室开场问候。\n"
-            f"基于以下长期记忆：\n{compressed_memory_text}\n\n"
-            f"生成一个自然的、符合角色性格的问候语，长度不超过50字，反映角色的背景或记忆中的关键点。"
-        )
-        try:
-            completion = client.chat.completions.create(
-                model=LLM_MODEL,
-                messages=[
-                    {"role": "system", "content": "你是一个有创意的问候生成助手。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=50
-            )
-            initial_greeting = completion.choices[0].message.content.strip()
-        except Exception as e:
-            st.error(f"生成 {first_bot_name} 的问候时出错：{e}")
-            initial_greeting = persona_details.get("greeting", f"你好，我是 {first_bot_name}。")
-    else:
-        # 如果没有压缩记忆，使用persona.py中的预设问候
-        initial_greeting = persona_details.get("greeting", f"你好，我是 {first_bot_name}。")
-    
-    timestamp = datetime.now()
-    st.session_state.messages.append({"role": first_bot_name, "content": initial_greeting, "timestamp": timestamp})
-    st.session_state.last_speaker = first_bot_name
-    st.session_state.conversation_rounds += 1
-    st.session_state.bot_memories[first_bot_name] = update_bot_memory(
-        first_bot_name, persona_details, st.session_state.messages, st.session_state.bot_memories[first_bot_name]
-    )
+if room.open_conversation():
     st.rerun()
 
 
 # --- 处理机器人自动对话逻辑 ---
-if "auto_bot_turns" in st.session_state and st.session_state.auto_bot_turns > 0:
-    if "current_auto_turn" not in st.session_state:
-        st.session_state.current_auto_turn = 0
-    
-    if st.session_state.current_auto_turn < st.session_state.auto_bot_turns:
-        with st.spinner(f"自动对话进行中... (第 {st.session_state.current_auto_turn + 1}/{st.session_state.auto_bot_turns} 轮)"):
-            # 添加随机延迟
-            delay = random.uniform(BOT_RESPONSE_DELAY[0], BOT_RESPONSE_DELAY[1])
+def run_auto_conversation():
+    """
+    在一次脚本运行中连续生成剩余的自动对话轮次：每条新消息生成后立即显示在聊天区域，
+    每轮之间提交已完成的后台任务，不需要每轮重新运行整个脚本。
+    运行被用户操作打断时，进度保存在会话状态中，下一次运行继续生成剩余的轮次。
+    """
+    progress = st.empty()
+    while st.session_state.current_auto_turn < st.session_state.auto_bot_turns:
+        done = st.session_state.current_auto_turn
+        total = st.session_state.auto_bot_turns
+        generated_turns = 0
+        if st.session_state.get("batch_auto_mode", False):
+            batch_end = done + min(total - done, batch_generation.BATCH_SIZE)
+            progress.caption(f"批量生成对话中... (第 {done + 1}-{batch_end}/{total} 轮)")
+            generated_turns = room.batch_turns(total - done)
+            if generated_turns:
+                with chat_container:
+                    render_chat_entries(view.entries[-generated_turns:])
+        if not generated_turns:
+            # 逐轮生成（批量生成失败时也回退到这里）
+            progress.caption(f"自动对话进行中... (第 {done + 1}/{total} 轮)")
+            if not bot_autonomous_turn():
+                break
+            # 检查是否需要生成总结
+            room.maybe_schedule_summary()
+            generated_turns = 1
+        st.session_state.current_auto_turn += generated_turns
+        room.commit_ready()
+
+        delay = st.session_state.get("auto_turn_delay", AUTO_TURN_DELAY)
+        if delay > 0 and st.session_state.current_auto_turn < total:
             time.sleep(delay)
-            
-            if bot_autonomous_turn():
-                st.session_state.current_auto_turn += 1
-                # 检查是否需要生成总结
-                if st.session_state.conversation_rounds > 0 and \
-                   st.session_state.conversation_rounds % SUMMARY_INTERVAL == 0 and \
-                   (not st.session_state.summaries or len(st.session_state.summaries) * SUMMARY_INTERVAL < st.session_state.conversation_rounds):
-                    with st.spinner("正在生成对话总结..."):
-                        start_index_for_summary = max(0, len(st.session_state.messages) - SUMMARY_INTERVAL)
-                        actual_messages_for_summary = st.session_state.messages[start_index_for_summary : len(st.session_state.messages)]
-                        summary_text = get_conversation_summary(actual_messages_for_summary)
-                        st.session_state.summaries.append(summary_text)
-                        st.toast(f"已为第 {st.session_state.conversation_rounds} 轮生成对话总结！")
-                st.rerun()
-    else:
-        # 自动对话完成，重置状态
-        st.session_state.auto_bot_turns = 0
-        st.session_state.current_auto_turn = 0
-        st.toast("自动对话已完成！")
-        st.rerun()
+
+    # 自动对话完成，重置状态
+    progress.empty()
+    st.session_state.auto_bot_turns = 0
+    st.session_state.current_auto_turn = 0
+    st.toast("自动对话已完成！")
+
+if st.session_state.get("auto_bot_turns", 0) > 0:
+    st.session_state.setdefault("current_auto_turn", 0)
+    run_auto_conversation()
+    st.rerun()
+
+
+# --- 后台任务完成或会话空闲需要刷新记忆缓冲时刷新页面 ---
+if st.session_state.background_jobs.pending() or st.session_state.memory_scheduler.has_pending():
+    @st.fragment(run_every=BACKGROUND_JOB_POLL_INTERVAL)
+    def poll_background_jobs():
+        scheduler = st.session_state.memory_scheduler
+        if st.session_state.background_jobs.has_ready() or (scheduler.has_pending() and scheduler.is_idle()):
+            st.rerun()
+
+    poll_background_jobs()
+
+# --- 记录本次完整运行的耗时（中途 st.rerun() 的运行不计入） ---
+run_timing.get_timings().record_run(time.perf_counter() - RUN_STARTED_AT)
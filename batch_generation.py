@@ -0,0 +1,132 @@
+"""
+批量生成模块：自动对话模式下，一次LLM请求规划并生成多轮连续发言
+LLM以JSON结构化输出发言列表，经校验后拆分为每个角色的消息，
+避免每轮都分别调用导演、回复和记忆更新。
+"""
+
+import json
+from speaker_selector import name_aliases
+
+BATCH_SIZE = 10 # 每次请求最多生成的发言轮数
+MAX_TOKENS_PER_TURN = 300 # 每轮发言预留的输出 token 数
+MAX_BATCH_TOKENS = 4000 # 单次批量请求的输出 token 上限
+PERSONA_MEMORY_CHARS = 300 # 每个角色的长期记忆在提示中保留的字符数
+WORKING_MEMORY_LINES = 3 # 每个角色的工作记忆在提示中保留的最近条目数
+
+
+def _speaker_lookup(bots):
+    """名称及别名到规范角色名的映射，用于校验LLM返回的发言者"""
+    lookup = {}
+    for name in bots:
+        for alias in name_aliases(name):
+            lookup.setdefault(alias, name)
+    return lookup
+
+
+def build_batch_prompt(bots, personas_data, chat_history, bot_memories, compressed_memories, n_turns, history_len=20):
+    """
+    构建批量生成的提示
+
+    参数:
+        bots: 参与对话的角色名称列表
+        personas_data: 角色名称到角色数据的字典
+        chat_history: 聊天历史
+        bot_memories: 角色名称到工作记忆的字典
+        compressed_memories: 角色名称到压缩记忆的字典
+        n_turns: 需要生成的发言轮数
+        history_len: 提示中包含的最近消息数
+    """
+    persona_sections = []
+    for name in bots:
+        persona = personas_data.get(name, {})
+        section = (
+            f"### {name}\n"
+            f"描述：{persona.get('description', '')}\n"
+            f"背景：{persona.get('background', '')}\n"
+        )
+        compressed = compressed_memories.get(name, "")
+        if compressed:
+            section += f"长期记忆：{compressed[:PERSONA_MEMORY_CHARS]}\n"
+        working_lines = [line for line in bot_memories.get(name, "").split("\n")[1:] if line.strip()]
+        if working_lines:
+            section += "最近记忆：\n" + "\n".join(working_lines[-WORKING_MEMORY_LINES:]) + "\n"
+        persona_sections.append(section)
+
+    history_text = "\n".join(f"{msg['role']}: {msg['content']}" for msg in chat_history[-history_len:])
+    last_speaker = chat_history[-1]["role"] if chat_history else "无"
+
+    return (
+        f"你是一个多角色聊天室的编剧。请根据角色设定和对话历史，续写接下来的 {n_turns} 轮发言。\n\n"
+        f"角色设定：\n" + "\n".join(persona_sections) + "\n"
+        f"最近的对话历史：\n{history_text}\n\n"
+        f"要求：\n"
+        f"1. 发言者只能从以下名单中选择：{', '.join(bots)}\n"
+        f"2. 同一个角色不能连续发言，第一轮发言者不能是 {last_speaker}\n"
+        f"3. 每个角色保持自己的性格和立场，自然地回应前面的发言，简明扼要，不要问候\n"
+        f"4. 综合考虑谁被提及、谁最适合回应当前话题、谁最近发言较少\n\n"
+        f"只返回如下格式的JSON，不要任何额外说明：\n"
+        f'{{"turns": [{{"speaker": "角色名", "content": "发言内容"}}]}}'
+    )
+
+
+def parse_batch_response(text, bots, max_turns):
+    """
+    解析并校验LLM返回的批量发言
+
+    未知发言者的条目会被丢弃；同一角色连续发言会合并为一条。
+
+    返回:
+        [{"speaker": 角色名, "content": 内容}] 列表；无法解析时返回空列表
+    """
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    end = max(text.rfind("}"), text.rfind("]")) + 1
+    if start < 0 or end <= start:
+        return []
+    try:
+        data = json.loads(text[start:end])
+    except ValueError:
+        return []
+    raw_turns = data.get("turns", []) if isinstance(data, dict) else data
+    if not isinstance(raw_turns, list):
+        return []
+
+    lookup = _speaker_lookup(bots)
+    turns = []
+    for item in raw_turns:
+        if not isinstance(item, dict):
+            continue
+        speaker = lookup.get(str(item.get("speaker", "")).strip().lower())
+        content = item.get("content")
+        if not speaker or not isinstance(content, str) or not content.strip():
+            continue
+        if turns and turns[-1]["speaker"] == speaker:
+            turns[-1]["content"] += "\n" + content.strip()
+            continue
+        turns.append({"speaker": speaker, "content": content.strip()})
+    return turns[:max_turns]
+
+
+def generate_batch(client, llm_model, bots, personas_data, chat_history, bot_memories, compressed_memories, n_turns, history_len=20):
+    """
+    一次请求生成多轮发言
+
+    返回:
+        校验后的发言列表；请求失败或无法解析时返回空列表，调用方应回退到逐轮生成
+    """
+    n_turns = max(1, min(n_turns, BATCH_SIZE))
+    prompt = build_batch_prompt(bots, personas_data, chat_history, bot_memories, compressed_memories, n_turns, history_len)
+    try:
+        completion = client.chat.completions.create(
+            model=llm_model,
+            messages=[
+                {"role": "system", "content": "你是一位擅长多角色对话创作的编剧，只输出JSON。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.8,
+            max_tokens=min(MAX_BATCH_TOKENS, MAX_TOKENS_PER_TURN * n_turns)
+        )
+        result = completion.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"批量生成对话时出错: {e}")
+        return []
+    return parse_batch_response(result, bots, n_turns)
@@ -0,0 +1,1040 @@
+"""
+聊天室引擎：与 Streamlit 无关的对话逻辑
+ChatRoom 负责选择发言者、生成回复、记忆更新、对话总结和报告，
+会话数据保存在可替换的状态对象中（Streamlit 中直接使用 st.session_state，离线模拟使用 RoomState），
+错误和提示通过事件接收器（sink）发出，因此同一套逻辑既能在页面中运行，也能在命令行中批量运行（见 simulate.py）。
+
+事件接收器只需实现 emit(event, **data)，事件类型：
+    "message": 新消息，data 为 {"index", "speaker", "content", "timestamp"}
+    "info": 提示，data 为 {"text"}
+    "error": 错误，data 为 {"text"}
+"""
+
+import json
+import random
+from concurrent.futures import wait, TimeoutError as FuturesTimeoutError
+from datetime import datetime
+
+import compressed_memory as cm
+import detailed_memory as dm
+import llm_jobs
+import speaker_selector
+import batch_generation
+import memory_scheduler
+import prompt_builder
+import prefix_stats
+import llm_cache
+import summary_tree
+import llm_gateway
+import speculation
+import reply_ranker
+
+# --- 配置 ---
+MAX_HISTORY_LEN = 20 # LLM 可见的最大消息数（实际条数还受各请求的 token 预算限制，见 prompt_builder）
+MAX_BOT_MEMORY_LEN = 20 # 每个机器人工作记忆的最大条目数
+SUMMARY_INTERVAL = 3 # 每隔多少轮总消息进行一次总结
+MEMORY_COMPRESSION_INTERVAL = 3 # 每隔多少次记忆更新压缩一次记忆
+RECALL_TOP_K = 5 # 每次回复从详细记忆中检索的相关往事条数
+RECALL_QUERY_MESSAGES = 4 # 用最近多少条消息作为记忆检索的查询
+MAX_CANDIDATES = 4 # 并行生成候选回复的最大角色数
+CANDIDATE_TIMEOUT = 30 # 等待候选回复的最长秒数，超时的候选被放弃
+DRAFT_WAIT_TIMEOUT = 5 # 轮到机器人发言时等待未完成草稿的最长秒数，超时后按正常流程生成
+DEFAULT_BOTS_IN_CHAT = 6 # 没有指定角色时，以前几个角色开始
+
+_MISSING = object()
+
+
+def create_client():
+    """
+    创建LLM客户端（见 llm_gateway：多服务商故障转移、重试和连接复用）。
+    记录每次请求可被服务端提示缓存复用的前缀；
+    传入 use_cache=True 的确定性调用（总结、报告、角色解析）优先使用本地响应缓存；
+    实际发出的请求按 priority 在所选服务商的配额内排队限速（见 llm_gateway），缓存命中不占用配额。
+
+    返回:
+        (gateway, client)
+    """
+    gateway = llm_gateway.get_gateway()
+    client = llm_cache.CachedClient(
+        prefix_stats.PrefixInstrumentedClient(gateway, prefix_stats.get_tracker()),
+        llm_cache.get_cache()
+    )
+    return gateway, client
+
+
+class RoomState:
+    """离线运行时的会话状态，属性与 st.session_state 中的键一致"""
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def init_state(state, personas, bots=None, user_name=None):
+    """为状态对象补齐尚未设置的会话数据（已有的值保持不变）"""
+    defaults = {
+        "messages": list, # 完整聊天历史：{"role": "name", "content": "text", "timestamp": datetime}
+        "bot_memories": dict, # 角色 -> 工作记忆，角色加入聊天时才创建
+        "conversation_rounds": lambda: 0, # 已发送的总消息数
+        "summaries": list, # 总结列表
+        "last_speaker": lambda: None, # 避免立即自我回复
+        "user_name": lambda: user_name or f"用户_{random.randint(1000, 9999)}",
+        "bots_in_chat": lambda: list(bots) if bots is not None else personas.names[:DEFAULT_BOTS_IN_CHAT],
+        "memory_updates_count": dict, # 记录每个角色记忆更新的次数
+        "background_jobs": llm_jobs.JobQueue, # 记忆更新、压缩和总结等后台任务
+        "pending_summaries": lambda: 0, # 正在后台生成的总结数
+        "summarized_upto": lambda: 0, # 已安排总结的消息数
+        "summary_tree": summary_tree.SummaryTree, # 分层总结，用于生成报告
+        "memory_scheduler": memory_scheduler.MemoryUpdateScheduler, # 合并每个角色的记忆更新
+        "speaker_selection_stats": speaker_selector.SelectionStats, # 发言者选择来源统计
+        "speculative_draft": lambda: None, # 后台预先生成的下一条机器人回复（speculation.Draft）
+        "speculation_stats": speculation.SpeculationStats, # 预生成草稿的命中统计
+        "reply_seeds": reply_ranker.ReplySeeds, # 未被采用的候选回复，之后几轮可复用
+        "candidate_stats": reply_ranker.CandidateStats, # 候选回复的生成和复用统计
+        # 超时或被丢弃但仍在运行的请求：键（角色名或 "draft"）-> (Future, 提交时的历史长度)
+        "stragglers": dict,
+    }
+    for key, factory in defaults.items():
+        if getattr(state, key, _MISSING) is _MISSING:
+            setattr(state, key, factory())
+    return state
+
+
+class PrintSink:
+    """把错误和提示打印到标准输出的事件接收器"""
+
+    def emit(self, event, **data):
+        if event in ("error", "info"):
+            print(data["text"])
+
+
+class JsonlTranscriptSink:
+    """把聊天室的事件逐行写入 JSONL 文件，每行带上聊天室编号"""
+
+    def __init__(self, path, room_id):
+        self.room_id = room_id
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def emit(self, event, **data):
+        record = {"room": self.room_id, "event": event}
+        for key, value in data.items():
+            record[key] = value.isoformat() if isinstance(value, datetime) else value
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+def merge_memory_entry(current_memory, new_memory_entry):
+    """
+    将新记忆条目合并进工作记忆。
+    保持工作记忆在合理长度内（MAX_BOT_MEMORY_LEN条目）。
+    """
+    memory_lines = current_memory.split('\n')
+    # 保留初始记忆行和最近的MAX_BOT_MEMORY_LEN-1条记忆
+    initial_memory = memory_lines[0] if memory_lines else ""
+    recent_memories = memory_lines[1:] if len(memory_lines) > 1 else []
+
+    if len(recent_memories) >= MAX_BOT_MEMORY_LEN - 1:
+        recent_memories = recent_memories[-(MAX_BOT_MEMORY_LEN - 2):]
+
+    return initial_memory + "\n" + "\n".join(recent_memories + [new_memory_entry])
+
+
+class ChatRoom:
+    """
+    一个聊天室的对话引擎。
+    后台任务的结果在调用 commit_ready() 的线程中提交，状态对象只在该线程中修改。
+
+    参数:
+        client, llm_model: LLM客户端和模型
+        personas: 角色注册表（persona_registry.PersonaRegistry）
+        state: 会话状态（st.session_state 或 RoomState）
+        sink: 事件接收器，默认打印错误和提示
+        bots: 初始的聊天角色（状态中已有 bots_in_chat 时忽略）
+        persist_memory: 为 False 时记忆更新只写入工作记忆，不写入磁盘上的详细记忆和压缩记忆
+        speculative: 为 True 时每轮机器人发言后在后台预测下一位发言者并预先生成它的回复（见 speculation）
+        candidate_count: 大于 1 时每轮为评分最高的几位角色并行生成候选回复，本地排序后提交一条（见 reply_ranker）
+    """
+
+    def __init__(self, client, llm_model, personas, state=None, sink=None, bots=None, persist_memory=True, speculative=False,
+                 candidate_count=0):
+        self.client = client
+        self.llm_model = llm_model
+        self.personas = personas
+        self.state = init_state(state if state is not None else RoomState(), personas, bots)
+        self.sink = sink or PrintSink()
+        self.persist_memory = persist_memory
+        self.speculative = speculative
+        self.candidate_count = min(candidate_count, MAX_CANDIDATES)
+
+    def _error(self, text):
+        self.sink.emit("error", text=text)
+
+    def _info(self, text):
+        self.sink.emit("info", text=text)
+
+    def _straggling(self, key):
+        """
+        键对应的请求是否仍在运行。Future.cancel() 无法中止已经开始的请求，
+        超时或被丢弃的请求会继续占用前台线程和限速配额，在它们结束之前不为同一个键重新提交。
+        """
+        entry = self.state.stragglers.get(key)
+        return entry is not None and not entry[0].done()
+
+    def _collect_stragglers(self):
+        """清理已结束的请求；成功生成的候选回复保存为种子，之后几轮可以复用"""
+        stragglers = self.state.stragglers
+        for key, (future, history_len) in list(stragglers.items()):
+            if not future.done():
+                continue
+            del stragglers[key]
+            if key == "draft" or future.cancelled() or future.exception() is not None:
+                continue
+            self.state.reply_seeds.put({"speaker": key, "content": future.result(), "history_len": history_len})
+
+    # --- 回复 ---
+
+    def build_reply_messages(self, persona_name, chat_history, bot_memory, compressed_memory_text="", relevant_memory_text=""):
+        """
+        根据角色、历史记录和记忆构建回复请求的消息列表。
+        增加了压缩记忆参数，为角色提供长期经验；relevant_memory_text 是从详细记忆中检索到的相关往事。
+        按 REPLY_TOKEN_BUDGET 分配：角色设定 > 压缩记忆 > 相关往事 > 工作记忆 > 最近的对话历史。
+        提示按变化频率排列：固定的角色设定和指令在最前，很少变化的压缩记忆其次，
+        每轮都会变化的工作记忆和对话历史在最后，使同一角色的请求共享尽量长的可缓存前缀。
+        """
+        budget = prompt_builder.PromptBudget(prompt_builder.REPLY_TOKEN_BUDGET)
+        system_prompt = budget.reserve(
+            self.personas.prompt_fragment(persona_name) +
+            f"你正在一个聊天室中。系统提示之后是最近的对话历史。"
+            f"自然地进行互动。简明扼要。保持角色特性。除非这是你的第一条消息，否则不要问候。\n\n"
+        )
+
+        # 添加压缩记忆（如果有）
+        if compressed_memory_text:
+            compressed_memory_text = budget.take_text(compressed_memory_text, prompt_builder.COMPRESSED_MEMORY_SHARE)
+            system_prompt += f"你的核心经验（长期记忆）：{compressed_memory_text}\n\n"
+
+        # 与当前话题相关的较早记忆
+        if relevant_memory_text:
+            relevant_memory_text = budget.take_text(relevant_memory_text, prompt_builder.RELEVANT_MEMORY_SHARE)
+            system_prompt += f"与当前话题相关的往事：\n{relevant_memory_text}"
+
+        # 工作记忆按时间追加，超出预算时保留最近的部分
+        bot_memory = budget.take_text(bot_memory, prompt_builder.WORKING_MEMORY_SHARE, keep="tail")
+        system_prompt += f"你的最近工作记忆（用于保持一致性）：{bot_memory}"
+        history_for_llm = budget.take_history(chat_history, MAX_HISTORY_LEN)
+
+        messages_for_llm = [{"role": "system", "content": system_prompt}]
+
+        # 修复：将所有角色映射为 API 的 "user" 或 "assistant"
+        for msg in history_for_llm:
+            # 如果消息来自当前角色，则是 "assistant" 消息
+            # 否则，是 "user" 消息（无论是来自用户还是其他机器人）
+            if msg["role"] == persona_name:
+                role = "assistant"
+                msg_content = msg["content"]
+            else:
+                role = "user"
+                # 为了上下文，在内容中添加实际发言者的名称
+                msg_content = f"[{msg['role']}]: {msg['content']}"
+
+            messages_for_llm.append({
+                "role": role,
+                "content": msg_content
+            })
+
+        return messages_for_llm
+
+    def reply_inputs(self, persona_name):
+        """
+        收集角色回复所需的输入：(聊天历史, 工作记忆, 压缩记忆, 相关往事)，
+        可直接传给 get_llm_response 或 stream_llm_response。
+        """
+        return (
+            self.state.messages,
+            self.state.bot_memories[persona_name],
+            cm.get_compressed_memory(persona_name),
+            self.recall_relevant_memory(persona_name),
+        )
+
+    def get_llm_response(self, persona_name, chat_history, bot_memory, compressed_memory_text="", relevant_memory_text=""):
+        """
+        根据角色、历史记录和记忆获取 LLM 的响应。
+        """
+        messages_for_llm = self.build_reply_messages(persona_name, chat_history, bot_memory, compressed_memory_text, relevant_memory_text)
+
+        try:
+            return self._complete_reply(messages_for_llm)
+        except Exception as e:
+            self._error(f"{persona_name} 与 LLM 通信出错：{str(e)}")
+            return f"({persona_name} 思考遇到了困难...)"
+
+    def _complete_reply(self, messages_for_llm, priority="reply"):
+        """发出回复请求并返回回复文本，出错时抛出异常"""
+        completion = self.client.chat.completions.create(
+            model=self.llm_model,
+            messages=messages_for_llm,
+            temperature=0.7,
+            max_tokens=500,
+            priority=priority
+        )
+        return completion.choices[0].message.content.strip()
+
+    def stream_llm_response(self, persona_name, chat_history, bot_memory, compressed_memory_text="", relevant_memory_text=""):
+        """
+        流式获取 LLM 的响应，逐段产出文本增量，供 st.write_stream 渲染。
+        出错时：如果还没有收到任何内容，产出占位文本；否则保留已收到的部分。
+        """
+        messages_for_llm = self.build_reply_messages(persona_name, chat_history, bot_memory, compressed_memory_text, relevant_memory_text)
+
+        received_any = False
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.llm_model,
+                messages=messages_for_llm,
+                temperature=0.7,
+                max_tokens=500,
+                stream=True
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    received_any = True
+                    yield delta
+        except Exception as e:
+            self._error(f"{persona_name} 与 LLM 通信出错：{str(e)}")
+            if not received_any:
+                yield f"({persona_name} 思考遇到了困难...)"
+
+    def add_message(self, speaker, content, timestamp=None, is_bot=True):
+        """把一条消息追加到聊天历史，并登记到记忆更新调度器"""
+        timestamp = timestamp or datetime.now()
+        state = self.state
+        state.messages.append({"role": speaker, "content": content, "timestamp": timestamp})
+        state.last_speaker = speaker
+        state.conversation_rounds += 1
+        state.memory_scheduler.record_message(speaker, len(state.messages) - 1, is_bot)
+        self.sink.emit("message", index=len(state.messages) - 1, speaker=speaker, content=content, timestamp=timestamp)
+        if not is_bot:
+            # 用户发言后之前的草稿和候选已经过时
+            self.discard_draft()
+            state.reply_seeds.clear()
+
+    def start_turn(self):
+        """
+        选出下一个发言的机器人。
+        没有可发言的机器人时返回 None。
+        """
+        if not self.state.bots_in_chat:
+            return None
+        return self.determine_next_speaker()
+
+    def finish_turn(self, persona_name, bot_response, timestamp=None):
+        """提交一轮机器人回复；回复为空时返回 False"""
+        if not bot_response:
+            return False
+        self.add_message(persona_name, bot_response, timestamp)
+        # 记忆更新先缓冲，到期后在后台合并更新，不阻塞回复的显示
+        self.flush_memory_updates()
+        self.speculate()
+        return True
+
+    def bot_turn(self):
+        """进行一轮机器人发言（非流式）；没有生成回复时返回 False"""
+        if self.commit_draft():
+            return True
+        if self.candidate_count > 1 and self.candidate_turn():
+            return True
+        chosen_bot_name = self.start_turn()
+        if not chosen_bot_name:
+            return False
+        bot_response = self.get_llm_response(chosen_bot_name, *self.reply_inputs(chosen_bot_name))
+        return self.finish_turn(chosen_bot_name, bot_response)
+
+    def candidate_turn(self):
+        """
+        为发言者评分最高的 candidate_count 位角色并行生成候选回复，用本地排序选出一条提交，
+        其余候选保存为种子；之后几轮评分靠前的角色有种子时直接复用，不再重新生成。
+        一轮的耗时是最慢的一次回复请求，而不是导演调用加一次回复请求。
+
+        返回:
+            提交的发言者；没有可用候选时返回 None（调用方应回退到逐轮生成）
+        """
+        state = self.state
+        history = state.messages
+        eligible_bots = [b for b in state.bots_in_chat if b != state.last_speaker] or list(state.bots_in_chat)
+        if not eligible_bots:
+            return None
+
+        recent_messages = history[-MAX_HISTORY_LEN:]
+        speaker_scores = speaker_selector.score_candidates(recent_messages, eligible_bots, self.personas.personas)
+        top_speakers = [name for name, _ in speaker_scores[:self.candidate_count]]
+        self.ensure_working_memory(top_speakers)
+
+        self._collect_stragglers()
+        candidates = []
+        futures = {}
+        for name in top_speakers:
+            seed = state.reply_seeds.take(name, len(history))
+            if seed is not None:
+                candidates.append(seed)
+                continue
+            if self._straggling(name):
+                continue # 上一轮超时的请求仍在运行
+            # 提示在脚本线程中构建，只有回复请求并行发出
+            messages_for_llm = self.build_reply_messages(name, *self.reply_inputs(name))
+            futures[name] = llm_jobs.submit_foreground(self._complete_reply, messages_for_llm)
+        done, _ = wait(futures.values(), timeout=CANDIDATE_TIMEOUT)
+        for name, future in futures.items():
+            if future not in done:
+                if not future.cancel():
+                    state.stragglers[name] = (future, len(history))
+                self._error(f"等待 {name} 的候选回复超时")
+                continue
+            try:
+                candidates.append({"speaker": name, "content": future.result(), "history_len": len(history)})
+            except Exception as e:
+                self._error(f"生成 {name} 的候选回复时出错：{e}")
+        if not candidates:
+            return None
+
+        ranked = reply_ranker.rank_candidates(candidates, history, dict(speaker_scores))
+        best, best_score = ranked[0]
+        if best_score == float("-inf"):
+            return None
+        for candidate, _ in ranked[1:]:
+            state.reply_seeds.put(candidate)
+        state.reply_seeds.discard(best["speaker"])
+
+        stats = state.candidate_stats
+        stats.turns += 1
+        stats.generated += len(futures)
+        stats.seeded += sum(1 for candidate in candidates if candidate["speaker"] not in futures)
+        if best["history_len"] < len(history):
+            stats.seed_wins += 1
+        state.speaker_selection_stats.record("heuristic")
+
+        self.finish_turn(best["speaker"], best["content"])
+        return best["speaker"]
+
+    def batch_turns(self, n_turns):
+        """
+        一次请求生成多轮机器人发言（自动对话的批量模式）。
+        发言登记到记忆更新调度器，本批结束后统一刷新。
+        返回生成的轮数；为0时调用方应回退到逐轮生成。
+        """
+        bots = self.state.bots_in_chat
+        if not bots:
+            return 0
+
+        compressed_memories = {name: cm.get_compressed_memory(name) for name in bots}
+        turns = batch_generation.generate_batch(
+            self.client,
+            self.llm_model,
+            bots,
+            self.personas.personas,
+            self.state.messages,
+            self.state.bot_memories,
+            compressed_memories,
+            n_turns,
+            MAX_HISTORY_LEN
+        )
+
+        for turn in turns:
+            self.add_message(turn["speaker"], turn["content"])
+            self.maybe_schedule_summary()
+
+        self.flush_memory_updates()
+        return len(turns)
+
+    def open_conversation(self):
+        """
+        聊天为空时，随机选择一个机器人发出开场问候。
+        有压缩记忆时基于压缩记忆生成问候，否则使用角色预设的问候。
+        """
+        if self.state.messages or not self.state.bots_in_chat:
+            return False
+        # 随机选择一个机器人，而不是总是第一个
+        first_bot_name = random.choice(self.state.bots_in_chat)
+        persona_details = self.personas.personas[first_bot_name]
+        default_greeting = persona_details.get("greeting", f"你好，我是 {first_bot_name}。")
+
+        # 获取压缩记忆
+        compressed_memory_text = cm.get_compressed_memory(first_bot_name)
+
+        if compressed_memory_text:
+            # 如果有压缩记忆，使用LLM基于压缩记忆生成随机问候
+            prompt = (
+                f"你是一个AI助手，为 {first_bot_name}（{persona_details['description']}）生成一个简短的聊天室开场问候。\n"
+                f"基于以下长期记忆：\n{compressed_memory_text}\n\n"
+                f"生成一个自然的、符合角色性格的问候语，长度不超过50字，反映角色的背景或记忆中的关键点。"
+            )
+            try:
+                completion = self.client.chat.completions.create(
+                    model=self.llm_model,
+                    messages=[
+                        {"role": "system", "content": "你是一个有创意的问候生成助手。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.7,
+                    max_tokens=50
+                )
+                initial_greeting = completion.choices[0].message.content.strip()
+            except Exception as e:
+                self._error(f"生成 {first_bot_name} 的问候时出错：{e}")
+                initial_greeting = default_greeting
+        else:
+            # 如果没有压缩记忆，使用persona.py中的预设问候
+            initial_greeting = default_greeting
+
+        self.add_message(first_bot_name, initial_greeting)
+        self.flush_memory_updates()
+        self.speculate()
+        return True
+
+    # --- 预测性回复 ---
+
+    def _generate_draft(self, history, bots, last_speaker, bot_memories, memory_updates_count):
+        """
+        在后台线程中预测下一位发言者并生成它的回复；参数都是调用时的快照。
+
+        返回:
+            (发言者, 回复, 出错信息列表)；出错信息在使用草稿时通过 sink 发出
+        """
+        errors = []
+        # 预测用的选择不计入页面上的发言者选择统计，导演调用按预测请求的优先级排队
+        speaker = self.choose_speaker(
+            history, list(bots), last_speaker, speaker_selector.SelectionStats(),
+            on_error=errors.append, priority="speculation"
+        )
+        reply_inputs = (
+            history,
+            bot_memories[speaker],
+            cm.get_compressed_memory(speaker),
+            self.recall_relevant_memory(speaker, history, memory_updates_count),
+        )
+        return speaker, self._complete_reply(self.build_reply_messages(speaker, *reply_inputs), priority="speculation"), errors
+
+    def speculate(self):
+        """在后台为下一轮预先生成回复草稿（未开启预测或草稿仍然有效时不做任何事）"""
+        state = self.state
+        if not self.speculative or not state.bots_in_chat:
+            return
+        draft = state.speculative_draft
+        if draft is not None and draft.matches(state.messages, state.bots_in_chat):
+            return
+        self.discard_draft()
+        if self._straggling("draft"):
+            return # 之前被丢弃的草稿仍在生成
+        self.ensure_working_memory()
+        history = list(state.messages)
+        # 草稿不经过任务队列提交，出错时在使用时计入失败并回退到正常流程；
+        # 使用前台线程池，不会排在后台的记忆压缩等任务后面
+        future = llm_jobs.submit_foreground(
+            self._generate_draft,
+            history,
+            tuple(state.bots_in_chat),
+            state.last_speaker,
+            dict(state.bot_memories),
+            dict(state.memory_updates_count)
+        )
+        state.speculative_draft = speculation.Draft(future, history, state.bots_in_chat)
+
+    def discard_draft(self):
+        """丢弃与当前聊天历史不一致的草稿，计为未命中"""
+        state = self.state
+        draft = state.speculative_draft
+        if draft is None or draft.matches(state.messages, state.bots_in_chat):
+            return
+        state.speculative_draft = None
+        if not draft.future.cancel():
+            state.stragglers["draft"] = (draft.future, draft.history_len)
+        state.speculation_stats.record("misses")
+
+    def take_draft(self):
+        """
+        取出与当前聊天历史一致的草稿，必要时等待它生成完成（最多 DRAFT_WAIT_TIMEOUT 秒）。
+
+        返回:
+            (发言者, 回复)；没有可用草稿时返回 None
+        """
+        state = self.state
+        self.discard_draft()
+        draft = state.speculative_draft
+        if draft is None or not self.speculative:
+            # 关闭预测后不再使用之前的草稿
+            state.speculative_draft = None
+            return None
+        state.speculative_draft = None
+        try:
+            speaker, bot_response, errors = draft.future.result(timeout=DRAFT_WAIT_TIMEOUT)
+        except FuturesTimeoutError:
+            if not draft.future.cancel():
+                state.stragglers["draft"] = (draft.future, draft.history_len)
+            state.speculation_stats.record("timeouts")
+            return None
+        except Exception as e:
+            self._error(f"生成预测回复时出错：{e}")
+            state.speculation_stats.record("failed")
+            return None
+        for text in errors:
+            self._error(text)
+        if not bot_response:
+            state.speculation_stats.record("failed")
+            return None
+        state.speculation_stats.record("hits")
+        return speaker, bot_response
+
+    def commit_draft(self, timestamp=None):
+        """
+        有可用草稿时直接把它作为本轮发言提交。
+
+        返回:
+            提交的发言者；没有可用草稿时返回 None
+        """
+        draft = self.take_draft()
+        if draft is None:
+            return None
+        speaker, bot_response = draft
+        self.finish_turn(speaker, bot_response, timestamp)
+        return speaker
+
+    # --- 记忆 ---
+
+    def generate_memory_update(self, persona_name, chat_history, current_memory):
+        """
+        使用 LLM 生成机器人的记忆更新条目。
+        在后台线程中运行，不访问状态对象；没有重要更新时返回 None。
+        """
+        if not chat_history:
+            return None # 没有新信息
+
+        persona_details = self.personas.personas[persona_name]
+        budget = prompt_builder.PromptBudget(prompt_builder.MEMORY_UPDATE_TOKEN_BUDGET)
+        instruction = budget.reserve(
+            f"根据下面的当前记忆和最近对话片段，为 {persona_name} 提供一个简洁的更新记忆。"
+            f"关注 {persona_name} 应该记住的关键新事实、决定或表达/观察到的强烈感受。"
+            f"保持简短，像个人笔记。如果没有重要的内容可添加，可以说'没有重要更新'。"
+        )
+        header = budget.reserve(f"你是一个AI助手，帮助 {persona_name}（{persona_details['description']}）更新其记忆。\n")
+        current_memory = budget.take_text(current_memory, prompt_builder.CURRENT_MEMORY_SHARE, keep="tail")
+
+        # 提取与机器人相关的最近对话片段
+        relevant_history_snippet = prompt_builder.format_transcript(budget.take_history(chat_history, MAX_HISTORY_LEN))
+
+        # 固定的说明在前，当前记忆和对话片段在后，保持可缓存的前缀
+        prompt = (
+            header + instruction + "\n\n"
+            f"当前记忆：\n{current_memory}\n\n"
+            f"最近对话片段：\n{relevant_history_snippet}"
+        )
+        completion = self.client.chat.completions.create(
+            model=self.llm_model,
+            messages=[
+                {"role": "system", "content": "你是一个有帮助的记忆助手。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3,
+            max_tokens=500,
+            priority="memory"
+        )
+        update = completion.choices[0].message.content.strip()
+        if "没有重要更新" in update.lower() or "no significant updates" in update.lower():
+            return None
+
+        return f"- (更新于 {datetime.now().strftime('%H:%M')}) {update}"
+
+    def commit_memory_update(self, persona_name, new_memory_entry):
+        """
+        在提交线程中提交后台生成的记忆更新，并按需安排记忆压缩。
+        """
+        if not new_memory_entry:
+            return
+        state = self.state
+
+        # 将更新添加到详细记忆（永久存储）
+        if self.persist_memory:
+            dm.append_to_detailed_memory(persona_name, new_memory_entry)
+
+        # 更新会话工作记忆；基于提交时的最新记忆合并，保证同一角色的多次更新不互相覆盖
+        state.bot_memories[persona_name] = merge_memory_entry(state.bot_memories[persona_name], new_memory_entry)
+
+        state.memory_updates_count[persona_name] = state.memory_updates_count.get(persona_name, 0) + 1
+
+        # 定期将详细记忆压缩到压缩记忆中
+        if self.persist_memory and state.memory_updates_count[persona_name] % MEMORY_COMPRESSION_INTERVAL == 0:
+            # 最近的详细记忆，加上与之相关的较早记忆，一起用于压缩
+            recent_detailed_memory = dm.get_detailed_memory(persona_name, max_entries=MAX_BOT_MEMORY_LEN)
+            full_detailed_memory = dm.get_relevant_memory(
+                persona_name, recent_detailed_memory, RECALL_TOP_K, exclude_recent=MAX_BOT_MEMORY_LEN
+            ) + recent_detailed_memory
+            # 获取当前压缩记忆
+            current_compressed = cm.get_compressed_memory(persona_name)
+            # 在后台更新压缩记忆
+            state.background_jobs.submit(
+                f"compress:{persona_name}",
+                cm.update_compressed_memory, self.client, self.llm_model, persona_name, current_compressed, full_detailed_memory,
+                on_commit=lambda new_compressed: self.commit_compressed_memory(persona_name, new_compressed),
+                on_error=lambda e: self._error(f"更新 {persona_name} 的压缩记忆时出错：{e}")
+            )
+
+    def commit_compressed_memory(self, persona_name, new_compressed):
+        """压缩记忆更新后，在同一队列中按需压实该角色的详细记忆日志（以新的压缩记忆作为归档检查点）"""
+        self._info(f"{persona_name} 的长期记忆已更新！")
+        self.state.background_jobs.submit(
+            f"compress:{persona_name}",
+            dm.compact_persona_log, persona_name, summary=new_compressed,
+            on_error=lambda e: self._error(f"归档 {persona_name} 的详细记忆时出错：{e}")
+        )
+
+    def recall_relevant_memory(self, persona_name, chat_history=None, memory_updates_count=None):
+        """
+        以最近的对话为查询，检索角色工作记忆之外的相关往事
+        （后台线程中调用时传入聊天历史和记忆更新次数的快照）
+        """
+        chat_history = self.state.messages if chat_history is None else chat_history
+        memory_updates_count = self.state.memory_updates_count if memory_updates_count is None else memory_updates_count
+        query = "\n".join(msg["content"] for msg in chat_history[-RECALL_QUERY_MESSAGES:])
+        # 本会话写入的记忆已经在工作记忆中，只检索更早的条目
+        in_working_memory = min(memory_updates_count.get(persona_name, 0), MAX_BOT_MEMORY_LEN)
+        return dm.get_relevant_memory(persona_name, query, RECALL_TOP_K, exclude_recent=in_working_memory)
+
+    def ensure_working_memory(self, persona_names=None):
+        """为聊天中的角色创建初始工作记忆（只处理当前在聊天中的角色）"""
+        personas = self.personas.personas
+        for name in persona_names if persona_names is not None else self.state.bots_in_chat:
+            if name not in self.state.bot_memories and name in personas:
+                self.state.bot_memories[name] = f"初始记忆：我的名字是 {name}。{personas[name]['background']}"
+
+    def flush_memory_updates(self, force=False):
+        """
+        刷新到期的记忆缓冲：每个角色缓冲的消息合并为一次后台记忆更新，
+        结果在之后调用 commit_ready() 时按顺序提交。
+
+        参数:
+            force: 为 True 时不等待空闲，立即刷新所有缓冲
+        """
+        state = self.state
+        scheduler = state.memory_scheduler
+        for persona_name in scheduler.due(state.messages, now=float("inf") if force else None):
+            buffered_messages = scheduler.take(persona_name, state.messages)
+            state.background_jobs.submit(
+                f"memory:{persona_name}",
+                self.generate_memory_update,
+                persona_name,
+                buffered_messages, # 切片即快照，后台线程看不到之后追加的消息
+                state.bot_memories[persona_name],
+                on_commit=lambda entry, persona_name=persona_name: self.commit_memory_update(persona_name, entry),
+                on_error=lambda e, persona_name=persona_name: self._error(f"更新 {persona_name} 的记忆时出错：{e}")
+            )
+
+    def commit_ready(self):
+        """提交已完成的后台任务，并刷新空闲会话的记忆缓冲"""
+        committed = self.state.background_jobs.commit_ready()
+        self.flush_memory_updates()
+        return committed
+
+    def drain(self, timeout=None):
+        """等待并提交全部后台任务（包括提交回调中新安排的任务），用于离线运行结束时"""
+        jobs = self.state.background_jobs
+        while True:
+            # 结束时不再等待空闲，立即刷新所有缓冲
+            self.flush_memory_updates(force=True)
+            if not jobs.pending():
+                break
+            jobs.wait(timeout)
+            if not jobs.commit_ready() and timeout is not None:
+                break
+
+    # --- 总结 ---
+
+    def get_conversation_summary(self, chat_history_to_summarize):
+        """
+        总结一段对话。
+        在后台线程中运行，出错时抛出异常，由任务的错误回调处理。
+        """
+        if not chat_history_to_summarize:
+            return "没有对话可总结。"
+
+        budget = prompt_builder.PromptBudget(prompt_builder.SUMMARY_TOKEN_BUDGET)
+        instruction = budget.reserve("总结以下聊天对话。突出关键话题、决定、任何冲突或协议，以及讨论的整体进展。要简明扼要。\n\n")
+        prompt = (
+            instruction +
+            "对话：\n" + prompt_builder.format_transcript(budget.take_history(chat_history_to_summarize))
+        )
+        completion = self.client.chat.completions.create(
+            model=self.llm_model,
+            messages=[
+                {"role": "system", "content": "你是一位总结专家。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.2,
+            max_tokens=500,
+            use_cache=True,
+            priority="summary"
+        )
+        summary = completion.choices[0].message.content.strip()
+        return summary
+
+    def commit_summary(self, summary_text, rounds, start, end):
+        """提交后台生成的对话总结，并作为叶子节点加入总结树"""
+        state = self.state
+        state.summaries.append(summary_text)
+        state.pending_summaries -= 1
+        state.summary_tree.add_leaf(summary_text, start, end)
+        self.schedule_summary_merges()
+        self._info(f"已为第 {rounds} 轮生成对话总结！")
+
+    def fail_summary(self, error, start, end):
+        """
+        后台总结失败时保留占位总结，保证总结编号与轮次对应；
+        总结树中用原始对话代替，保证报告覆盖全部消息。
+        """
+        state = self.state
+        self._error(f"生成总结时出错：{error}")
+        state.summaries.append("由于错误，无法生成总结。")
+        state.pending_summaries -= 1
+        raw_text = prompt_builder.format_transcript(state.messages[start:end])
+        state.summary_tree.add_leaf(raw_text, start, end)
+        self.schedule_summary_merges()
+
+    def schedule_summary_merges(self):
+        """在后台把总结树中积累满 MERGE_FANOUT 个节点的层合并到上一层"""
+        tree = self.state.summary_tree
+        while (merge := tree.next_merge()) is not None:
+            level, nodes = merge
+            self.state.background_jobs.submit(
+                f"summary_merge:{level}",
+                summary_tree.merge_summaries, self.client, self.llm_model, nodes,
+                on_commit=lambda text, level=level, nodes=nodes: (tree.apply_merge(level, nodes, text), self.schedule_summary_merges()),
+                on_error=lambda e, level=level: (tree.cancel_merge(level), print(f"合并总结时出错: {e}"))
+            )
+
+    def maybe_schedule_summary(self):
+        """
+        每 SUMMARY_INTERVAL 轮在后台生成一次对话总结。
+        正在生成中的总结也计入已有总结数，避免重复安排。
+        """
+        state = self.state
+        rounds = state.conversation_rounds
+        scheduled = len(state.summaries) + state.pending_summaries
+        if rounds > 0 and rounds % SUMMARY_INTERVAL == 0 and scheduled * SUMMARY_INTERVAL < rounds:
+            # 从上一次总结结束的位置开始，保证各段总结连续覆盖全部消息
+            start_index_for_summary = state.summarized_upto
+            end_index_for_summary = len(state.messages)
+            if end_index_for_summary <= start_index_for_summary:
+                return
+            actual_messages_for_summary = state.messages[start_index_for_summary : end_index_for_summary]
+            state.summarized_upto = end_index_for_summary
+            state.pending_summaries += 1
+            state.background_jobs.submit(
+                "summary",
+                self.get_conversation_summary, actual_messages_for_summary,
+                on_commit=lambda summary_text: self.commit_summary(summary_text, rounds, start_index_for_summary, end_index_for_summary),
+                on_error=lambda e: self.fail_summary(e, start_index_for_summary, end_index_for_summary)
+            )
+
+    # --- 发言者选择 ---
+
+    def determine_next_speaker(self):
+        """
+        使用LLM作为隐藏导演，根据聊天历史分析，决定下一个发言的机器人。
+        """
+        state = self.state
+        return self.choose_speaker(state.messages, state.bots_in_chat, state.last_speaker, state.speaker_selection_stats)
+
+    def choose_speaker(self, history, available_bots, last_speaker, stats, on_error=None, priority="director"):
+        """
+        determine_next_speaker 的实现，不读写状态对象，可在后台线程中调用。
+
+        参数:
+            stats: 记录选择来源的 speaker_selector.SelectionStats
+            on_error: 导演调用出错时的回调，默认发出 "error" 事件
+            priority: 导演调用的限速优先级（见 rate_limiter.PRIORITIES）
+        """
+        on_error = on_error or self._error
+        if not available_bots:
+            return None
+
+        # 避免同一发言者连续发言的基本规则
+        eligible_bots = [b for b in available_bots if b != last_speaker]
+        if not eligible_bots:
+            eligible_bots = available_bots
+
+        # 基本情况：如果历史太短，直接随机选择
+        if len(history) < 2:
+            return random.choice(eligible_bots)
+
+        # 获取最近的消息上下文（受MAX_HISTORY_LEN限制）
+        recent_messages = history[-min(MAX_HISTORY_LEN, len(history)):]
+
+        # 快速检查：如果明确提及某个机器人，让它来回答
+        last_message = recent_messages[-1]
+        last_content = last_message["content"].lower()
+        for bot_name in available_bots:
+            if bot_name.lower() in last_content and "?" in last_content:
+                stats.record("heuristic")
+                return bot_name
+
+        # 给一定概率随机回复，保持对话活跃性
+        if random.random() < 0.15:  # 15%的概率随机选择
+            stats.record("random")
+            return random.choice(eligible_bots)
+
+        # 本地启发式评分（点名、发言频率、话题重合度），置信度足够时不调用LLM导演
+        heuristic_choice, confidence = speaker_selector.choose_speaker(
+            recent_messages, eligible_bots, self.personas.personas
+        )
+        if heuristic_choice and confidence >= speaker_selector.MIN_CONFIDENCE:
+            stats.record("heuristic")
+            return heuristic_choice
+
+        stats.record("director")
+
+        # 使用LLM来决定谁是最合适的下一个发言者
+        try:
+            # 准备可用角色的简短描述，帮助LLM做决定
+            bot_info = "\n".join(
+                f"- {bot_name}: {self.personas.short_description(bot_name)}"
+                for bot_name in eligible_bots if bot_name in self.personas.personas
+            )
+
+            # 固定的指令在前，成员列表其次，每轮变化的对话历史和上一个发言者在最后
+            prompt_head = (
+                f"你是一个聊天室的隐形导演。基于最近的对话历史，请决定谁应该是下一个发言者。\n\n"
+                f"请仔细分析对话内容，考虑以下因素：\n"
+                f"1. 谁是对话中被提及或被询问的对象\n"
+                f"2. 谁最适合对最近的话题进行回应（基于角色背景）\n"
+                f"3. 谁可以提供有价值的新观点\n"
+                f"4. 谁在最近几轮对话中发言较少\n\n"
+                f"当前聊天室成员：\n{bot_info}\n\n"
+                f"从以下列表中选择一个名字作为下一个发言者（只返回名字，不要任何解释）：{', '.join(eligible_bots)}\n\n"
+                f"最近的对话历史：\n"
+            )
+            prompt_tail = f"\n\n上一个发言者是：{last_speaker}"
+            # 角色描述和指令之外的预算留给最近的对话历史
+            budget = prompt_builder.PromptBudget(prompt_builder.DIRECTOR_TOKEN_BUDGET)
+            budget.reserve(prompt_head)
+            budget.reserve(prompt_tail)
+            recent_history_text = prompt_builder.format_transcript(budget.take_history(recent_messages))
+            prompt = prompt_head + recent_history_text + prompt_tail
+
+            # 调用LLM获取推荐的下一个发言者
+            completion = self.client.chat.completions.create(
+                model=self.llm_model,
+                messages=[
+                    {"role": "system", "content": "你是一位对话管理专家，帮助决定谁应该是对话中的下一个发言者。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.3,
+                max_tokens=50,
+                priority=priority
+            )
+
+            next_speaker_suggestion = completion.choices[0].message.content.strip()
+
+            # 清理响应，确保我们得到的是一个有效的发言者名称
+            for bot_name in eligible_bots:
+                if bot_name.lower() in next_speaker_suggestion.lower():
+                    return bot_name
+
+            # 如果LLM没有返回有效的机器人名称，使用启发式评分最高者
+            return heuristic_choice or random.choice(eligible_bots)
+
+        except Exception as e:
+            on_error(f"使用LLM决定下一个发言者时出错：{e}")
+            # 出错时回退到启发式评分最高者
+            return heuristic_choice or random.choice(eligible_bots)
+
+    # --- 报告 ---
+
+    def generate_conversation_report(self):
+        """
+        生成整个对话历史的综合报告。
+        较早的对话使用总结树中的分层总结，只有尚未被总结的最新消息以原文发送，
+        报告请求的长度不随对话变长而增长。
+        """
+        chat_history = self.state.messages
+        tree = self.state.summary_tree
+        if not chat_history:
+            return "没有对话可生成报告。"
+
+        budget = prompt_builder.PromptBudget(prompt_builder.REPORT_TOKEN_BUDGET)
+        earlier_summaries = "\n\n".join(
+            f"【第 {node['start'] + 1}-{node['end']} 条消息的总结】\n{node['text']}" for node in tree.frontier()
+        )
+        budget.reserve(earlier_summaries)
+        # 未被总结的最新消息；预算不足时保留最近的部分
+        unsummarized = budget.take_history(chat_history[tree.covered_upto:])
+        recent_text = "\n".join([f"{msg['role']}: {msg['content']} ({msg['timestamp'].strftime('%H:%M:%S')})" for msg in unsummarized])
+
+        prompt = (
+            "你是一个专业的报告生成助手。请根据以下聊天对话的分层总结和最新的原始对话，生成一份简洁的报告。\n"
+            "报告应包括以下内容：\n"
+            "1. 对话的主要话题和主题\n"
+            "2. 关键讨论点、决定或结论\n"
+            "3. 参与者的主要观点或角色动态（例如谁主导了讨论，谁提出了关键问题等）\n"
+            "4. 任何明显的冲突或共识\n"
+            "5. 对话的整体进展和结果\n\n"
+            "请以清晰、结构化的格式生成报告，字数控制在300字以内，适合快速阅读。\n\n"
+            "较早对话的总结（按时间顺序）：\n" + (earlier_summaries or "无") + "\n\n"
+            "最新的对话（尚未总结）：\n" + (recent_text or "无")
+        )
+        try:
+            completion = self.client.chat.completions.create(
+                model=self.llm_model,
+                messages=[
+                    {"role": "system", "content": "你是一位专业的总结和报告生成专家。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.2,
+                max_tokens=2000,
+                use_cache=True # 对话没有变化时直接返回上次的报告
+            )
+            report = completion.choices[0].message.content.strip()
+            return report
+        except Exception as e:
+            self._error(f"生成报告时出错：{e}")
+            return "由于错误，无法生成报告。"
+
+    # --- 离线运行 ---
+
+    def run(self, turns, batch=False):
+        """
+        离线运行：开场问候后进行 turns 轮机器人发言，结束时等待并提交全部后台任务。
+        batch 为 True 时优先使用批量生成。
+
+        返回:
+            实际生成的发言轮数（不含开场问候）
+        """
+        self.ensure_working_memory()
+        self.open_conversation()
+        completed = 0
+        while completed < turns:
+            self.commit_ready()
+            generated = self.batch_turns(turns - completed) if batch else 0
+            if not generated:
+                # 批量生成失败时回退到逐轮生成
+                if not self.bot_turn():
+                    break
+                generated = 1
+                self.maybe_schedule_summary()
+            completed += generated
+        self.drain()
+        return completed
+
+    def stats(self):
+        """返回本聊天室的运行统计"""
+        state = self.state
+        return {
+            "messages": len(state.messages),
+            "summaries": len(state.summaries),
+            "memory_updates": sum(state.memory_updates_count.values()),
+            "speaker_selection": state.speaker_selection_stats.summary(),
+            "memory_scheduler": state.memory_scheduler.stats(),
+            "background_jobs": state.background_jobs.stats(),
+            "speculation": state.speculation_stats.summary(),
+            "candidates": state.candidate_stats.summary(),
+        }
@@ -0,0 +1,49 @@
+"""
+聊天记录视图：页面渲染用的消息列表
+消息在追加到聊天历史时格式化一次（发言者、头像、时间标题），之后的重新运行不再重复格式化；
+页面只渲染最近 LIVE_WINDOW 条消息，更早的消息按页查看，每次运行的渲染量不随聊天变长而增长。
+"""
+
+LIVE_WINDOW = 30 # 页面上直接显示的最近消息数
+HISTORY_PAGE_SIZE = 50 # 较早消息每页显示的条数
+
+
+class ChatView:
+    """已格式化的消息列表，与聊天历史一一对应"""
+
+    def __init__(self):
+        self.entries = [] # {"role", "avatar", "header", "content"}
+
+    def append(self, speaker, content, timestamp, avatar):
+        """格式化并追加一条消息"""
+        self.entries.append({
+            "role": speaker,
+            "avatar": avatar,
+            "header": f"**{speaker}** ({timestamp.strftime('%H:%M:%S')}):",
+            "content": content,
+        })
+
+    def sync(self, messages, avatar_for):
+        """补齐视图中缺少的消息（例如视图创建之前已有的聊天历史）；只格式化新增的部分"""
+        if len(self.entries) > len(messages):
+            del self.entries[len(messages):]
+        for msg in messages[len(self.entries):]:
+            self.append(msg["role"], msg["content"], msg["timestamp"], avatar_for(msg["role"]))
+
+    def live(self, window=LIVE_WINDOW):
+        """最近的 window 条消息"""
+        return self.entries[-window:] if window else []
+
+    def older_count(self, window=LIVE_WINDOW):
+        """不在实时窗口中的较早消息数"""
+        return max(0, len(self.entries) - window)
+
+    def page_count(self, window=LIVE_WINDOW, page_size=HISTORY_PAGE_SIZE):
+        """较早消息的页数"""
+        return -(-self.older_count(window) // page_size)
+
+    def page(self, page, window=LIVE_WINDOW, page_size=HISTORY_PAGE_SIZE):
+        """较早消息的第 page 页（从1开始，按时间顺序）"""
+        older = self.older_count(window)
+        start = (page - 1) * page_size
+        return self.entries[start:min(start + page_size, older)]
@@ -0,0 +1,26 @@
+"""
+客户端包装基类：在 OpenAI 兼容客户端的 chat.completions.create 前后加入处理
+限速（rate_limiter）、前缀统计（prefix_stats）和响应缓存（llm_cache）都基于它，可以层层嵌套；
+子类只需实现 create，其余属性原样转发给被包装的客户端。
+"""
+
+from types import SimpleNamespace
+
+
+class ClientWrapper:
+    """包装 OpenAI 兼容客户端：client.chat.completions.create 调用 self.create"""
+
+    def __init__(self, client):
+        self.client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model=None, messages=None, **params):
+        """默认直接转发；子类覆盖以加入自己的处理"""
+        return self.forward(model=model, messages=messages, **params)
+
+    def forward(self, model=None, messages=None, **params):
+        """把请求交给被包装的客户端"""
+        return self.client.chat.completions.create(model=model, messages=messages, **params)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -1,60 +1,125 @@
 """
 压缩记忆模块：存储和管理角色的压缩记忆
 每个角色的压缩记忆是其经验的概括总结，定期从详细记忆中更新
+
+存储格式：每个角色一个分片文件 bot_memories/compressed/<角色>.json，
+内容为 {"persona": 角色名, "content": 压缩记忆, "updated": 时间}，并登记在 memory_manifest 的清单中。
+读取某个角色只打开它自己的分片；写入时只对该分片加锁并原子替换，
+多个会话同时更新不同角色时互不阻塞、不会互相覆盖。
+旧版的单文件 compressed_memories.json 会在第一次使用时自动拆分。
 """
 
 import os
 import json
+import threading
 from datetime import datetime
+import memory_cache
+import memory_manifest
+import file_store
 
 # 确保记忆目录存在
 MEMORY_DIR = "bot_memories"
-COMPRESSED_MEMORY_FILE = os.path.join(MEMORY_DIR, "compressed_memories.json")
+COMPRESSED_MEMORY_FILE = os.path.join(MEMORY_DIR, "compressed_memories.json") # 旧版单文件格式，仅用于迁移
+COMPRESSED_DIR, SHARD_SUFFIX = memory_manifest.SHARD_DIRS["compressed"]
+
+_legacy_migrated = False
+_migration_lock = threading.Lock()
 
 def ensure_memory_dir():
     """确保记忆目录存在"""
-    os.makedirs(MEMORY_DIR, exist_ok=True)
+    os.makedirs(COMPRESSED_DIR, exist_ok=True)
+    memory_manifest.ensure_manifest()
+    migrate_legacy_compressed_memories()
 
-def load_compressed_memories():
-    """加载所有角色的压缩记忆"""
-    ensure_memory_dir()
-    if os.path.exists(COMPRESSED_MEMORY_FILE):
+def _shard_path(persona_name):
+    """返回角色压缩记忆分片的文件路径"""
+    return os.path.join(COMPRESSED_DIR, file_store.persona_filename(persona_name, SHARD_SUFFIX))
+
+def _read_shard(path):
+    """从磁盘解析一个压缩记忆分片，返回压缩记忆文本"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get("content", "")
+
+def migrate_legacy_compressed_memories():
+    """
+    一次性迁移：将旧版 compressed_memories.json 拆分为每个角色的分片。
+    迁移成功后旧文件被重命名为 compressed_memories.migrated.json 作为备份。
+    多个进程同时启动时由旧文件的文件锁保证只有一个进程迁移。
+    """
+    global _legacy_migrated
+    with _migration_lock:
+        if _legacy_migrated:
+            return
+        _legacy_migrated = True
+        if not os.path.exists(COMPRESSED_MEMORY_FILE):
+            return
         try:
-            with open(COMPRESSED_MEMORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with file_store.locked(COMPRESSED_MEMORY_FILE):
+                # 等待锁期间其他进程可能已完成迁移
+                if not os.path.exists(COMPRESSED_MEMORY_FILE):
+                    return
+                with open(COMPRESSED_MEMORY_FILE, 'r', encoding='utf-8') as f:
+                    legacy_memories = json.load(f)
+                for persona_name, text in legacy_memories.items():
+                    _write_shard(persona_name, text)
+                os.replace(COMPRESSED_MEMORY_FILE, os.path.join(MEMORY_DIR, "compressed_memories.migrated.json"))
+            print(f"已将 {len(legacy_memories)} 个角色的压缩记忆迁移到 {COMPRESSED_DIR}")
         except Exception as e:
-            print(f"加载压缩记忆时出错: {e}")
-            return {}
-    return {}
+            print(f"迁移旧版压缩记忆时出错: {e}")
+
+def _write_shard(persona_name, text):
+    """加锁并原子写入一个角色的分片，刷新缓存并登记到清单"""
+    path = _shard_path(persona_name)
+    shard = {"persona": persona_name, "content": text, "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    with file_store.locked(path):
+        file_store.atomic_write_text(path, json.dumps(shard, ensure_ascii=False, indent=2))
+        memory_cache.get_cache().put(path, text)
+    memory_manifest.register_shard(persona_name, "compressed", path)
+
+def load_compressed_memories(persona_names=None):
+    """
+    加载角色的压缩记忆（分片未变化时直接使用进程内缓存）
+
+    参数:
+        persona_names: 只加载这些角色；为None时按清单加载全部角色
+    """
+    ensure_memory_dir()
+    if persona_names is None:
+        persona_names = memory_manifest.personas_with("compressed")
+    compressed_memories = {}
+    for persona_name in persona_names:
+        text = get_compressed_memory(persona_name)
+        if text:
+            compressed_memories[persona_name] = text
+    return compressed_memories
 
 def save_compressed_memories(compressed_memories):
-    """保存所有角色的压缩记忆"""
+    """保存多个角色的压缩记忆（每个角色写入自己的分片）"""
+    for persona_name, text in compressed_memories.items():
+        set_compressed_memory(persona_name, text)
+
+def set_compressed_memory(persona_name, text):
+    """更新一个角色的压缩记忆，只改写该角色的分片"""
     ensure_memory_dir()
     try:
-        with open(COMPRESSED_MEMORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(compressed_memories, f, ensure_ascii=False, indent=2)
+        _write_shard(persona_name, text)
     except Exception as e:
-        print(f"保存压缩记忆时出错: {e}")
+        memory_cache.get_cache().invalidate(_shard_path(persona_name))
+        print(f"保存 {persona_name} 的压缩记忆时出错: {e}")
 
 def update_compressed_memory(client, llm_model, persona_name, old_memory, new_memory):
     """
     使用LLM更新角色的压缩记忆
     将旧的压缩记忆与新的详细记忆合并成新的压缩版本
     """
-    compressed_memories = load_compressed_memories()
-    
-    # 如果角色还没有压缩记忆，初始化为空
-    if persona_name not in compressed_memories:
-        compressed_memories[persona_name] = ""
-    
     # 获取当前压缩记忆
-    current_compressed = compressed_memories[persona_name]
+    current_compressed = get_compressed_memory(persona_name)
     
     # 如果没有现有的压缩记忆，创建初始版本
     if not current_compressed:
-        compressed_memories[persona_name] = f"初始压缩记忆 ({datetime.now().strftime('%Y-%m-%d')}): {new_memory[:500]}..."
-        save_compressed_memories(compressed_memories)
-        return compressed_memories[persona_name]
+        initial_compressed = f"初始压缩记忆 ({datetime.now().strftime('%Y-%m-%d')}): {new_memory[:500]}..."
+        set_compressed_memory(persona_name, initial_compressed)
+        return initial_compressed
     
     # 使用LLM合并旧的压缩记忆和新的详细记忆
     try:
@@ -78,12 +143,12 @@ def update_compressed_memory(client, llm_model, persona_name, old_memory, new_me
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=1000
+            max_tokens=1000,
+            priority="compression"
         )
         
         new_compressed = completion.choices[0].message.content.strip()
-        compressed_memories[persona_name] = new_compressed
-        save_compressed_memories(compressed_memories)
+        set_compressed_memory(persona_name, new_compressed)
         return new_compressed
         
     except Exception as e:
@@ -91,6 +156,13 @@ def update_compressed_memory(client, llm_model, persona_name, old_memory, new_me
         return current_compressed
 
 def get_compressed_memory(persona_name):
-    """获取特定角色的压缩记忆"""
-    compressed_memories = load_compressed_memories()
-    return compressed_memories.get(persona_name, "")
+    """获取特定角色的压缩记忆（只读取该角色的分片）"""
+    ensure_memory_dir()
+    path = _shard_path(persona_name)
+    if not os.path.exists(path):
+        return ""
+    try:
+        return memory_cache.get_cache().get(path, _read_shard)
+    except Exception as e:
+        print(f"读取 {persona_name} 的压缩记忆时出错: {e}")
+        return ""
@@ -1,86 +1,379 @@
 """
 详细记忆模块：存储和管理角色的完整记忆历史
-保存所有原始bot_memory内容，不进行任何压缩或删减
+保存所有原始bot_memory内容；超过保留期限（COMPACTION_HORIZON_DAYS）的条目被压实到
+memory_archive 的 gzip 归档段中，仍可通过 get_detailed_memory(get_all=True) 按时间顺序读取
+
+存储格式：每个角色一个只追加（append-only）的 JSONL 日志文件，
+每行一条 {"timestamp": ..., "content": ...} 记录。
+追加新记忆只需写入一行，读取最近记忆时从文件末尾反向读取，
+不再需要解析和重写全部角色的历史。
+每个角色的日志登记在 memory_manifest 的清单中，只在用到某个角色时才读取它的日志。
 """
 
 import os
 import json
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+import memory_cache
+import memory_index
+import memory_manifest
+import memory_archive
+import file_store
 
 # 确保记忆目录存在
 MEMORY_DIR = "bot_memories"
-DETAILED_MEMORY_FILE = os.path.join(MEMORY_DIR, "detailed_memories.json")
+DETAILED_MEMORY_FILE = os.path.join(MEMORY_DIR, "detailed_memories.json") # 旧版单文件格式，仅用于迁移
+DETAILED_LOG_DIR, LOG_SUFFIX = memory_manifest.SHARD_DIRS["detailed"] # 每个角色一个 JSONL 日志
+TAIL_READ_BLOCK_SIZE = 8192 # 反向读取日志尾部时每次读取的字节数
+COMPACTION_HORIZON_DAYS = 7 # 日志中保留的期限（天），更早的条目进入归档
+MIN_ARCHIVE_ENTRIES = 100 # 超过期限的条目达到此数时才压实，避免产生大量很小的归档段
+KEEP_RECENT_ENTRIES = 20 # 无论多早，日志中至少保留的最近条目数（读取最近记忆时只读日志尾部）
+
+_offset_cache = memory_cache.FileCache() # 日志路径 -> 每条记录的起始字节偏移（与条目缓存分开）
+
+_legacy_migrated = False
+_migration_lock = threading.Lock() # 多个会话同时启动时只迁移一次
 
 def ensure_memory_dir():
     """确保记忆目录存在"""
-    os.makedirs(MEMORY_DIR, exist_ok=True)
+    os.makedirs(DETAILED_LOG_DIR, exist_ok=True)
+    memory_manifest.ensure_manifest()
+    migrate_legacy_detailed_memories()
+
+def _persona_log_path(persona_name):
+    """返回角色详细记忆日志的文件路径"""
+    return os.path.join(DETAILED_LOG_DIR, file_store.persona_filename(persona_name, LOG_SUFFIX))
+
+def _write_persona_log(persona_name, entries):
+    """整体写入某个角色的日志（仅用于迁移和批量保存；加锁并原子替换）"""
+    path = _persona_log_path(persona_name)
+    with file_store.locked(path):
+        file_store.atomic_write_text(path, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+    memory_manifest.register_shard(persona_name, "detailed", path)
+    memory_cache.get_cache().invalidate(path)
+    _offset_cache.invalidate(path)
+    memory_index.get_index().invalidate(persona_name)
+
+def _parse_log_lines(lines, persona_name):
+    """解析 JSONL 行，跳过损坏的行（例如进程中断导致的半行）"""
+    entries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError as e:
+            print(f"跳过 {persona_name} 的损坏详细记忆条目: {e}")
+    return entries
+
+def _read_persona_log(path, persona_name):
+    """完整解析某个角色的日志文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return _parse_log_lines(f, persona_name)
+
+def _scan_line_offsets(path):
+    """扫描日志，返回每个非空行的起始字节偏移"""
+    offsets = []
+    position = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                offsets.append(position)
+            position += len(line)
+    return offsets
+
+def _read_log_from(path, offset, persona_name):
+    """从字节偏移 offset 开始逐条读取日志"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            yield from _parse_log_lines([line.decode('utf-8')], persona_name)
+
+def _read_tail_lines(path, max_lines):
+    """从文件末尾反向读取最多 max_lines 行，读取量与文件总大小无关"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        # 多读一个换行符，以便丢弃块开头可能不完整的那一行
+        while pos > 0 and data.count(b"\n") <= max_lines:
+            read_size = min(TAIL_READ_BLOCK_SIZE, pos)
+            pos -= read_size
+            f.seek(pos)
+            data = f.read(read_size) + data
+    lines = data.split(b"\n")
+    if pos > 0:
+        lines = lines[1:]
+    lines = [line for line in lines if line.strip()]
+    return [line.decode('utf-8') for line in lines[-max_lines:]]
+
+def migrate_legacy_detailed_memories():
+    """
+    一次性迁移：将旧版 detailed_memories.json 拆分为每个角色的 JSONL 日志。
+    迁移成功后旧文件被重命名为 detailed_memories.migrated.json 作为备份。
+    进程内用 _migration_lock 只检查一次；多个进程同时启动时由旧文件的文件锁保证只有一个进程迁移。
+    """
+    global _legacy_migrated
+    with _migration_lock:
+        if _legacy_migrated:
+            return
+        _legacy_migrated = True
+        if not os.path.exists(DETAILED_MEMORY_FILE):
+            return
+        with file_store.locked(DETAILED_MEMORY_FILE):
+            # 等待锁期间其他进程可能已完成迁移
+            if os.path.exists(DETAILED_MEMORY_FILE):
+                _migrate_legacy_file()
+
+def _migrate_legacy_file():
+    """读取旧版文件并写成每个角色的日志"""
+    try:
+        with open(DETAILED_MEMORY_FILE, 'r', encoding='utf-8') as f:
+            legacy_memories = json.load(f)
+        for persona_name, entries in legacy_memories.items():
+            _write_persona_log(persona_name, entries)
+        os.replace(DETAILED_MEMORY_FILE, os.path.join(MEMORY_DIR, "detailed_memories.migrated.json"))
+        print(f"已将 {len(legacy_memories)} 个角色的详细记忆迁移到 {DETAILED_LOG_DIR}")
+    except Exception as e:
+        print(f"迁移旧版详细记忆时出错: {e}")
 
 def load_detailed_memories():
-    """加载所有角色的详细记忆"""
+    """加载所有角色的详细记忆（按清单列出角色）"""
     ensure_memory_dir()
-    if os.path.exists(DETAILED_MEMORY_FILE):
-        try:
-            with open(DETAILED_MEMORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"加载详细记忆时出错: {e}")
-            return {}
-    return {}
+    detailed_memories = {}
+    try:
+        for persona_name in memory_manifest.personas_with("detailed"):
+            detailed_memories[persona_name] = load_persona_entries(persona_name)
+    except Exception as e:
+        print(f"加载详细记忆时出错: {e}")
+    return detailed_memories
 
 def save_detailed_memories(detailed_memories):
-    """保存所有角色的详细记忆"""
+    """保存所有角色的详细记忆（整体覆盖每个角色的日志）"""
     ensure_memory_dir()
     try:
-        with open(DETAILED_MEMORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(detailed_memories, f, ensure_ascii=False, indent=2)
+        for persona_name, entries in detailed_memories.items():
+            _write_persona_log(persona_name, entries)
     except Exception as e:
         print(f"保存详细记忆时出错: {e}")
 
 def append_to_detailed_memory(persona_name, memory_entry):
-    """向角色的详细记忆添加新条目"""
-    detailed_memories = load_detailed_memories()
-    
-    # 如果角色还没有详细记忆，初始化为空列表
-    if persona_name not in detailed_memories:
-        detailed_memories[persona_name] = []
-    
+    """向角色的详细记忆添加新条目（加锁只追加一行，与历史长度无关；不同角色的写入互不阻塞）"""
+    ensure_memory_dir()
+
     # 添加带时间戳的新记忆
     memory_with_timestamp = {
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "content": memory_entry
     }
-    
-    detailed_memories[persona_name].append(memory_with_timestamp)
-    save_detailed_memories(detailed_memories)
+
+    path = _persona_log_path(persona_name)
+    try:
+        memory_index.get_index().append(
+            persona_name, memory_with_timestamp,
+            lambda: file_store.append_text(path, json.dumps(memory_with_timestamp, ensure_ascii=False) + "\n")
+        )
+        memory_manifest.register_shard(persona_name, "detailed", path)
+    except Exception as e:
+        print(f"追加 {persona_name} 的详细记忆时出错: {e}")
+    finally:
+        memory_cache.get_cache().invalidate(path)
+
+def load_persona_entries(persona_name, max_entries=None):
+    """
+    读取单个角色的详细记忆条目列表
+
+    参数:
+        persona_name: 角色名称
+        max_entries: 只读取最近的若干条；为None时读取全部
+    """
+    ensure_memory_dir()
+    path = _persona_log_path(persona_name)
+    if not os.path.exists(path):
+        return []
+    if max_entries is not None and max_entries <= 0:
+        return []
+    cache = memory_cache.get_cache()
+    try:
+        if max_entries is None:
+            return list(cache.get(path, lambda p: _read_persona_log(p, persona_name)))
+        # 已缓存完整日志时直接切片，否则只从文件尾部读取
+        cached_entries = cache.peek(path)
+        if cached_entries is not None:
+            return cached_entries[-max_entries:]
+        return _parse_log_lines(_read_tail_lines(path, max_entries), persona_name)
+    except Exception as e:
+        print(f"读取 {persona_name} 的详细记忆时出错: {e}")
+        return []
 
 def get_detailed_memory(persona_name, max_entries=20, get_all=False):
     """
     获取特定角色的详细记忆
-    
+
     参数:
         persona_name: 角色名称
         max_entries: 默认情况下返回的最大记忆条目数
         get_all: 若为True，则返回所有记忆条目，忽略max_entries参数
-    
+
     返回:
         格式化的记忆字符串
     """
-    detailed_memories = load_detailed_memories()
-    memory_entries = detailed_memories.get(persona_name, [])
-    
-    if not memory_entries:
-        return "尚无详细记忆记录。"
-    
-    # 决定使用哪些记忆条目
     if get_all:
-        entries_to_use = memory_entries  # 使用所有记忆条目
-    else:
-        # 只取最近的max_entries条记忆
-        entries_to_use = memory_entries[-max_entries:] if len(memory_entries) > max_entries else memory_entries
-    
-    # 格式化输出选定的记忆条目
-    formatted_memory = ""
-    for entry in entries_to_use:
-        formatted_memory += f"[{entry['timestamp']}]\n{entry['content']}\n\n"
-    
-    return formatted_memory
+        # 归档段逐段流式解压，再接上当前日志
+        checkpoint = memory_archive.load_archive_index(persona_name)["checkpoint"]
+        text = format_entries(iter_entries(persona_name))
+        if checkpoint["dropped_entries"]:
+            text = f"（更早的 {checkpoint['dropped_entries']} 条记忆已超出保留期限，其总结：{checkpoint['summary']}）\n\n" + text
+        return text or "尚无详细记忆记录。"
+
+    # 默认只从日志尾部读取最近的max_entries条
+    entries_to_use = load_persona_entries(persona_name, max_entries)
+
+    if not entries_to_use:
+        return "尚无详细记忆记录。"
+
+    return format_entries(entries_to_use)
+
+def _history_parts(persona_name):
+    """
+    按时间顺序返回角色历史的各个部分（各归档段和当前日志）：
+    [(条目数, 最早时间, 最晚时间, read(skip) 逐条读取的生成器函数)]
+    条目数和时间范围来自归档索引和日志的行偏移索引，不需要读取条目内容。
+    """
+    parts = []
+    for segment in memory_archive.load_archive_index(persona_name)["segments"]:
+        parts.append((
+            segment["entries"], segment["first_timestamp"], segment["last_timestamp"],
+            lambda skip, segment=segment: memory_archive.iter_segment(persona_name, segment, skip)
+        ))
+    path = _persona_log_path(persona_name)
+    if os.path.exists(path):
+        offsets = _offset_cache.get(path, _scan_line_offsets)
+        if offsets:
+            first = next(_read_log_from(path, offsets[0], persona_name), {}).get("timestamp")
+            last = next(_read_log_from(path, offsets[-1], persona_name), {}).get("timestamp")
+            parts.append((
+                len(offsets), first, last,
+                lambda skip: _read_log_from(path, offsets[skip], persona_name) if skip < len(offsets) else iter(())
+            ))
+    return parts
+
+def iter_entries(persona_name, offset=0, limit=None, since=None, until=None):
+    """
+    按时间顺序逐条产出角色的全部详细记忆（归档加当前日志），不会一次性载入全部历史
+
+    参数:
+        persona_name: 角色名称
+        offset: 跳过（时间过滤后的）前若干条
+        limit: 最多产出的条数；为None时不限制
+        since / until: 只产出时间戳在此范围内（含两端）的条目，格式为 "%Y-%m-%d %H:%M:%S"
+
+    没有时间过滤时按各部分的条目数直接跳过整段，并从日志的字节偏移处开始读取。
+    """
+    ensure_memory_dir()
+    if limit is not None and limit <= 0:
+        return
+    filtered = since is not None or until is not None
+    for count, first, last, read in _history_parts(persona_name):
+        if filtered and ((since and last and last < since) or (until and first and first > until)):
+            continue
+        skip = 0
+        if not filtered:
+            if offset >= count:
+                offset -= count
+                continue
+            skip, offset = offset, 0
+        for entry in read(skip):
+            timestamp = entry.get("timestamp", "")
+            if (since and timestamp < since) or (until and timestamp > until):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            yield entry
+            if limit is not None:
+                limit -= 1
+                if limit == 0:
+                    return
+
+def count_entries(persona_name, since=None, until=None):
+    """角色全部详细记忆的条数；没有时间过滤时只读取索引"""
+    ensure_memory_dir()
+    if since is None and until is None:
+        return sum(part[0] for part in _history_parts(persona_name))
+    return sum(1 for _ in iter_entries(persona_name, since=since, until=until))
+
+def compact_persona_log(persona_name, summary=None, horizon_days=COMPACTION_HORIZON_DAYS,
+                        min_entries=MIN_ARCHIVE_ENTRIES, keep_recent=KEEP_RECENT_ENTRIES, now=None):
+    """
+    把日志中早于 horizon_days 天的条目写入归档段（最近 keep_recent 条除外），日志只保留之后的部分。
+    可归档的条目不足 min_entries 条时不压实。
+    压实期间持有日志的锁，并发的追加会等待压实完成。
+
+    参数:
+        persona_name: 角色名称
+        summary: 写入归档检查点的总结（通常是角色当前的压缩记忆）
+        now: 计算期限的当前时间（datetime），默认为现在
+
+    返回:
+        归档的条目数（未达到阈值时为0）
+    """
+    ensure_memory_dir()
+    path = _persona_log_path(persona_name)
+    if not os.path.exists(path):
+        return 0
+    cutoff = ((now or datetime.now()) - timedelta(days=horizon_days)).strftime("%Y-%m-%d %H:%M:%S")
+    old_entries = []
+    try:
+        with file_store.locked(path):
+            entries = _read_persona_log(path, persona_name)
+            # 日志按时间追加，早于期限的条目是开头连续的一段
+            archivable = 0
+            for entry in entries[:max(0, len(entries) - keep_recent)]:
+                if entry.get("timestamp", "") >= cutoff:
+                    break
+                archivable += 1
+            if archivable < max(1, min_entries):
+                return 0
+            old_entries, recent_entries = entries[:archivable], entries[archivable:]
+            # 先写归档再改写日志：中途失败最多重复归档，不会丢失条目
+            memory_archive.write_segment(persona_name, old_entries, summary)
+            file_store.atomic_write_text(path, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in recent_entries))
+    except Exception as e:
+        print(f"压实 {persona_name} 的详细记忆时出错: {e}")
+        return 0
+    finally:
+        # 条目位置变化，缓存需要重建；检索索引从归档段和新日志重建，归档的条目仍可检索
+        if old_entries:
+            memory_cache.get_cache().invalidate(path)
+            _offset_cache.invalidate(path)
+            memory_index.get_index().invalidate(persona_name)
+    print(f"已将 {persona_name} 的 {len(old_entries)} 条较早的详细记忆归档")
+    return len(old_entries)
+
+def get_relevant_memory(persona_name, query, top_k=memory_index.DEFAULT_TOP_K, exclude_recent=0):
+    """
+    检索与查询文本最相关的详细记忆（包括已压实到归档段中的条目）
+
+    参数:
+        persona_name: 角色名称
+        query: 查询文本（通常是最近的对话）
+        top_k: 返回的最大条目数
+        exclude_recent: 跳过最近的若干条（已在工作记忆中）
+
+    返回:
+        按时间顺序格式化的记忆字符串；没有相关记忆时返回空字符串
+    """
+    ensure_memory_dir()
+    try:
+        entries = memory_index.get_index().search(
+            persona_name, query, lambda: iter_entries(persona_name), top_k, exclude_recent
+        )
+    except Exception as e:
+        print(f"检索 {persona_name} 的详细记忆时出错: {e}")
+        return ""
+    return format_entries(entries)
+
+def format_entries(entries):
+    """格式化输出记忆条目"""
+    return "".join(f"[{entry['timestamp']}]\n{entry['content']}\n\n" for entry in entries)
@@ -0,0 +1,102 @@
+"""
+文件存储模块：记忆文件的加锁和原子写入
+多个 Streamlit 会话（线程）以及多个服务进程可能同时写同一个记忆文件：
+- 同一进程内按文件路径使用线程锁，不同进程之间再加 fcntl 文件锁（锁文件为 <路径>.lock，
+  没有 fcntl 的平台上只有进程内的线程锁）；
+- 整体覆盖写入时先写同目录下的临时文件并刷到磁盘，再用 os.replace 原子替换，
+  进程中断也不会留下写了一半的文件；替换后的文件保持原文件的权限（新文件按 umask 创建）。
+"""
+
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import unquote
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+LOCK_SUFFIX = ".lock"
+
+# 文件名中不允许出现的字符，使用 %XX 转义（可通过 unquote 还原角色名）
+_UNSAFE_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|%\x00-\x1f]')
+
+_thread_locks = {} # 文件路径 -> 线程锁
+_thread_locks_guard = threading.Lock()
+
+# 进程的 umask（只能通过设置来读取，在导入时读取一次，避免之后在多线程中修改）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def persona_filename(persona_name, suffix):
+    """角色名称对应的分片文件名"""
+    return _UNSAFE_FILENAME_CHARS.sub(lambda m: f"%{ord(m.group()):02X}", persona_name) + suffix
+
+
+def persona_from_filename(filename, suffix):
+    """由分片文件名还原角色名称"""
+    return unquote(filename[:-len(suffix)])
+
+
+def _thread_lock(path):
+    key = os.path.abspath(path)
+    with _thread_locks_guard:
+        if key not in _thread_locks:
+            _thread_locks[key] = threading.Lock()
+        return _thread_locks[key]
+
+
+@contextmanager
+def locked(path):
+    """对文件加独占锁，用于读-改-写和追加（不可重入）"""
+    with _thread_lock(path):
+        if fcntl is None:
+            yield
+            return
+        with open(path + LOCK_SUFFIX, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def atomic_write_text(path, text):
+    """原子地用 text 覆盖文件（调用方需已持有该文件的锁）"""
+    atomic_write_bytes(path, text.encode('utf-8'))
+
+
+def atomic_write_bytes(path, data):
+    """原子地用 data 覆盖文件（调用方需已持有该文件的锁）"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        # mkstemp 创建的文件权限是 0600，替换前改成原文件的权限
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def append_text(path, text):
+    """加锁后向文件末尾追加 text"""
+    with locked(path):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
@@ -0,0 +1,212 @@
+"""
+LLM响应缓存模块：按内容寻址的本地磁盘缓存
+以模型、消息和参数的哈希为键缓存非流式响应文本，支持过期时间（TTL，从写入时算起）、
+按最近使用时间淘汰（LRU）以及条目数和总大小上限。
+条目文件写入后不再修改，文件的修改时间即写入时间；最近使用时间记录在访问时间中。
+写入时只更新内存中的条目数和总大小，超出上限或距上次扫描超过 SCAN_INTERVAL_SECONDS 时才扫描缓存目录。
+只有调用时显式传入 use_cache=True 的请求才会使用缓存，
+适用于总结、报告、角色解析等输入相同即可复用结果的调用。
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+
+from client_wrapper import ClientWrapper
+
+CACHE_DIR = ".llm_cache"
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600 # 缓存条目的默认有效期
+MAX_ENTRIES = 500 # 最多保留的缓存条目数
+MAX_BYTES = 20 * 1024 * 1024 # 缓存目录的总大小上限
+SCAN_INTERVAL_SECONDS = 600 # 至少每隔这么久完整扫描一次（清理过期条目，校正其他进程写入造成的计数偏差）
+
+
+def make_key(model, messages, params):
+    """根据模型、消息和参数计算缓存键"""
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """磁盘上的响应缓存，每个条目一个 JSON 文件"""
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=DEFAULT_TTL_SECONDS, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entry_count = None # 内存中的条目数和总大小，第一次扫描之前未知
+        self._total_bytes = 0
+        self._last_scan = 0.0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _expired(self, created, now, ttl=None):
+        """条目自写入起是否已超过有效期（get 和 evict 使用同一规则）"""
+        return now - created > (self.ttl if ttl is None else ttl)
+
+    def get(self, key, ttl=None):
+        """读取未过期的缓存文本；命中时刷新最近使用时间"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        created = stat.st_mtime
+        now = time.time()
+        if self._expired(created, now, ttl):
+            removed = self._remove(path)
+            with self._lock:
+                self.misses += 1
+                if removed and self._entry_count is not None:
+                    self._entry_count -= 1
+                    self._total_bytes -= stat.st_size
+            return None
+        try:
+            os.utime(path, (now, created)) # 访问时间即最近使用时间，用于LRU淘汰；修改时间保持为写入时间
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return entry["content"]
+
+    def put(self, key, content):
+        """写入缓存条目（先写临时文件再重命名），超出上限或到了扫描间隔时淘汰旧条目"""
+        path = self._path(key)
+        data = json.dumps({"content": content}, ensure_ascii=False).encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                old_size = os.stat(path).st_size
+            except FileNotFoundError:
+                old_size = None
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入LLM响应缓存时出错: {e}")
+            return
+        with self._lock:
+            if self._entry_count is not None:
+                if old_size is None:
+                    self._entry_count += 1
+                else:
+                    self._total_bytes -= old_size
+                self._total_bytes += len(data)
+            scan_due = (
+                self._entry_count is None
+                or self._entry_count > self.max_entries
+                or self._total_bytes > self.max_bytes
+                or time.time() - self._last_scan >= SCAN_INTERVAL_SECONDS
+            )
+        if scan_due:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _entries(self):
+        """列出所有缓存条目：(最近使用时间, 写入时间, 大小, 路径)"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """扫描缓存目录：删除过期条目，再按最近使用时间淘汰超出条目数或大小上限的部分"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for used, created, size, path in self._entries():
+                if self._expired(created, now):
+                    self._remove(path)
+                    self.evictions += 1
+                else:
+                    entries.append((used, size, path))
+            entries.sort()
+            total_bytes = sum(size for _, size, _ in entries)
+            while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+                _, size, path = entries.pop(0)
+                self._remove(path)
+                total_bytes -= size
+                self.evictions += 1
+            self._entry_count = len(entries)
+            self._total_bytes = total_bytes
+            self._last_scan = now
+
+    def stats(self):
+        """返回命中/未命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def _completion_from_text(model, content):
+    """将缓存文本包装成与 OpenAI 响应结构相同的对象"""
+    message = SimpleNamespace(role="assistant", content=content)
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+        usage=None,
+        cached=True,
+    )
+
+
+class CachedClient(ClientWrapper):
+    """
+    包装 OpenAI 兼容客户端，为 chat.completions.create 增加 use_cache / cache_ttl 参数
+    """
+
+    def __init__(self, client, cache):
+        super().__init__(client)
+        self.cache = cache
+
+    def create(self, model=None, messages=None, use_cache=False, cache_ttl=None, **params):
+        # 只缓存显式开启且非流式的请求
+        if not use_cache or params.get("stream"):
+            return self.forward(model=model, messages=messages, **params)
+        # 排队优先级不影响响应内容，不计入缓存键
+        key = make_key(model, messages, {k: v for k, v in params.items() if k != "priority"})
+        content = self.cache.get(key, cache_ttl)
+        if content is not None:
+            return _completion_from_text(model, content)
+        completion = self.forward(model=model, messages=messages, **params)
+        self.cache.put(key, completion.choices[0].message.content)
+        return completion
+
+
+# 进程内共享的响应缓存
+_cache = ResponseCache()
+
+def get_cache():
+    """获取共享的LLM响应缓存"""
+    return _cache
@@ -0,0 +1,297 @@
+"""
+LLM网关模块：统一管理多个LLM服务商
+所有服务商都通过 OpenAI 兼容接口访问，共用一个带连接池的 HTTP 客户端；
+请求超时、429/5xx 时按指数退避重试，被限流的服务商进入冷却期，
+请求自动转到下一个可用的服务商。每个服务商按自己的配额限速（见 rate_limiter），
+每次尝试（包括重试）都占用该服务商的配额；配额已满、短时间内排不上队时也转到下一个服务商。另有离线模拟后端用于无网络的压力测试。
+
+环境变量:
+    LLM_BACKEND=mock           使用离线模拟后端
+    LLM_MOCK_ERROR_RATE=0.3    模拟后端按该概率返回 429/503，用于离线测试重试
+    LLM_BACKENDS=gemini,groq   按优先级排列的服务商（默认 gemini,groq,zhipu）
+    GEMINI_API_KEY / GROQ_API_KEY / ZHIPUAI_API_KEY   各服务商的密钥，未设置的服务商会被跳过
+"""
+
+import os
+import time
+import random
+import threading
+from types import SimpleNamespace
+
+import openai
+from openai import OpenAI
+
+import rate_limiter
+from mock_llm import MockLLMClient
+
+REQUEST_TIMEOUT_SECONDS = 60 # 单次请求超时
+MAX_RETRIES = 3 # 每个服务商的最大重试次数
+BACKOFF_BASE_SECONDS = 0.5 # 指数退避的初始等待
+BACKOFF_MAX_SECONDS = 20 # 单次退避的最长等待
+RATE_LIMIT_COOLDOWN_SECONDS = 30 # 被限流且没有 Retry-After 时的冷却时间
+QUEUE_FAILOVER_SECONDS = 2 # 还有其他服务商可用时，在一个服务商的限速队列中最多等待的秒数
+DEFAULT_BACKEND_ORDER = "gemini,groq,zhipu"
+
+# 服务商配置：OpenAI 兼容地址、密钥环境变量、默认模型
+PROVIDERS = {
+    "gemini": {
+        "base_url": "https://generativelanguage.googleapis.com/v1beta/",
+        "api_key_env": "GEMINI_API_KEY",
+        "model": "gemini-2.0-flash",
+    },
+    "groq": {
+        "base_url": "https://api.groq.com/openai/v1",
+        "api_key_env": "GROQ_API_KEY",
+        "model": "llama3-70b-8192",
+    },
+    "zhipu": {
+        "base_url": "https://open.bigmodel.cn/api/paas/v4/",
+        "api_key_env": "ZHIPUAI_API_KEY",
+        "model": "glm-4-flash",
+    },
+}
+
+
+class GatewayConfigError(RuntimeError):
+    """没有可用的服务商（例如未设置任何API密钥）"""
+
+
+class AllBackendsFailedError(RuntimeError):
+    """所有服务商都请求失败"""
+
+
+def _status_code(error):
+    return getattr(error, "status_code", None)
+
+
+def is_retryable(error):
+    """限流、服务端错误、超时和连接错误可以重试"""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = _status_code(error)
+    return status == 429 or (status is not None and status >= 500)
+
+
+def retry_after_seconds(error):
+    """读取错误响应中的 Retry-After 头（秒），没有时返回None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Backend:
+    """一个服务商：客户端、模型以及限流冷却状态"""
+
+    def __init__(self, name, client, model):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.queue_timeouts = 0 # 限速队列已满、转到其他服务商的次数
+
+    def available(self, now=None):
+        return (now or time.time()) >= self.cooldown_until
+
+    def cool_down(self, seconds):
+        self.cooldown_until = max(self.cooldown_until, time.time() + seconds)
+
+
+class _GatewayCompletions:
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def create(self, model=None, messages=None, **params):
+        return self._gateway.create(model=model, messages=messages, **params)
+
+
+class LLMGateway:
+    """
+    多服务商网关，接口与 OpenAI 兼容客户端的 chat.completions.create 相同。
+    调用方传入的 model 只用于标识；实际请求使用所选服务商自己的模型。
+    """
+
+    def __init__(self, backends, max_retries=MAX_RETRIES, sleep=time.sleep):
+        if not backends:
+            raise GatewayConfigError("没有可用的LLM服务商")
+        self.backends = backends
+        self.max_retries = max_retries
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.failovers = 0
+        self.chat = SimpleNamespace(completions=_GatewayCompletions(self))
+
+    @property
+    def model(self):
+        """首选服务商的模型名"""
+        return self.backends[0].model
+
+    def _pick_backend(self, tried):
+        """选择未尝试过且不在冷却期的服务商；都在冷却时等待最早恢复的那个（最多等待 BACKOFF_MAX_SECONDS）"""
+        candidates = [backend for backend in self.backends if backend.name not in tried]
+        if not candidates:
+            return None
+        now = time.time()
+        for backend in candidates:
+            if backend.available(now):
+                return backend
+        backend = min(candidates, key=lambda b: b.cooldown_until)
+        self._sleep(min(BACKOFF_MAX_SECONDS, max(0.0, backend.cooldown_until - now)))
+        return backend
+
+    def _has_untried(self, tried):
+        return any(backend.name not in tried for backend in self.backends)
+
+    def create(self, model=None, messages=None, **params):
+        """
+        发送请求：在当前服务商上按指数退避重试可重试的错误，仍失败时转到下一个服务商；
+        被限流（429）时不在该服务商上等待，立即让它冷却并转到下一个服务商（已是最后一个时才退避重试）。
+        每次等待都不超过 BACKOFF_MAX_SECONDS，服务端的 Retry-After 更长时只用于冷却期。
+        还有其他服务商可用时，在限速队列中最多等待 QUEUE_FAILOVER_SECONDS 秒，排不上时转到下一个服务商；
+        最后一个服务商一直排队等待。
+        不可重试的错误（如参数错误）直接抛出。
+        流式请求只在建立连接阶段重试，已开始输出后出错会直接抛出。
+        """
+        tried = set()
+        last_error = None
+        while (backend := self._pick_backend(tried)) is not None:
+            tried.add(backend.name)
+            if len(tried) > 1:
+                with self._lock:
+                    self.failovers += 1
+            saturated = False
+            for attempt in range(self.max_retries + 1):
+                queue_params = {}
+                if isinstance(backend.client, rate_limiter.RateLimitedClient) and self._has_untried(tried):
+                    queue_params["admit_timeout"] = QUEUE_FAILOVER_SECONDS
+                with self._lock:
+                    backend.requests += 1
+                try:
+                    return backend.client.chat.completions.create(
+                        model=backend.model, messages=messages, **queue_params, **params
+                    )
+                except rate_limiter.QueueTimeout as e:
+                    # 请求没有发出，不计为失败
+                    last_error = e
+                    saturated = True
+                    with self._lock:
+                        backend.requests -= 1
+                        backend.queue_timeouts += 1
+                    break
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    last_error = e
+                    with self._lock:
+                        backend.retries += 1
+                    retry_after = retry_after_seconds(e)
+                    if _status_code(e) == 429 and (self._has_untried(tried) or attempt == self.max_retries):
+                        # 限流：让该服务商冷却一段时间，转到下一个服务商
+                        backend.cool_down(retry_after or RATE_LIMIT_COOLDOWN_SECONDS)
+                        break
+                    if attempt == self.max_retries:
+                        break
+                    delay = retry_after or BACKOFF_BASE_SECONDS * (2 ** attempt)
+                    self._sleep(min(BACKOFF_MAX_SECONDS, delay * random.uniform(0.8, 1.2)))
+            if saturated:
+                continue
+            with self._lock:
+                backend.failures += 1
+            print(f"LLM服务商 {backend.name} 请求失败，尝试下一个: {last_error}")
+        raise AllBackendsFailedError(f"所有LLM服务商都请求失败: {last_error}")
+
+    def stats(self):
+        """返回每个服务商的请求统计"""
+        with self._lock:
+            return {
+                "failovers": self.failovers,
+                "backends": {
+                    backend.name: {
+                        "model": backend.model,
+                        "requests": backend.requests,
+                        "retries": backend.retries,
+                        "failures": backend.failures,
+                        "queue_timeouts": backend.queue_timeouts,
+                        "cooling_down": not backend.available(),
+                    }
+                    for backend in self.backends
+                },
+            }
+
+
+def _shared_http_client():
+    """所有服务商共用的 HTTP 客户端（保持连接复用）"""
+    return openai.DefaultHttpxClient()
+
+
+def backend_names(environ=None):
+    """按优先级排列的服务商名称（离线模拟时只有 mock）"""
+    environ = os.environ if environ is None else environ
+    if environ.get("LLM_BACKEND") == "mock":
+        return ["mock"]
+    return environ.get("LLM_BACKENDS", DEFAULT_BACKEND_ORDER).split(",")
+
+
+def _limited(name, client):
+    """为服务商的客户端加上该服务商的限速（请求增加 priority 参数）"""
+    return rate_limiter.RateLimitedClient(client, rate_limiter.get_limiter(name))
+
+
+def create_gateway(environ=None):
+    """
+    根据环境变量创建网关
+
+    抛出:
+        GatewayConfigError: 没有设置任何服务商的API密钥
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get("LLM_BACKEND") == "mock":
+        # 离线模拟客户端，用于本地测试和压力测试（支持流式输出）
+        error_rate = float(environ.get("LLM_MOCK_ERROR_RATE", 0))
+        mock_client = MockLLMClient(chunk_delay=0.02, error_rate=error_rate)
+        return LLMGateway([Backend("mock", _limited("mock", mock_client), "mock")])
+
+    http_client = _shared_http_client()
+    backends = []
+    for name in backend_names(environ):
+        name = name.strip()
+        provider = PROVIDERS.get(name)
+        if provider is None:
+            print(f"未知的LLM服务商: {name}")
+            continue
+        api_key = environ.get(provider["api_key_env"])
+        if not api_key:
+            continue
+        client = OpenAI(
+            api_key=api_key,
+            base_url=provider["base_url"],
+            timeout=REQUEST_TIMEOUT_SECONDS,
+            max_retries=0, # 重试由网关统一处理
+            http_client=http_client,
+        )
+        backends.append(Backend(name, _limited(name, client), provider["model"]))
+    if not backends:
+        raise GatewayConfigError(
+            "API 密钥未找到。请设置 GEMINI_API_KEY、GROQ_API_KEY 或 ZHIPUAI_API_KEY 环境变量，"
+            "或设置 LLM_BACKEND=mock 使用离线模拟"
+        )
+    return LLMGateway(backends)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_gateway():
+    """获取进程内共享的网关（连接池在多次脚本运行之间复用）"""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = create_gateway()
+        return _gateway
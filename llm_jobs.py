@@ -0,0 +1,125 @@
+"""
+后台任务模块：在线程池中运行记忆更新、记忆压缩和对话总结等LLM调用
+机器人回复生成后立即显示，其余调用作为后台任务执行；
+任务结果在脚本线程中按通道（lane）内的提交顺序提交到会话状态。
+"""
+
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+MAX_BACKGROUND_WORKERS = 4 # 所有会话共享的后台线程数
+MAX_FOREGROUND_WORKERS = 8 # 所有会话共享的前台线程数（用户等待结果的并行回复请求）
+
+# 进程内共享的线程池；任务函数不能访问 st.*，只做LLM调用和计算
+_executor = ThreadPoolExecutor(max_workers=MAX_BACKGROUND_WORKERS, thread_name_prefix="llm-job")
+# 前台请求使用单独的线程池：后台任务在限速器中排队时会一直占着线程，
+# 共用线程池时前台请求拿不到线程，限速器中的优先级也就无从发挥
+_foreground_executor = ThreadPoolExecutor(max_workers=MAX_FOREGROUND_WORKERS, thread_name_prefix="llm-reply")
+
+
+def submit_foreground(fn, *args, **kwargs):
+    """
+    提交一个用户正在等待（或即将等待）结果的请求，例如并行生成的候选回复和预生成的回复草稿；
+    结果不经过任务队列提交，返回 Future
+    """
+    return _foreground_executor.submit(fn, *args, **kwargs)
+
+
+class JobQueue:
+    """
+    一个会话的后台任务队列。
+    同一通道内的任务严格按提交顺序提交结果，不同通道互不阻塞
+    （例如每个角色的记忆更新一个通道，对话总结一个通道）。
+    """
+
+    def __init__(self, executor=None):
+        self._executor = executor or _executor
+        self._lanes = OrderedDict() # lane -> deque[(future, on_commit, on_error)]
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.committed = 0
+        self.failed = 0
+
+    def submit(self, lane, fn, *args, on_commit=None, on_error=None, **kwargs):
+        """
+        提交一个后台任务
+
+        参数:
+            lane: 通道名称，同一通道的结果按提交顺序提交
+            fn: 在后台线程中执行的函数（不能调用 st.*）
+            on_commit: 在脚本线程中以任务结果调用的回调
+            on_error: 任务抛出异常时在脚本线程中调用的回调
+        """
+        future = self._executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._lanes.setdefault(lane, deque()).append((future, on_commit, on_error))
+            self.submitted += 1
+        return future
+
+    def pending(self, lane=None):
+        """返回尚未提交的任务数（可只统计某个通道）"""
+        with self._lock:
+            if lane is not None:
+                return len(self._lanes.get(lane, ()))
+            return sum(len(jobs) for jobs in self._lanes.values())
+
+    def has_ready(self):
+        """是否有可以立即提交的已完成任务"""
+        with self._lock:
+            return any(jobs and jobs[0][0].done() for jobs in self._lanes.values())
+
+    def _pop_ready(self):
+        """取出任意通道中位于队首且已完成的任务"""
+        with self._lock:
+            for lane, jobs in list(self._lanes.items()):
+                if jobs and jobs[0][0].done():
+                    job = jobs.popleft()
+                    if not jobs:
+                        del self._lanes[lane]
+                    return job
+        return None
+
+    def commit_ready(self):
+        """
+        在脚本线程中调用：提交所有已完成的任务结果。
+        每个通道遇到第一个未完成的任务即停止，保证通道内的提交顺序。
+        回调中可以继续提交新任务。
+
+        返回:
+            本次提交的任务数
+        """
+        committed = 0
+        while True:
+            job = self._pop_ready()
+            if job is None:
+                break
+            future, on_commit, on_error = job
+            error = future.exception()
+            if error is None:
+                if on_commit:
+                    on_commit(future.result())
+            else:
+                self.failed += 1
+                if on_error:
+                    on_error(error)
+                else:
+                    print(f"后台任务出错: {error}")
+            committed += 1
+        self.committed += committed
+        return committed
+
+    def wait(self, timeout=None):
+        """等待当前所有任务完成（不提交结果）"""
+        with self._lock:
+            futures = [job[0] for jobs in self._lanes.values() for job in jobs]
+        wait(futures, timeout=timeout)
+
+    def stats(self):
+        """返回任务统计"""
+        return {
+            "submitted": self.submitted,
+            "committed": self.committed,
+            "failed": self.failed,
+            "pending": self.pending(),
+        }
@@ -0,0 +1,115 @@
+"""
+详细记忆归档模块：保存从详细记忆日志中滚出的旧条目
+每次压实（compaction）把一批旧条目写成一个 gzip 压缩的 JSONL 段文件
+bot_memories/archive/<角色>.<序号>.jsonl.gz，并在 <角色>.archive.json 索引中记录各段的
+条目数和时间范围，以及一个总结检查点（压实时角色的压缩记忆）。
+默认保留全部归档段；设置了 MAX_ARCHIVE_SEGMENTS 时，超出的最早段被删除，
+只保留检查点中的计数和总结。读取时逐段流式解压，不会一次性载入全部归档。
+"""
+
+import os
+import json
+import gzip
+from datetime import datetime
+
+import memory_cache
+import memory_manifest
+import file_store
+
+ARCHIVE_DIR, INDEX_SUFFIX = memory_manifest.SHARD_DIRS["archive"]
+SEGMENT_SUFFIX = ".jsonl.gz"
+MAX_ARCHIVE_SEGMENTS = None # 每个角色最多保留的归档段数；None 表示全部保留，设置后更早的段只保留检查点
+
+
+def _index_path(persona_name):
+    return os.path.join(ARCHIVE_DIR, file_store.persona_filename(persona_name, INDEX_SUFFIX))
+
+
+def _segment_path(persona_name, sequence):
+    return os.path.join(ARCHIVE_DIR, file_store.persona_filename(persona_name, f".{sequence:05d}{SEGMENT_SUFFIX}"))
+
+
+def _empty_index():
+    return {
+        "next_segment": 1,
+        "segments": [], # [{"file", "entries", "first_timestamp", "last_timestamp"}]
+        "checkpoint": {"archived_entries": 0, "dropped_entries": 0, "summary": "", "updated": None},
+    }
+
+
+def _read_index(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_archive_index(persona_name):
+    """读取角色的归档索引（文件未变化时使用进程内缓存）；没有归档时返回空索引"""
+    path = _index_path(persona_name)
+    if not os.path.exists(path):
+        return _empty_index()
+    try:
+        return memory_cache.get_cache().get(path, _read_index)
+    except Exception as e:
+        print(f"读取 {persona_name} 的归档索引时出错: {e}")
+        return _empty_index()
+
+
+def write_segment(persona_name, entries, summary=None):
+    """
+    把一批旧条目写成新的归档段，更新索引和检查点，并删除超出上限的最早段。
+    调用方需持有该角色详细记忆日志的锁，保证同一角色的压实不会并发进行。
+
+    参数:
+        entries: 按时间顺序排列的旧条目
+        summary: 检查点中保存的总结（通常是角色当前的压缩记忆）
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    index_path = _index_path(persona_name)
+    index = _read_index(index_path) if os.path.exists(index_path) else _empty_index()
+
+    sequence = index["next_segment"]
+    segment_path = _segment_path(persona_name, sequence)
+    data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode('utf-8')
+    file_store.atomic_write_bytes(segment_path, gzip.compress(data))
+
+    index["next_segment"] = sequence + 1
+    index["segments"].append({
+        "file": os.path.basename(segment_path),
+        "entries": len(entries),
+        "first_timestamp": entries[0].get("timestamp") if entries else None,
+        "last_timestamp": entries[-1].get("timestamp") if entries else None,
+    })
+    checkpoint = index["checkpoint"]
+    checkpoint["archived_entries"] += len(entries)
+    checkpoint["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if summary:
+        checkpoint["summary"] = summary
+
+    # 超出上限的最早段只保留检查点中的计数
+    while MAX_ARCHIVE_SEGMENTS is not None and len(index["segments"]) > MAX_ARCHIVE_SEGMENTS:
+        dropped = index["segments"].pop(0)
+        checkpoint["dropped_entries"] += dropped["entries"]
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, dropped["file"]))
+        except OSError as e:
+            print(f"删除 {persona_name} 的归档段时出错: {e}")
+
+    file_store.atomic_write_text(index_path, json.dumps(index, ensure_ascii=False, indent=2))
+    memory_cache.get_cache().put(index_path, index)
+    memory_manifest.register_shard(persona_name, "archive", index_path)
+
+
+def iter_segment(persona_name, segment, skip=0):
+    """流式解压一个归档段，跳过前 skip 条后逐条产出"""
+    path = os.path.join(ARCHIVE_DIR, segment["file"])
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                yield json.loads(line)
+    except (OSError, ValueError) as e:
+        print(f"读取 {persona_name} 的归档段 {segment['file']} 时出错: {e}")
@@ -0,0 +1,102 @@
+"""
+记忆缓存模块：在进程内缓存已解析的记忆文件
+两个记忆模块共用同一个缓存，文件被替换（inode 变化）、修改时间或大小变化、或本进程写入时失效，
+避免每次Streamlit重新运行时为每个角色重复读取和解析磁盘文件。
+"""
+
+import os
+import threading
+
+
+class FileCache:
+    """以文件路径为键的解析结果缓存，使用 (inode, mtime, size) 判断是否过期"""
+
+    def __init__(self):
+        self._entries = {} # path -> (签名, 解析结果)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _signature(path):
+        """
+        返回文件的 (inode, mtime_ns, size) 签名，文件不存在时返回None。
+        原子替换（os.replace）后 inode 一定变化，即使大小和修改时间（精度有限）恰好相同也会失效。
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def peek(self, path):
+        """返回仍然有效的缓存值；没有缓存或已过期时返回None，不触发加载"""
+        signature = self._signature(path)
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and signature is not None and cached[0] == signature:
+                self.hits += 1
+                return cached[1]
+        return None
+
+    def get(self, path, loader):
+        """
+        获取文件的解析结果
+
+        参数:
+            path: 文件路径
+            loader: 缓存未命中时调用 loader(path) 重新解析文件
+        """
+        value = self.peek(path)
+        if value is not None:
+            return value
+        signature = self._signature(path)
+        value = loader(path)
+        with self._lock:
+            self.misses += 1
+            if signature is not None:
+                self._entries[path] = (signature, value)
+        return value
+
+    def put(self, path, value):
+        """本进程写入文件后调用，直接用写入的内容刷新缓存"""
+        signature = self._signature(path)
+        with self._lock:
+            if signature is None:
+                self._entries.pop(path, None)
+            else:
+                self._entries[path] = (signature, value)
+
+    def invalidate(self, path=None):
+        """使单个文件（或全部）的缓存失效"""
+        with self._lock:
+            self.invalidations += 1
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        """返回命中/未命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 进程内共享的缓存实例
+_cache = FileCache()
+
+def get_cache():
+    """获取共享的记忆缓存"""
+    return _cache
+
+def get_stats():
+    """获取共享记忆缓存的命中/未命中统计"""
+    return _cache.stats()
@@ -0,0 +1,167 @@
+"""
+记忆检索模块：为每个角色的详细记忆建立本地 BM25 索引
+详细记忆按中文二元组和英文单词切分，以当前对话为查询检索最相关的 top-k 条，
+让较早但相关的记忆也能进入回复提示和记忆压缩，而不只是最近的若干条。
+索引在第一次检索时由完整历史（归档段加当前日志）构建，之后随 append_to_detailed_memory 增量更新，
+压实后重建，已归档的条目仍可被检索；
+评分按词项的倒排表用 NumPy 向量化计算。
+"""
+
+import math
+import threading
+from collections import Counter
+
+import numpy as np
+
+from speaker_selector import terms
+
+BM25_K1 = 1.5 # 词频饱和参数
+BM25_B = 0.75 # 文档长度归一化参数
+DEFAULT_TOP_K = 5 # 默认检索的记忆条数
+
+
+class PersonaIndex:
+    """一个角色的 BM25 倒排索引，文档编号即条目在全部详细记忆（按时间顺序）中的下标"""
+
+    def __init__(self):
+        self.entries = []
+        self._doc_lengths = []
+        self._postings = {} # 词项 -> ([文档编号], [词频])
+        self._arrays = {} # 词项 -> (文档编号数组, 词频数组)，追加新文档时失效
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        """追加一条记忆"""
+        doc_id = len(self.entries)
+        counts = Counter(terms(entry.get("content", "")))
+        self.entries.append(entry)
+        self._doc_lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            doc_ids, tfs = self._postings.setdefault(term, ([], []))
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+            self._arrays.pop(term, None)
+
+    def _posting_arrays(self, term):
+        if term not in self._arrays:
+            doc_ids, tfs = self._postings[term]
+            self._arrays[term] = (np.array(doc_ids, dtype=np.int64), np.array(tfs, dtype=np.float64))
+        return self._arrays[term]
+
+    def scores(self, query):
+        """返回每条记忆对查询文本的 BM25 得分数组"""
+        n_docs = len(self.entries)
+        scores = np.zeros(n_docs)
+        if not n_docs:
+            return scores
+        doc_lengths = np.array(self._doc_lengths, dtype=np.float64)
+        avg_length = doc_lengths.mean() or 1.0
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / avg_length)
+        for term in set(terms(query)):
+            if term not in self._postings:
+                continue
+            doc_ids, tfs = self._posting_arrays(term)
+            idf = math.log(1 + (n_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            scores[doc_ids] += idf * tfs * (BM25_K1 + 1) / (tfs + norms[doc_ids])
+        return scores
+
+    def search(self, query, top_k=DEFAULT_TOP_K, exclude_recent=0):
+        """
+        检索最相关的记忆
+
+        参数:
+            query: 查询文本（通常是最近的对话）
+            top_k: 返回的最大条数
+            exclude_recent: 不参与检索的最近条目数（它们已经在工作记忆中）
+
+        返回:
+            得分大于0的记忆条目，按时间顺序排列
+        """
+        scores = self.scores(query)
+        if exclude_recent:
+            scores = scores[:max(0, len(scores) - exclude_recent)]
+        if not len(scores) or top_k <= 0:
+            return []
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = sorted(int(i) for i in best if scores[i] > 0)
+        return [self.entries[i] for i in best]
+
+
+class MemoryIndex:
+    """所有角色的记忆索引（线程安全）"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._persona_locks = {} # 角色 -> 锁，同一角色的构建、检索和追加互斥，不同角色互不阻塞
+        self._generation = 0 # 每次丢弃索引时加1，构建期间被丢弃的索引不保存
+        self._lock = threading.Lock() # 只保护上面的字典和计数，不在持有时读取文件
+
+    def _persona_lock(self, persona_name):
+        with self._lock:
+            if persona_name not in self._persona_locks:
+                self._persona_locks[persona_name] = threading.Lock()
+            return self._persona_locks[persona_name]
+
+    def append(self, persona_name, entry, write):
+        """
+        写入一条记忆并增量更新索引；尚未建立索引的角色等第一次检索时再完整构建。
+        写入与该角色的索引构建互斥：构建时已读到的条目不会再被重复加入。
+
+        参数:
+            write: write() 把条目写入存储
+        """
+        with self._persona_lock(persona_name):
+            write()
+            with self._lock:
+                index = self._indexes.get(persona_name)
+            if index is not None:
+                index.add(entry)
+
+    def invalidate(self, persona_name=None):
+        """丢弃索引（日志被整体重写时调用）"""
+        with self._lock:
+            self._generation += 1
+            if persona_name is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(persona_name, None)
+
+    def search(self, persona_name, query, loader, top_k=DEFAULT_TOP_K, exclude_recent=0):
+        """
+        检索角色的相关记忆；构建索引时只持有该角色的锁，不阻塞其他角色的检索和追加
+
+        参数:
+            loader: loader() -> 按时间顺序逐条产出角色的全部详细记忆，仅在构建索引时调用
+        """
+        with self._persona_lock(persona_name):
+            with self._lock:
+                index = self._indexes.get(persona_name)
+                generation = self._generation
+            if index is None:
+                index = PersonaIndex()
+                for entry in loader():
+                    index.add(entry)
+                with self._lock:
+                    # 构建期间日志被压实或重写时，本次检索仍使用构建结果，但不保存
+                    if self._generation == generation:
+                        self._indexes[persona_name] = index
+            return index.search(query, top_k, exclude_recent)
+
+    def stats(self):
+        """返回已建立索引的角色数和条目数"""
+        with self._lock:
+            return {
+                "personas": len(self._indexes),
+                "entries": sum(len(index) for index in self._indexes.values()),
+            }
+
+
+# 进程内共享的记忆索引
+_index = MemoryIndex()
+
+def get_index():
+    """获取共享的记忆索引"""
+    return _index
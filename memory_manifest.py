@@ -0,0 +1,96 @@
+"""
+记忆清单模块：记录每个角色有哪些记忆分片文件
+清单保存在 bot_memories/manifest.json：
+    {"version": 1, "personas": {角色名: {"detailed": 相对路径, "compressed": 相对路径, "archive": 相对路径}}}
+列出全部角色时只需读取这个小文件，不必扫描目录或打开每个分片；
+只有角色第一次产生某类分片时才会加锁改写清单，平时的读写不会争用它。
+"""
+
+import os
+import json
+import threading
+
+import memory_cache
+import file_store
+
+MEMORY_DIR = "bot_memories"
+MANIFEST_FILE = os.path.join(MEMORY_DIR, "manifest.json")
+MANIFEST_VERSION = 1
+# 分片类型 -> (目录, 文件后缀)
+SHARD_DIRS = {
+    "detailed": (os.path.join(MEMORY_DIR, "detailed"), ".jsonl"),
+    "compressed": (os.path.join(MEMORY_DIR, "compressed"), ".json"),
+    "archive": (os.path.join(MEMORY_DIR, "archive"), ".archive.json"), # 详细记忆归档的索引
+}
+
+_manifest_checked = False
+_manifest_lock = threading.Lock()
+
+
+def _read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_manifest():
+    """读取清单（文件未变化时使用进程内缓存）；清单不存在时返回空清单"""
+    if not os.path.exists(MANIFEST_FILE):
+        return {"version": MANIFEST_VERSION, "personas": {}}
+    try:
+        return memory_cache.get_cache().get(MANIFEST_FILE, _read_manifest)
+    except Exception as e:
+        print(f"读取记忆清单时出错: {e}")
+        return {"version": MANIFEST_VERSION, "personas": {}}
+
+
+def personas_with(kind):
+    """返回拥有某类分片（"detailed" 或 "compressed"）的角色名称列表"""
+    return sorted(name for name, shards in load_manifest()["personas"].items() if kind in shards)
+
+
+def _update_manifest(update):
+    """加锁读取清单，调用 update(manifest) 修改后原子写回"""
+    os.makedirs(MEMORY_DIR, exist_ok=True)
+    with file_store.locked(MANIFEST_FILE):
+        manifest = {"version": MANIFEST_VERSION, "personas": {}}
+        if os.path.exists(MANIFEST_FILE):
+            manifest = _read_manifest(MANIFEST_FILE)
+        update(manifest)
+        file_store.atomic_write_text(MANIFEST_FILE, json.dumps(manifest, ensure_ascii=False, indent=2))
+        memory_cache.get_cache().put(MANIFEST_FILE, manifest)
+
+
+def register_shard(persona_name, kind, path):
+    """登记角色的分片文件；已登记时直接返回"""
+    relative = os.path.relpath(path, MEMORY_DIR)
+    if load_manifest()["personas"].get(persona_name, {}).get(kind) == relative:
+        return
+
+    def update(manifest):
+        manifest["personas"].setdefault(persona_name, {})[kind] = relative
+    _update_manifest(update)
+
+
+def ensure_manifest():
+    """每个进程检查一次：清单不存在时扫描分片目录重建（例如从没有清单的版本升级）"""
+    global _manifest_checked
+    with _manifest_lock:
+        if _manifest_checked:
+            return
+        _manifest_checked = True
+        if not os.path.exists(MANIFEST_FILE):
+            rebuild_manifest()
+
+
+def rebuild_manifest():
+    """扫描分片目录重建清单"""
+    def update(manifest):
+        for kind, (directory, suffix) in SHARD_DIRS.items():
+            if not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                if filename.endswith(suffix):
+                    persona_name = file_store.persona_from_filename(filename, suffix)
+                    relative = os.path.relpath(os.path.join(directory, filename), MEMORY_DIR)
+                    manifest["personas"].setdefault(persona_name, {})[kind] = relative
+    _update_manifest(update)
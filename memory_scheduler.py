@@ -0,0 +1,106 @@
+"""
+记忆更新调度模块：按角色缓冲新消息，合并成一次LLM调用来更新记忆
+角色发言后不再立即更新记忆，而是在以下情况之一时刷新：
+角色自己缓冲的发言数或其估算 token 数达到阈值、缓冲的全部对话快要装不进记忆更新提示、会话空闲一段时间。
+阈值只计角色自己的发言：多角色聊天中每轮有很多其他人的消息，按全部消息计数几乎每次发言都会到期。
+轮到角色发言时不单独刷新：更新在后台完成时回复已经生成，提前刷新不会让回复用上更新后的记忆。
+"""
+
+import time
+import prompt_builder
+from prompt_builder import estimate_tokens
+
+FLUSH_MESSAGE_COUNT = 3 # 角色自己缓冲的发言数达到此值时刷新
+FLUSH_TOKEN_COUNT = 800 # 角色自己缓冲发言的估算 token 数达到此值时刷新
+MAX_BUFFERED_MESSAGES = 20 # 缓冲的全部消息数达到此值时刷新（记忆更新提示最多容纳的对话条数）
+# 缓冲的全部消息的估算 token 数达到此值时刷新（记忆更新提示中留给对话片段的预算）
+MAX_BUFFERED_TOKENS = int(prompt_builder.MEMORY_UPDATE_TOKEN_BUDGET * (1 - prompt_builder.CURRENT_MEMORY_SHARE))
+IDLE_FLUSH_SECONDS = 30 # 会话空闲超过此秒数时刷新所有缓冲
+
+
+class MemoryUpdateScheduler:
+    """
+    一个会话的记忆更新调度器。
+    只记录消息在聊天历史中的位置，缓冲内容直接从聊天历史切片获得。
+    """
+
+    def __init__(self, flush_messages=FLUSH_MESSAGE_COUNT, flush_tokens=FLUSH_TOKEN_COUNT, idle_seconds=IDLE_FLUSH_SECONDS):
+        self.flush_messages = flush_messages
+        self.flush_tokens = flush_tokens
+        self.idle_seconds = idle_seconds
+        self._flushed_upto = {} # 角色 -> 已写入记忆的消息数（聊天历史下标）
+        self._own_messages = {} # 角色 -> 缓冲中角色自己发言的下标
+        self._dirty = set() # 发言后尚未更新记忆的角色
+        self._last_activity = time.time()
+        self.bot_messages = 0 # 逐条更新时本应发出的记忆请求数
+        self.flushes = 0 # 实际发出的合并记忆请求数
+
+    def record_message(self, speaker, message_index, is_bot=True):
+        """
+        记录一条新消息
+
+        参数:
+            speaker: 发言者名称
+            message_index: 消息在聊天历史中的下标
+            is_bot: 是否为机器人发言（只有机器人需要更新记忆）
+        """
+        self._last_activity = time.time()
+        if not is_bot:
+            return
+        self.bot_messages += 1
+        if speaker not in self._flushed_upto:
+            # 缓冲从角色的第一次发言开始，不回填之前的消息（否则第一次发言就会立即到期）
+            self._flushed_upto[speaker] = message_index
+        self._own_messages.setdefault(speaker, []).append(message_index)
+        self._dirty.add(speaker)
+
+    def has_pending(self):
+        """是否有角色等待更新记忆"""
+        return bool(self._dirty)
+
+    def is_idle(self, now=None):
+        """会话是否已空闲足够长的时间"""
+        return (now or time.time()) - self._last_activity >= self.idle_seconds
+
+    def pending_messages(self, persona_name, messages):
+        """角色缓冲中尚未写入记忆的消息"""
+        return messages[self._flushed_upto.get(persona_name, len(messages)):]
+
+    def due(self, messages, now=None):
+        """
+        返回需要立即刷新记忆的角色列表
+
+        参数:
+            messages: 聊天历史
+            now: 当前时间（传入 float("inf") 时视为空闲，刷新所有缓冲）
+        """
+        idle = self.is_idle(now)
+        due_personas = []
+        for persona_name in sorted(self._dirty):
+            own = [messages[i] for i in self._own_messages.get(persona_name, []) if i < len(messages)]
+            buffered = self.pending_messages(persona_name, messages)
+            if (idle
+                    or len(own) >= self.flush_messages
+                    or sum(estimate_tokens(msg["content"]) for msg in own) >= self.flush_tokens
+                    or len(buffered) >= MAX_BUFFERED_MESSAGES
+                    or sum(estimate_tokens(msg["content"]) for msg in buffered) >= MAX_BUFFERED_TOKENS):
+                due_personas.append(persona_name)
+        return due_personas
+
+    def take(self, persona_name, messages):
+        """取出角色的缓冲消息并标记为已刷新"""
+        buffered = self.pending_messages(persona_name, messages)
+        self._flushed_upto[persona_name] = len(messages)
+        self._own_messages.pop(persona_name, None)
+        self._dirty.discard(persona_name)
+        self.flushes += 1
+        return buffered
+
+    def stats(self):
+        """返回合并统计"""
+        return {
+            "bot_messages": self.bot_messages,
+            "flushes": self.flushes,
+            "pending": len(self._dirty),
+            "flush_factor": self.bot_messages / self.flushes if self.flushes else 0.0,
+        }
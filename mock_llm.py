@@ -0,0 +1,90 @@
+"""
+模拟LLM客户端：与 OpenAI 兼容客户端的 client.chat.completions.create 接口一致
+支持流式（stream=True）和非流式输出，不访问网络，
+用于离线开发、测试流式渲染和错误回退。
+设置环境变量 LLM_BACKEND=mock 即可让应用使用该客户端。
+"""
+
+import time
+import random
+import threading
+from types import SimpleNamespace
+
+
+def default_responder(messages, **params):
+    """根据最后一条消息生成确定性的模拟回复"""
+    last_content = messages[-1]["content"] if messages else ""
+    return f"（模拟回复）我听到了：{last_content[:40]}"
+
+
+class MockStreamError(RuntimeError):
+    """模拟的流式传输中断"""
+
+
+class MockAPIError(RuntimeError):
+    """模拟的服务端错误（限流或服务不可用），带有 status_code 属性"""
+
+    def __init__(self, status_code):
+        super().__init__(f"模拟的服务端错误（HTTP {status_code}）")
+        self.status_code = status_code
+
+
+class _MockCompletions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def create(self, model=None, messages=None, stream=False, **params):
+        return self._owner._create(model, messages or [], stream, params)
+
+
+class MockLLMClient:
+    """
+    离线模拟客户端
+
+    参数:
+        responder: responder(messages, **params) -> str，生成回复文本
+        latency: 返回第一个结果前的等待秒数
+        chunk_size: 流式输出时每个增量包含的字符数
+        chunk_delay: 流式输出时每个增量之间的等待秒数
+        fail_after_chunks: 流式输出在产出若干个增量后抛出异常（None表示不出错）
+        error_rate: 每次请求以该概率抛出 429/503 错误，用于测试重试和故障转移
+    """
+
+    def __init__(self, responder=default_responder, latency=0.0, chunk_size=4, chunk_delay=0.0, fail_after_chunks=None, error_rate=0.0):
+        self.responder = responder
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.fail_after_chunks = fail_after_chunks
+        self.error_rate = error_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=_MockCompletions(self))
+
+    def _create(self, model, messages, stream, params):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise MockAPIError(random.choice((429, 503)))
+        text = self.responder(messages, **params)
+        if stream:
+            return self._stream(model, text)
+        message = SimpleNamespace(role="assistant", content=text)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=len(text), total_tokens=len(text)),
+        )
+
+    def _stream(self, model, text):
+        """逐段产出与 OpenAI 流式响应结构相同的增量块"""
+        for index, start in enumerate(range(0, len(text), self.chunk_size)):
+            if self.fail_after_chunks is not None and index >= self.fail_after_chunks:
+                raise MockStreamError("模拟的流式传输中断")
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            delta = SimpleNamespace(role="assistant", content=text[start:start + self.chunk_size])
+            yield SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)])
+        yield SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(role=None, content=None), finish_reason="stop")])
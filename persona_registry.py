@@ -0,0 +1,116 @@
+"""
+角色注册表：进程内只加载一次的角色索引
+按名称和别名（如 "伏地魔（Lord Voldemort）" 的 "伏地魔"、"Lord Voldemort"）建立字典索引，
+启动时将预设群组中的成员名解析为角色全名，无法解析或有歧义时直接报错；
+同时预先生成回复提示中的角色设定片段和导演使用的简短描述。
+"""
+
+import threading
+
+from speaker_selector import name_aliases
+
+REQUIRED_FIELDS = ("name", "description", "background", "greeting")
+SHORT_DESCRIPTION_LEN = 50 # 导演提示中每个角色描述的最大字数
+AVATAR_URL = "https://api.dicebear.com/9.x/personas/svg?seed={name}"
+
+
+class PersonaRegistryError(ValueError):
+    """角色定义或群组成员无效"""
+
+
+class PersonaRegistry:
+    """角色和群组的索引（线程安全；运行中添加的自定义角色对所有会话可见）"""
+
+    def __init__(self, personas, groups=()):
+        self.personas = {} # 角色全名 -> 角色定义
+        self._aliases = {} # 小写别名 -> 角色全名；有歧义的别名为 None
+        self._prompt_fragments = {}
+        self._short_descriptions = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+        for persona in personas:
+            self.add(persona)
+        for group in groups:
+            self._add_group(group)
+
+    @property
+    def names(self):
+        """按添加顺序排列的角色全名"""
+        return list(self.personas)
+
+    def add(self, persona):
+        """
+        添加一个角色
+
+        抛出:
+            PersonaRegistryError: 缺少必要字段或名称重复
+        """
+        missing = [field for field in REQUIRED_FIELDS if not persona.get(field)]
+        if missing:
+            raise PersonaRegistryError(f"角色 {persona.get('name', '?')} 缺少字段: {', '.join(missing)}")
+        name = persona["name"]
+        persona = dict(persona)
+        persona.setdefault("avatar", AVATAR_URL.format(name=name))
+        with self._lock:
+            if name in self.personas:
+                raise PersonaRegistryError(f"角色名称重复: {name}")
+            self.personas[name] = persona
+            for alias in name_aliases(name):
+                # 同一个别名对应多个角色时不能用它查找
+                self._aliases[alias] = name if self._aliases.get(alias, name) == name else None
+            self._prompt_fragments[name] = (
+                f"你是 {name}。{persona['description']}\n"
+                f"你的背景：{persona['background']}\n\n"
+            )
+            description = persona["description"]
+            self._short_descriptions[name] = (
+                description[:SHORT_DESCRIPTION_LEN] + "..." if len(description) > SHORT_DESCRIPTION_LEN else description
+            )
+        return persona
+
+    def get(self, name):
+        """按全名或别名查找角色定义，找不到时返回None"""
+        resolved = self.resolve(name)
+        return self.personas[resolved] if resolved else None
+
+    def resolve(self, name):
+        """将全名或别名解析为角色全名，找不到或有歧义时返回None"""
+        if name in self.personas:
+            return name
+        return self._aliases.get(name.strip().lower())
+
+    def prompt_fragment(self, name):
+        """回复提示开头的角色设定（名称、描述和背景）"""
+        return self._prompt_fragments[name]
+
+    def short_description(self, name):
+        """导演提示中使用的简短描述"""
+        return self._short_descriptions[name]
+
+    def _add_group(self, group):
+        unresolved = [member for member in group["personas"] if self.resolve(member) is None]
+        if unresolved:
+            raise PersonaRegistryError(f"群组 {group['name']} 中的角色无法识别: {', '.join(unresolved)}")
+        self._groups[group["name"]] = dict(group, personas=[self.resolve(member) for member in group["personas"]])
+
+    @property
+    def group_names(self):
+        return list(self._groups)
+
+    def group(self, name):
+        """返回群组定义，成员已解析为角色全名"""
+        return self._groups[name]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """获取进程内共享的角色注册表（第一次调用时加载并校验 persona.py 和 group.py）"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            from persona import PERSONAS
+            from group import GROUPS
+            _registry = PersonaRegistry(PERSONAS, GROUPS)
+        return _registry
@@ -0,0 +1,111 @@
+"""
+提示前缀统计模块：记录每次请求可被服务端提示缓存复用的前缀
+Gemini / OpenAI 兼容接口会对与之前请求相同的长前缀打折计费，
+这里将每次请求与最近的请求比较，记录最长公共前缀的哈希和长度，
+并统计可缓存前缀占全部输入 token 的比例。
+"""
+
+import hashlib
+import threading
+from collections import deque
+
+from prompt_builder import estimate_tokens
+from client_wrapper import ClientWrapper
+
+RECENT_PROMPTS = 32 # 与最近多少个请求比较公共前缀
+MIN_CACHEABLE_TOKENS = 1024 # 服务端提示缓存要求的最小前缀长度
+MAX_RECORDS = 200 # 保留的请求记录数
+
+
+def serialize_messages(messages):
+    """将消息列表序列化为与请求顺序一致的文本，用于比较前缀"""
+    return "".join(f"<{msg['role']}>{msg['content']}\n" for msg in messages)
+
+
+def _common_prefix_len(a, b):
+    """两个字符串的最长公共前缀长度"""
+    limit = min(len(a), len(b))
+    low, high = 0, limit
+    # 二分查找，每次比较都在C层完成
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class PrefixTracker:
+    """记录请求的前缀复用情况（线程安全，可在后台任务中使用）"""
+
+    def __init__(self, recent=RECENT_PROMPTS, min_cacheable_tokens=MIN_CACHEABLE_TOKENS):
+        self.min_cacheable_tokens = min_cacheable_tokens
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+        self.records = deque(maxlen=MAX_RECORDS)
+        self.requests = 0
+        self.total_tokens = 0
+        self.shared_tokens = 0 # 与之前请求相同的前缀 token 数
+        self.cacheable_tokens = 0 # 其中达到服务端缓存最小长度的部分
+
+    def record(self, messages, model=None):
+        """
+        记录一次请求
+
+        返回:
+            {"prefix_hash", "prefix_tokens", "total_tokens", "cacheable"} 记录
+        """
+        text = serialize_messages(messages)
+        with self._lock:
+            prefix_len = max((_common_prefix_len(text, previous) for previous in self._recent), default=0)
+            self._recent.append(text)
+        prefix = text[:prefix_len]
+        prefix_tokens = estimate_tokens(prefix) if prefix else 0
+        total_tokens = estimate_tokens(text)
+        cacheable = prefix_tokens >= self.min_cacheable_tokens
+        record = {
+            "model": model,
+            "prefix_hash": hashlib.sha1(prefix.encode("utf-8")).hexdigest()[:12],
+            "prefix_tokens": prefix_tokens,
+            "total_tokens": total_tokens,
+            "cacheable": cacheable,
+        }
+        with self._lock:
+            self.records.append(record)
+            self.requests += 1
+            self.total_tokens += total_tokens
+            self.shared_tokens += prefix_tokens
+            if cacheable:
+                self.cacheable_tokens += prefix_tokens
+        return record
+
+    def summary(self):
+        """返回前缀复用统计"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "total_tokens": self.total_tokens,
+                "shared_prefix_ratio": self.shared_tokens / self.total_tokens if self.total_tokens else 0.0,
+                "cacheable_prefix_ratio": self.cacheable_tokens / self.total_tokens if self.total_tokens else 0.0,
+            }
+
+
+# 进程内共享的前缀统计（Streamlit 每次重新运行脚本时不会重置）
+_tracker = PrefixTracker()
+
+def get_tracker():
+    """获取共享的前缀统计"""
+    return _tracker
+
+
+class PrefixInstrumentedClient(ClientWrapper):
+    """包装 OpenAI 兼容客户端，在每次 chat.completions.create 前记录前缀统计"""
+
+    def __init__(self, client, tracker):
+        super().__init__(client)
+        self.tracker = tracker
+
+    def create(self, model=None, messages=None, **params):
+        self.tracker.record(messages or [], model)
+        return self.forward(model=model, messages=messages, **params)
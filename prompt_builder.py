@@ -0,0 +1,126 @@
+"""
+提示构建模块：按 token 预算组装提示
+使用本地 token 估算代替固定条数的历史切片，按优先级分配预算：
+系统提示 > 压缩记忆 > 工作记忆 > 最近的对话历史。
+消息的 token 数按内容缓存，每条消息只估算一次。
+"""
+
+import re
+from functools import lru_cache
+
+REPLY_TOKEN_BUDGET = 3000 # 角色回复请求的输入 token 预算
+MEMORY_UPDATE_TOKEN_BUDGET = 2000 # 记忆更新请求的输入 token 预算
+DIRECTOR_TOKEN_BUDGET = 1500 # 导演选择发言者请求的输入 token 预算
+SUMMARY_TOKEN_BUDGET = 3000 # 对话总结请求的输入 token 预算
+REPORT_TOKEN_BUDGET = 6000 # 对话报告请求的输入 token 预算
+COMPRESSED_MEMORY_SHARE = 0.3 # 压缩记忆最多占用的预算比例
+WORKING_MEMORY_SHARE = 0.2 # 工作记忆最多占用的预算比例
+RELEVANT_MEMORY_SHARE = 0.15 # 检索到的相关往事最多占用的预算比例
+CURRENT_MEMORY_SHARE = 0.4 # 记忆更新请求中当前记忆最多占用的预算比例
+MESSAGE_OVERHEAD_TOKENS = 4 # 每条消息的角色标记等额外开销
+TRUNCATION_MARK = "…"
+
+# 中文、日文假名、全角标点：约每字一个 token
+_WIDE_CHARS = re.compile(r"[　-ヿ一-鿿＀-￯]")
+# 英文单词和数字：约每4个字符一个 token
+_WORDS = re.compile(r"[A-Za-z0-9]+")
+
+
+def _count_tokens(text):
+    """估算文本的 token 数（不缓存）"""
+    wide = len(_WIDE_CHARS.findall(text))
+    words = _WORDS.findall(text)
+    word_tokens = sum((len(word) + 3) // 4 for word in words)
+    others = len(text) - wide - sum(len(word) for word in words) - text.count(" ")
+    return wide + word_tokens + (max(others, 0) + 1) // 2
+
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text):
+    """估算文本的 token 数，按内容缓存"""
+    return _count_tokens(text)
+
+
+def message_tokens(msg):
+    """估算一条聊天消息（含发言者名称）的 token 数"""
+    return estimate_tokens(msg["content"]) + estimate_tokens(msg["role"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def format_transcript(messages):
+    """将消息列表格式化为 "发言者: 内容" 的对话文本"""
+    return "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+
+
+def truncate_to_tokens(text, max_tokens, keep="head"):
+    """
+    将文本截断到 token 预算以内
+
+    参数:
+        keep: "head" 保留开头（适合压缩记忆），"tail" 保留结尾（适合按时间追加的工作记忆）
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 二分查找能放进预算的最长前缀/后缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[:mid] if keep == "head" else text[-mid:]
+        if _count_tokens(part) + 1 <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    if low == 0:
+        return ""
+    return text[:low] + TRUNCATION_MARK if keep == "head" else TRUNCATION_MARK + text[-low:]
+
+
+class PromptBudget:
+    """单次请求的 token 预算，按调用顺序（即优先级）依次分配"""
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+
+    @property
+    def remaining(self):
+        return max(0, self.total - self.used)
+
+    def reserve(self, text):
+        """为必须完整保留的文本（如系统提示的固定部分）记账"""
+        self.used += estimate_tokens(text)
+        return text
+
+    def take_text(self, text, max_share=1.0, keep="head"):
+        """在剩余预算和比例上限内截断并记账"""
+        if not text:
+            return text
+        limit = min(self.remaining, int(self.total * max_share))
+        fitted = truncate_to_tokens(text, limit, keep)
+        self.used += estimate_tokens(fitted)
+        return fitted
+
+    def take_history(self, chat_history, max_messages=None):
+        """
+        从最新的消息向前选取，直到预算用完
+
+        最新的一条消息总会被保留（必要时截断内容），保证模型能看到要回应的内容。
+        """
+        candidates = chat_history[-max_messages:] if max_messages else chat_history
+        selected = []
+        for msg in reversed(candidates):
+            cost = message_tokens(msg)
+            if cost > self.remaining:
+                if not selected:
+                    content_budget = self.remaining - estimate_tokens(msg["role"]) - MESSAGE_OVERHEAD_TOKENS
+                    content = truncate_to_tokens(msg["content"], content_budget, keep="tail")
+                    if content:
+                        msg = dict(msg, content=content)
+                        self.used += message_tokens(msg)
+                        selected.append(msg)
+                break
+            self.used += cost
+            selected.append(msg)
+        selected.reverse()
+        return selected
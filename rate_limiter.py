@@ -0,0 +1,230 @@
+"""
+请求限速模块：在客户端按每分钟请求数（RPM）和每分钟 token 数（TPM）限速
+每个服务商一个限速器，使用令牌桶，允许短时突发、长期速率不超过该服务商的配额；
+配额不足时请求按优先级排队：用户可见的回复优先，其次是记忆更新、总结，最后是记忆压缩。
+同一优先级按到达顺序放行。
+
+环境变量:
+    LLM_RPM / LLM_TPM   所有服务商的每分钟请求数 / token 数上限（0 表示不限制），覆盖默认配额
+    LLM_RPM_<服务商> / LLM_TPM_<服务商>   单个服务商的上限，例如 LLM_RPM_GROQ=30
+"""
+
+import os
+import time
+import heapq
+import itertools
+import threading
+
+from prompt_builder import estimate_tokens
+from client_wrapper import ClientWrapper
+
+# 服务商的默认配额：(每分钟请求数, 每分钟 token 数)；未列出的服务商（包括离线模拟后端）默认不限速
+BACKEND_LIMITS = {
+    "gemini": (15, 1000000), # Gemini 免费配额
+}
+DEFAULT_COMPLETION_TOKENS = 500 # 请求未指定 max_tokens 时预估的输出 token 数
+
+# 优先级：数值越小越先放行
+PRIORITIES = {
+    "reply": 0, # 用户可见的回复、报告、问候
+    "director": 0, # 选择下一位发言者（回复前的必经步骤）
+    "speculation": 1, # 预测性的回复草稿，不阻塞用户可见的回复
+    "memory": 1, # 记忆更新
+    "summary": 2, # 对话总结及总结合并
+    "compression": 3, # 记忆压缩
+}
+DEFAULT_PRIORITY = "reply"
+
+
+class QueueTimeout(RuntimeError):
+    """请求在等待期限内没有被限速队列放行（调用方可以改用其他服务商）"""
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟配额，按配额/60 的速率匀速补充"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.capacity <= 0
+
+    def refill(self, now):
+        if self.unlimited:
+            return
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """取出 amount 还需等待的秒数"""
+        if self.unlimited or self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if not self.unlimited:
+            self.level -= amount
+
+    def give_back(self, amount):
+        if not self.unlimited:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """按优先级排队的 RPM / TPM 限速器（线程安全）"""
+
+    def __init__(self, rpm=0, tpm=0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiting = [] # (优先级, 到达序号) 的最小堆
+        self._seq = itertools.count()
+        self.max_queue_depth = 0
+        self.throttled = 0 # 需要排队等待的请求数
+        self.timed_out = 0 # 在等待期限内没有放行、离开队列的请求数
+        self._by_priority = {}
+
+    def acquire(self, tokens, priority=DEFAULT_PRIORITY, timeout=None):
+        """
+        阻塞直到配额允许发送请求，返回等待的秒数
+
+        参数:
+            tokens: 请求预计消耗的 token 数（输入加最大输出）
+            priority: PRIORITIES 中的优先级名称
+            timeout: 最多等待的秒数；为 None 时一直等待。排到队首后所需的等待已超过剩余时间时立即放弃
+
+        返回:
+            等待的秒数；在 timeout 内没有放行时返回 None（请求已离开队列，不占用配额）
+        """
+        if not self.tokens.unlimited:
+            tokens = min(tokens, self.tokens.capacity) # 超过桶容量的请求在桶满时放行，避免永远等待
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            ticket = (PRIORITIES.get(priority, PRIORITIES[DEFAULT_PRIORITY]), next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+            throttled = False
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                if self._waiting[0] == ticket:
+                    wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        break
+                else:
+                    wait = None # 等待排在前面的请求放行后被唤醒
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                        self.timed_out += 1
+                        self._cond.notify_all()
+                        return None
+                    wait = remaining if wait is None else wait
+                throttled = True
+                self._cond.wait(wait)
+            heapq.heappop(self._waiting)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            waited = time.monotonic() - start
+            if throttled:
+                self.throttled += 1
+            entry = self._by_priority.setdefault(priority, {"requests": 0, "total_wait": 0.0, "max_wait": 0.0})
+            entry["requests"] += 1
+            entry["total_wait"] += waited
+            entry["max_wait"] = max(entry["max_wait"], waited)
+            self._cond.notify_all()
+        return waited
+
+    def settle(self, estimated, actual):
+        """请求完成后按实际 token 用量退还多预估的部分"""
+        if actual is None or actual >= estimated:
+            return
+        with self._cond:
+            self.tokens.give_back(estimated - actual)
+            self._cond.notify_all()
+
+    def stats(self):
+        """返回排队统计"""
+        with self._cond:
+            return {
+                "queue_depth": len(self._waiting),
+                "max_queue_depth": self.max_queue_depth,
+                "throttled": self.throttled,
+                "timed_out": self.timed_out,
+                "by_priority": {
+                    name: {
+                        "requests": entry["requests"],
+                        "avg_wait": entry["total_wait"] / entry["requests"],
+                        "max_wait": entry["max_wait"],
+                    }
+                    for name, entry in self._by_priority.items()
+                },
+            }
+
+
+def estimate_request_tokens(messages, params):
+    """预估一次请求消耗的 token 数：输入消息加最大输出"""
+    prompt_tokens = sum(estimate_tokens(msg["content"]) for msg in messages)
+    return prompt_tokens + (params.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+class RateLimitedClient(ClientWrapper):
+    """
+    包装 OpenAI 兼容客户端，为 chat.completions.create 增加 priority 参数并按配额限速；
+    传入 admit_timeout 时最多排队这么多秒，超时抛出 QueueTimeout
+    """
+
+    def __init__(self, client, limiter):
+        super().__init__(client)
+        self.limiter = limiter
+
+    def create(self, model=None, messages=None, priority=DEFAULT_PRIORITY, admit_timeout=None, **params):
+        estimated = estimate_request_tokens(messages or [], params)
+        if self.limiter.acquire(estimated, priority, admit_timeout) is None:
+            raise QueueTimeout(f"限速队列在 {admit_timeout} 秒内没有放行请求")
+        completion = self.forward(model=model, messages=messages, **params)
+        usage = getattr(completion, "usage", None)
+        if usage is not None and not params.get("stream"):
+            self.limiter.settle(estimated, getattr(usage, "total_tokens", None))
+        return completion
+
+
+def backend_limits(backend, environ=None):
+    """服务商的 (每分钟请求数, 每分钟 token 数)：单个服务商的环境变量优先，其次是全局环境变量和默认配额"""
+    environ = os.environ if environ is None else environ
+    default_rpm, default_tpm = BACKEND_LIMITS.get(backend, (0, 0))
+    suffix = backend.upper()
+    rpm = int(environ.get(f"LLM_RPM_{suffix}", environ.get("LLM_RPM", default_rpm)))
+    tpm = int(environ.get(f"LLM_TPM_{suffix}", environ.get("LLM_TPM", default_tpm)))
+    return rpm, tpm
+
+
+def create_limiter(backend, environ=None):
+    """根据服务商的配额创建限速器"""
+    return RateLimiter(*backend_limits(backend, environ))
+
+
+# 进程内共享的限速器，每个服务商一个（所有会话和后台任务共用该服务商的配额）
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(backend):
+    """获取服务商的共享限速器"""
+    with _limiters_lock:
+        if backend not in _limiters:
+            _limiters[backend] = create_limiter(backend)
+        return _limiters[backend]
+
+def get_stats():
+    """返回每个服务商限速器的排队统计"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {backend: limiter.stats() for backend, limiter in limiters.items()}
@@ -0,0 +1,123 @@
+"""
+候选回复排序模块：不调用LLM，在本地为多位角色并行生成的候选回复打分，选出最合适的一条提交
+综合考虑：
+- 发言者评分（见 speaker_selector.score_candidates：点名、发言均衡、话题与角色的契合度）
+- 回复与最近对话的话题相关度
+- 与某条最近消息的重复程度（照搬上文的回复扣分）
+- 长度是否适中
+- 种子候选（之前未被采用的候选）生成后聊天又前进了几条
+未被采用的候选保存为种子，之后几轮评分靠前的角色如果有种子，直接作为候选复用，不再重新生成。
+"""
+
+import speaker_selector
+
+TOPIC_WINDOW = 3 # 计算话题相关度时考虑的最近消息数
+REDUNDANCY_WINDOW = 6 # 检查重复时考虑的最近消息数
+SPEAKER_WEIGHT = 1.0 # 发言者评分的权重
+RELEVANCE_WEIGHT = 2.0 # 话题相关度的权重
+REDUNDANCY_PENALTY = 3.0 # 与最近消息高度重复的扣分权重
+REDUNDANCY_THRESHOLD = 0.6 # 词项重合比例超过此值才视为重复
+LENGTH_RANGE = (10, 400) # 长度适中的字符数范围
+LENGTH_PENALTY = 0.5 # 过短或过长的扣分
+STALENESS_PENALTY = 0.5 # 种子候选每落后一条消息的扣分
+SEED_MAX_AGE = 2 # 种子候选最多落后几条消息仍可复用
+FAILED_REPLY_MARK = "思考遇到了困难" # 回复失败时的占位文本
+
+
+def score_reply(candidate, history, speaker_score=0.0):
+    """
+    为一条候选回复打分
+
+    参数:
+        candidate: {"speaker", "content", "history_len"}
+        history: 当前聊天历史
+        speaker_score: 发言者评分
+    """
+    content = candidate["content"]
+    if not content or FAILED_REPLY_MARK in content:
+        return float("-inf")
+    tokens = speaker_selector.tokenize(content)
+    score = SPEAKER_WEIGHT * speaker_score
+
+    if tokens:
+        topic_tokens = set()
+        for msg in history[-TOPIC_WINDOW:]:
+            topic_tokens |= speaker_selector.tokenize(msg["content"])
+        score += RELEVANCE_WEIGHT * len(tokens & topic_tokens) / len(tokens)
+
+        redundancy = max(
+            (len(tokens & speaker_selector.tokenize(msg["content"])) / len(tokens) for msg in history[-REDUNDANCY_WINDOW:]),
+            default=0.0
+        )
+        if redundancy > REDUNDANCY_THRESHOLD:
+            score -= REDUNDANCY_PENALTY * (redundancy - REDUNDANCY_THRESHOLD) / (1 - REDUNDANCY_THRESHOLD)
+
+    if not LENGTH_RANGE[0] <= len(content) <= LENGTH_RANGE[1]:
+        score -= LENGTH_PENALTY
+
+    score -= STALENESS_PENALTY * (len(history) - candidate["history_len"])
+    return score
+
+
+def rank_candidates(candidates, history, speaker_scores):
+    """
+    按分数从高到低排列候选回复
+
+    参数:
+        speaker_scores: 发言者名称到发言者评分的字典
+
+    返回:
+        [(候选, 分数)] 列表
+    """
+    ranked = [
+        (candidate, score_reply(candidate, history, speaker_scores.get(candidate["speaker"], 0.0)))
+        for candidate in candidates
+    ]
+    ranked.sort(key=lambda item: item[1], reverse=True)
+    return ranked
+
+
+class ReplySeeds:
+    """未被采用的候选回复，每个角色保留最新的一条"""
+
+    def __init__(self):
+        self._seeds = {} # 角色 -> 候选
+
+    def put(self, candidate):
+        self._seeds[candidate["speaker"]] = candidate
+
+    def take(self, speaker, history_len):
+        """取出角色仍可复用的种子候选；过期的种子直接丢弃"""
+        candidate = self._seeds.pop(speaker, None)
+        if candidate is None or history_len - candidate["history_len"] > SEED_MAX_AGE:
+            return None
+        return candidate
+
+    def discard(self, speaker):
+        self._seeds.pop(speaker, None)
+
+    def clear(self):
+        self._seeds.clear()
+
+    def __len__(self):
+        return len(self._seeds)
+
+
+class CandidateStats:
+    """记录候选回复的生成和复用情况"""
+
+    def __init__(self):
+        self.turns = 0 # 使用候选回复的轮数
+        self.generated = 0 # 新生成的候选数
+        self.seeded = 0 # 复用的种子候选数
+        self.seed_wins = 0 # 种子候选被选中提交的次数
+
+    def summary(self):
+        candidates = self.generated + self.seeded
+        return {
+            "turns": self.turns,
+            "generated": self.generated,
+            "seeded": self.seeded,
+            "seed_wins": self.seed_wins,
+            "candidates_per_turn": candidates / self.turns if self.turns else 0.0,
+        }
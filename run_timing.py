@@ -0,0 +1,57 @@
+"""
+运行耗时统计模块：记录共享资源的初始化耗时和每次脚本运行的耗时
+共享资源（LLM客户端、角色注册表、记忆存储）每个进程只初始化一次，
+之后的每次重新运行只做界面工作，两者的对比显示在侧边栏中。
+"""
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+MAX_RUN_RECORDS = 100 # 保留最近多少次脚本运行的耗时
+
+
+class RunTimings:
+    """进程内的启动和重新运行耗时（线程安全，所有会话共用）"""
+
+    def __init__(self):
+        self.startup = {} # 资源名称 -> 初始化耗时（秒）
+        self.runs = deque(maxlen=MAX_RUN_RECORDS)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def startup_step(self, name):
+        """记录一个共享资源的初始化耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.startup[name] = elapsed
+            print(f"已初始化共享资源 {name}，耗时 {elapsed * 1000:.0f} 毫秒")
+
+    def record_run(self, seconds):
+        """记录一次完整的脚本运行耗时"""
+        with self._lock:
+            self.runs.append(seconds)
+
+    def summary(self):
+        """返回启动和重新运行的耗时统计（秒）"""
+        with self._lock:
+            runs = list(self.runs)
+            return {
+                "startup": dict(self.startup),
+                "startup_total": sum(self.startup.values()),
+                "runs": len(runs),
+                "last_run": runs[-1] if runs else 0.0,
+                "avg_run": sum(runs) / len(runs) if runs else 0.0,
+            }
+
+
+_timings = RunTimings()
+
+def get_timings():
+    """获取共享的耗时统计"""
+    return _timings
@@ -0,0 +1,161 @@
+"""
+离线批量模拟：不启动 Streamlit，在进程池中同时运行多个聊天室
+每个聊天室使用 chat_room 引擎，对话记录写入 <输出目录>/room_<编号>.jsonl（每行一个事件，见 chat_room.JsonlTranscriptSink），
+最后一行是 "end" 事件，带有该聊天室的运行统计。
+
+用法示例:
+    LLM_BACKEND=mock python simulate.py --group 工作组 --rooms 100 --turns 30 --workers 8
+    python simulate.py --bots 王医生,李药师 --rooms 4 --turns 20 --batch
+
+每个服务商的限速配额（见 rate_limiter）是所有工作进程共用的总配额，启动时平均分给每个进程。
+默认不把模拟中的记忆写入 bot_memories，避免离线模拟改变页面中角色的长期记忆（见 --persist-memory）。
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import chat_room
+import persona_registry
+import detailed_memory as dm
+import compressed_memory as cm
+import rate_limiter
+import llm_gateway
+
+DEFAULT_OUTPUT_DIR = "simulations" # 对话记录的默认输出目录
+
+_client = None # 工作进程内共享的LLM客户端
+_llm_model = None
+
+
+def _init_worker():
+    """工作进程启动时创建一次LLM客户端，进程内的所有聊天室共用"""
+    global _client, _llm_model
+    gateway, _client = chat_room.create_client()
+    _llm_model = gateway.model
+
+
+def run_room(room_id, bots, turns, output_dir, batch=False, seed=None, persist_memory=False, candidates=0):
+    """
+    在工作进程中运行一个聊天室，对话记录写入 JSONL 文件
+
+    返回:
+        (聊天室编号, 运行统计)
+    """
+    if seed is not None:
+        random.seed(seed + room_id)
+    sink = chat_room.JsonlTranscriptSink(os.path.join(output_dir, f"room_{room_id:05d}.jsonl"), room_id)
+    try:
+        room = chat_room.ChatRoom(
+            _client, _llm_model, persona_registry.get_registry(),
+            sink=sink, bots=bots, persist_memory=persist_memory, candidate_count=candidates
+        )
+        started_at = time.perf_counter()
+        room.run(turns, batch=batch)
+        stats = room.stats()
+        stats["seconds"] = time.perf_counter() - started_at
+        sink.emit("end", stats=stats)
+        return room_id, stats
+    finally:
+        sink.close()
+
+
+def _split_quota(workers):
+    """把每个服务商的限速总配额平均分给每个工作进程（通过环境变量传给新启动的进程）"""
+    for backend in llm_gateway.backend_names():
+        for key, total in zip(("LLM_RPM", "LLM_TPM"), rate_limiter.backend_limits(backend)):
+            if total > 0:
+                os.environ[f"{key}_{backend.upper()}"] = str(max(1, total // workers))
+
+
+def resolve_bots(registry, args):
+    """根据 --group 或 --bots 参数确定聊天角色"""
+    if args.group:
+        if args.group not in registry.group_names:
+            raise SystemExit(f"未知的群组：{args.group}（可选：{', '.join(registry.group_names)}）")
+        return list(registry.group(args.group)["personas"])
+    if args.bots:
+        bots = []
+        for name in args.bots.split(","):
+            resolved = registry.resolve(name)
+            if resolved is None:
+                raise SystemExit(f"未知或有歧义的角色：{name}")
+            bots.append(resolved)
+        return bots
+    return registry.names[:chat_room.DEFAULT_BOTS_IN_CHAT]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="离线批量运行聊天室模拟，对话记录写入 JSONL")
+    parser.add_argument("--group", help="使用的预设群组（见 group.py）")
+    parser.add_argument("--bots", help="逗号分隔的角色名称或别名（未指定 --group 时使用）")
+    parser.add_argument("--rooms", type=int, default=1, help="聊天室数量")
+    parser.add_argument("--turns", type=int, default=20, help="每个聊天室的机器人发言轮数（不含开场问候）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="工作进程数")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR, help="对话记录的输出目录")
+    parser.add_argument("--batch", action="store_true", help="使用批量生成（一次请求生成多轮发言）")
+    parser.add_argument("--seed", type=int, help="随机种子（每个聊天室使用 种子+编号）")
+    parser.add_argument("--candidates", type=int, default=0,
+                        help=f"每轮并行生成候选回复的角色数（2-{chat_room.MAX_CANDIDATES}，0 表示每轮只生成一条）")
+    parser.add_argument("--persist-memory", action="store_true", help="把记忆更新写入 bot_memories（默认只保留在工作记忆中）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        registry = persona_registry.get_registry()
+    except persona_registry.PersonaRegistryError as e:
+        raise SystemExit(f"角色或群组定义有误：{e}")
+    bots = resolve_bots(registry, args)
+    try:
+        llm_gateway.get_gateway() # 启动工作进程前检查服务商配置
+    except llm_gateway.GatewayConfigError as e:
+        raise SystemExit(str(e))
+    os.makedirs(args.output, exist_ok=True)
+    # 启动工作进程前完成记忆目录、清单和旧版文件的迁移，工作进程启动时不再同时迁移
+    dm.ensure_memory_dir()
+    cm.ensure_memory_dir()
+
+    workers = max(1, min(args.workers, args.rooms))
+    _split_quota(workers)
+    started_at = time.perf_counter()
+    totals = {"rooms": 0, "failed": 0, "messages": 0, "bot_messages": 0, "memory_flushes": 0}
+    # 使用 spawn 启动工作进程：每个进程按分配后的配额重新创建限速器和客户端
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+        futures = [
+            executor.submit(run_room, room_id, bots, args.turns, args.output, args.batch, args.seed, args.persist_memory, args.candidates)
+            for room_id in range(args.rooms)
+        ]
+        for future in as_completed(futures):
+            try:
+                room_id, stats = future.result()
+            except Exception as e:
+                totals["failed"] += 1
+                print(f"运行聊天室时出错: {e}", file=sys.stderr)
+                continue
+            totals["rooms"] += 1
+            totals["messages"] += stats["messages"]
+            totals["bot_messages"] += stats["memory_scheduler"]["bot_messages"]
+            totals["memory_flushes"] += stats["memory_scheduler"]["flushes"]
+            print(f"聊天室 {room_id}：{stats['messages']} 条消息，用时 {stats['seconds']:.1f} 秒")
+
+    elapsed = time.perf_counter() - started_at
+    print(
+        f"完成 {totals['rooms']} 个聊天室（失败 {totals['failed']} 个），共 {totals['messages']} 条消息，"
+        f"用时 {elapsed:.1f} 秒，对话记录在 {args.output}"
+    )
+    print(f"记忆更新：{totals['bot_messages']} 条机器人消息合并为 {totals['memory_flushes']} 次请求")
+    # 检查记忆更新确实被合并：每条机器人消息各发一次请求说明调度器没有起作用
+    if totals["bot_messages"] > 1 and totals["memory_flushes"] >= totals["bot_messages"]:
+        print("警告：记忆更新没有被合并（请求数不少于机器人消息数）", file=sys.stderr)
+    return 1 if totals["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
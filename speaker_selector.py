@@ -0,0 +1,149 @@
+"""
+发言者选择模块：用本地启发式评分决定下一个发言者
+综合考虑是否被点名、最近发言频率以及话题与角色描述/背景的重合度，
+只有在评分区分度不足（置信度低）时才调用LLM导演。
+"""
+
+import math
+import re
+
+RECENT_WINDOW = 10 # 统计发言频率时考虑的最近消息数
+TOPIC_WINDOW = 3 # 计算话题重合度时考虑的最近消息数
+MENTION_WEIGHT = 3.0 # 被点名的权重
+QUESTION_BONUS = 1.0 # 被点名且是提问时的额外权重
+BALANCE_WEIGHT = 1.0 # 发言频率均衡的权重
+TOPIC_WEIGHT = 1.5 # 话题重合度的权重
+MIN_CONFIDENCE = 0.2 # 第一名领先第二名的相对幅度低于此值时交给LLM导演
+
+_CJK_RUN = re.compile(r"[一-鿿]+")
+_ASCII_WORD = re.compile(r"[a-zA-Z][a-zA-Z0-9]+")
+_ALIAS_SPLIT = re.compile(r"[（(）)]")
+
+_keyword_cache = {} # (name, description, background) -> 关键词集合
+
+
+def terms(text):
+    """将文本切分为中文二元组和英文单词（保留重复，按出现顺序）"""
+    result = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            result.append(run)
+        result.extend(run[i:i + 2] for i in range(len(run) - 1))
+    result.extend(word.lower() for word in _ASCII_WORD.findall(text))
+    return result
+
+
+def tokenize(text):
+    """文本的词项集合，用于计算话题重合度"""
+    return set(terms(text))
+
+
+def name_aliases(name):
+    """返回角色名称的可识别别名，例如 "伏地魔（Lord Voldemort）" -> 伏地魔、Lord Voldemort"""
+    aliases = {name.lower()}
+    aliases.update(part.strip().lower() for part in _ALIAS_SPLIT.split(name) if part.strip())
+    return aliases
+
+
+def persona_keywords(name, persona):
+    """角色描述和背景的关键词集合（按内容缓存）"""
+    description = persona.get("description", "")
+    background = persona.get("background", "")
+    key = (name, description, background)
+    if key not in _keyword_cache:
+        _keyword_cache[key] = tokenize(f"{description} {background}")
+    return _keyword_cache[key]
+
+
+def score_candidates(history, candidates, personas_data):
+    """
+    为每个候选发言者打分
+
+    参数:
+        history: 聊天历史
+        candidates: 候选机器人名称列表
+        personas_data: 角色名称到角色数据的字典
+
+    返回:
+        按分数从高到低排序的 [(名称, 分数)] 列表
+    """
+    last_content = history[-1]["content"].lower() if history else ""
+    is_question = "?" in last_content or "？" in last_content
+
+    # 最近发言频率：距离上次发言越久，分数越高
+    recent_speakers = [msg["role"] for msg in history[-RECENT_WINDOW:]]
+
+    # 话题重合度：使用候选角色之间的逆文档频率加权，忽略大家共有的词
+    topic_tokens = set()
+    for msg in history[-TOPIC_WINDOW:]:
+        topic_tokens |= tokenize(msg["content"])
+    keywords = {name: persona_keywords(name, personas_data.get(name, {})) for name in candidates}
+    doc_freq = {}
+    for words in keywords.values():
+        for token in words & topic_tokens:
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+    topic_raw = {
+        name: sum(math.log(1 + len(candidates) / doc_freq[token]) for token in words & topic_tokens)
+        for name, words in keywords.items()
+    }
+    max_topic = max(topic_raw.values(), default=0) or 1
+
+    scores = []
+    for name in candidates:
+        score = 0.0
+        if any(alias in last_content for alias in name_aliases(name)):
+            score += MENTION_WEIGHT + (QUESTION_BONUS if is_question else 0)
+        if name in recent_speakers:
+            turns_since = len(recent_speakers) - 1 - max(i for i, speaker in enumerate(recent_speakers) if speaker == name)
+            score += BALANCE_WEIGHT * min(1.0, turns_since / RECENT_WINDOW)
+        else:
+            score += BALANCE_WEIGHT
+        score += TOPIC_WEIGHT * topic_raw[name] / max_topic
+        scores.append((name, score))
+
+    scores.sort(key=lambda item: item[1], reverse=True)
+    return scores
+
+
+def choose_speaker(history, candidates, personas_data):
+    """
+    用启发式评分选择下一个发言者
+
+    返回:
+        (名称, 置信度)；置信度为第一名领先第二名的相对幅度（0~1）
+    """
+    scores = score_candidates(history, candidates, personas_data)
+    if not scores:
+        return None, 0.0
+    if len(scores) == 1:
+        return scores[0][0], 1.0
+    (best, best_score), (_, second_score) = scores[0], scores[1]
+    confidence = (best_score - second_score) / best_score if best_score > 0 else 0.0
+    return best, confidence
+
+
+class SelectionStats:
+    """记录发言者选择的来源，用于统计避免了多少次LLM导演调用"""
+
+    def __init__(self):
+        self.heuristic = 0 # 启发式评分直接决定
+        self.random = 0 # 随机选择
+        self.director = 0 # 调用了LLM导演
+
+    def record(self, source):
+        setattr(self, source, getattr(self, source) + 1)
+
+    @property
+    def avoided(self):
+        """避免的LLM导演调用次数"""
+        return self.heuristic + self.random
+
+    def summary(self):
+        total = self.avoided + self.director
+        return {
+            "heuristic": self.heuristic,
+            "random": self.random,
+            "director": self.director,
+            "avoided": self.avoided,
+            "avoided_rate": self.avoided / total if total else 0.0,
+        }
@@ -0,0 +1,46 @@
+"""
+预测性回复模块：用户阅读上一条消息时，在后台预测下一位发言者并提前生成它的回复草稿
+下一次轮到机器人发言时，如果聊天历史和聊天角色都没有变化，直接提交草稿（命中）；
+否则丢弃草稿（未命中），按正常流程重新选择发言者并生成回复。
+"""
+
+
+class Draft:
+    """一份正在生成或已生成的回复草稿，记录生成时聊天历史的状态"""
+
+    def __init__(self, future, messages, bots):
+        self.future = future # 结果为 (发言者, 回复, 出错信息列表)
+        self.history_len = len(messages)
+        self.last_message = messages[-1] if messages else None
+        self.bots = tuple(bots)
+
+    def matches(self, messages, bots):
+        """聊天历史和聊天角色自草稿开始生成以来是否没有变化"""
+        return (
+            len(messages) == self.history_len
+            and (messages[-1] if messages else None) is self.last_message
+            and tuple(bots) == self.bots
+        )
+
+
+class SpeculationStats:
+    """记录草稿的命中情况"""
+
+    def __init__(self):
+        self.hits = 0 # 草稿被直接提交
+        self.misses = 0 # 聊天历史变化，草稿被丢弃
+        self.failed = 0 # 草稿生成出错
+        self.timeouts = 0 # 轮到发言时草稿仍未生成完，按正常流程生成
+
+    def record(self, outcome):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def summary(self):
+        total = self.hits + self.misses + self.failed + self.timeouts
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
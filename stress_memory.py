@@ -0,0 +1,193 @@
+"""
+记忆存储并发压力测试：多个线程同时追加详细记忆、写入压缩记忆并压实日志，最后检查条目数
+在临时目录中运行（不会改动 bot_memories），检查：
+- 每个角色的详细记忆（归档加当前日志）条数等于追加的条数，内容不重复、不丢失；
+- 每个角色的压缩记忆分片都是完整的 JSON，内容是某个线程写入的值；
+- 清单中登记了所有角色；
+- 与追加、压实并发的检索之后，检索索引中的条目数与存储一致（没有重复加入的条目）。
+有任何不一致时以非零状态退出。
+
+用法示例:
+    python stress_memory.py --threads 8 --appends 200 --personas 4
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+
+import memory_cache
+import memory_index
+import memory_manifest
+import memory_archive
+import detailed_memory as dm
+import compressed_memory as cm
+
+COMPACT_MIN_ENTRIES = 30 # 压力测试中触发压实的条目数（远小于默认值，让压实和追加频繁交错）
+COMPACT_KEEP = 20 # 压实后日志保留的条目数
+
+
+def _persona_names(count):
+    # 包含需要转义的字符，覆盖分片文件名的转义
+    return [f"角色{i}/测试:{i}" for i in range(count)]
+
+
+def _appender(persona_names, thread_id, appends, errors):
+    try:
+        for i in range(appends):
+            persona_name = persona_names[i % len(persona_names)]
+            dm.append_to_detailed_memory(persona_name, f"线程{thread_id}-条目{i}")
+    except Exception as e:
+        errors.append(f"追加线程 {thread_id} 出错: {e}")
+
+
+def _compressor(persona_names, thread_id, writes, errors):
+    try:
+        for i in range(writes):
+            if i % 2:
+                cm.set_compressed_memory(persona_names[i % len(persona_names)], f"线程{thread_id}-压缩{i}")
+            else:
+                cm.save_compressed_memories({name: f"线程{thread_id}-压缩{i}" for name in persona_names})
+    except Exception as e:
+        errors.append(f"压缩记忆线程 {thread_id} 出错: {e}")
+
+
+def _compactor(persona_names, stop, counter, errors):
+    try:
+        while not stop.is_set():
+            for persona_name in persona_names:
+                # 期限设为负数：除最近 COMPACT_KEEP 条外，所有条目都已超出期限，可以归档
+                archived = dm.compact_persona_log(
+                    persona_name, horizon_days=-1, min_entries=COMPACT_MIN_ENTRIES, keep_recent=COMPACT_KEEP
+                )
+                counter[persona_name] = counter.get(persona_name, 0) + archived
+    except Exception as e:
+        errors.append(f"压实线程出错: {e}")
+
+
+def _searcher(persona_names, stop, errors):
+    try:
+        while not stop.is_set():
+            for persona_name in persona_names:
+                dm.get_relevant_memory(persona_name, "线程 条目")
+    except Exception as e:
+        errors.append(f"检索线程出错: {e}")
+
+
+def run(threads, appends, persona_count):
+    """
+    运行一次压力测试（调用方需已切换到临时目录）
+
+    返回:
+        不一致的描述列表；为空表示通过
+    """
+    persona_names = _persona_names(persona_count)
+    errors = []
+    stop = threading.Event()
+    archived = {}
+
+    workers = [threading.Thread(target=_appender, args=(persona_names, t, appends, errors)) for t in range(threads)]
+    workers += [threading.Thread(target=_compressor, args=(persona_names, t, appends // 10 or 1, errors)) for t in range(threads)]
+    background = [
+        threading.Thread(target=_compactor, args=(persona_names, stop, archived, errors)),
+        threading.Thread(target=_searcher, args=(persona_names, stop, errors)),
+    ]
+    for thread in background + workers:
+        thread.start()
+    for worker in workers:
+        worker.join()
+    stop.set()
+    for thread in background:
+        thread.join()
+
+    # 检索索引：并发期间建立并增量更新的索引应与存储中的条目一一对应
+    for persona_name in persona_names:
+        dm.get_relevant_memory(persona_name, "线程 条目")
+    indexed = memory_index.get_index().stats()["entries"]
+    stored = sum(dm.count_entries(persona_name) for persona_name in persona_names)
+    if indexed != stored:
+        errors.append(f"检索索引：{indexed} 条，存储中有 {stored} 条")
+
+    # 以磁盘上的内容为准重新读取
+    memory_cache.get_cache().invalidate()
+
+    # 详细记忆：每个线程向每个角色追加的条目
+    for index, persona_name in enumerate(persona_names):
+        expected = {
+            f"线程{t}-条目{i}"
+            for t in range(threads) for i in range(appends) if i % len(persona_names) == index
+        }
+        contents = [entry["content"] for entry in dm.iter_entries(persona_name)]
+        checkpoint = memory_archive.load_archive_index(persona_name)["checkpoint"]
+        total = dm.count_entries(persona_name) + checkpoint["dropped_entries"]
+        if total != len(expected):
+            errors.append(f"{persona_name}：条目数 {total}，应为 {len(expected)}")
+        if checkpoint["archived_entries"] != archived.get(persona_name, 0):
+            errors.append(f"{persona_name}：归档条目数 {checkpoint['archived_entries']}，压实返回 {archived.get(persona_name, 0)}")
+        if len(contents) != len(set(contents)):
+            errors.append(f"{persona_name}：有 {len(contents) - len(set(contents))} 条重复的条目")
+        if not checkpoint["dropped_entries"] and set(contents) != expected:
+            errors.append(f"{persona_name}：缺少 {len(expected - set(contents))} 条，多出 {len(set(contents) - expected)} 条")
+
+    # 压缩记忆：每个分片都是完整的 JSON，内容来自某个写入线程
+    for persona_name in persona_names:
+        path = cm._shard_path(persona_name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = json.load(f)["content"]
+        except (OSError, ValueError, KeyError) as e:
+            errors.append(f"{persona_name}：压缩记忆分片损坏: {e}")
+            continue
+        if not content.startswith("线程"):
+            errors.append(f"{persona_name}：压缩记忆内容异常：{content}")
+
+    loaded = cm.load_compressed_memories()
+    if set(loaded) != set(persona_names):
+        errors.append(f"压缩记忆：加载到 {len(loaded)} 个角色，应为 {len(persona_names)}")
+    for kind in ("detailed", "compressed", "archive"):
+        registered = memory_manifest.personas_with(kind)
+        if set(registered) != set(persona_names):
+            errors.append(f"清单：{kind} 登记了 {len(registered)} 个角色，应为 {len(persona_names)}")
+
+    total_archived = sum(archived.values())
+    print(
+        f"{threads} 个线程向 {persona_count} 个角色追加 {threads * appends} 条详细记忆，"
+        f"压实归档 {total_archived} 条，压缩记忆写入 {threads * (appends // 10 or 1)} 次"
+    )
+    return errors
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="多线程并发读写记忆文件，检查最终的条目数")
+    parser.add_argument("--threads", type=int, default=8, help="追加线程和压缩记忆线程各自的数量")
+    parser.add_argument("--appends", type=int, default=200, help="每个追加线程追加的条目数")
+    parser.add_argument("--personas", type=int, default=4, help="角色数量")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录以便检查")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="stress_memory_")
+    cwd = os.getcwd()
+    # 记忆模块使用相对路径 bot_memories，切换到临时目录后不会影响真实记忆
+    os.chdir(workdir)
+    try:
+        errors = run(args.threads, args.appends, args.personas)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"临时目录：{workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print("通过" if not errors else f"失败：{len(errors)} 处不一致")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+分层总结模块：将滚动总结逐层合并成一棵总结树
+叶子节点是每 SUMMARY_INTERVAL 轮生成的滚动总结，同一层每积累 MERGE_FANOUT 个节点
+就合并为上一层的一个节点。生成报告时只需要各层尚未合并的节点加上
+还没有被总结的最新消息，报告的输入长度不随对话变长而增长。
+"""
+
+MERGE_FANOUT = 4 # 同一层积累多少个节点后合并为上一层节点
+
+
+class SummaryTree:
+    """
+    一个会话的总结树。
+    每个节点为 {"text": 总结, "start": 起始消息下标, "end": 结束消息下标（不含）, "level": 层级}，
+    各层只保存尚未被合并进上一层的节点。
+    """
+
+    def __init__(self, fanout=MERGE_FANOUT):
+        self.fanout = fanout
+        self.levels = [[]]
+        self.merging = set() # 正在后台合并的层级
+
+    @property
+    def covered_upto(self):
+        """已被总结覆盖的消息数（叶子节点连续覆盖 [0, covered_upto)）"""
+        return max((node["end"] for level in self.levels for node in level), default=0)
+
+    def add_leaf(self, text, start, end):
+        """添加一个滚动总结作为叶子节点"""
+        self.levels[0].append({"text": text, "start": start, "end": end, "level": 0})
+
+    def next_merge(self):
+        """
+        返回下一组需要合并的节点 (层级, 节点列表)；没有时返回 None。
+        同一层同时只会有一组节点在合并，保证上一层节点的时间顺序。
+        """
+        for level, nodes in enumerate(self.levels):
+            if level not in self.merging and len(nodes) >= self.fanout:
+                self.merging.add(level)
+                return level, nodes[:self.fanout]
+        return None
+
+    def apply_merge(self, level, nodes, text):
+        """用合并后的总结替换一组节点，放到上一层"""
+        merged_ids = {id(node) for node in nodes}
+        self.levels[level] = [node for node in self.levels[level] if id(node) not in merged_ids]
+        if len(self.levels) == level + 1:
+            self.levels.append([])
+        self.levels[level + 1].append({
+            "text": text,
+            "start": nodes[0]["start"],
+            "end": nodes[-1]["end"],
+            "level": level + 1,
+        })
+        self.merging.discard(level)
+
+    def cancel_merge(self, level):
+        """合并失败时释放该层，之后可以重试"""
+        self.merging.discard(level)
+
+    def frontier(self):
+        """按时间顺序返回覆盖全部已总结消息的节点（各层尚未合并的节点）"""
+        return sorted((node for level in self.levels for node in level), key=lambda node: node["start"])
+
+
+def merge_summaries(client, llm_model, nodes):
+    """使用LLM将几段按时间顺序排列的总结合并为一段"""
+    sections = "\n\n".join(
+        f"【第 {node['start'] + 1}-{node['end']} 条消息】\n{node['text']}" for node in nodes
+    )
+    prompt = (
+        "以下是一段聊天对话按时间顺序排列的几段总结。请将它们合并为一段连贯、精炼的总结，"
+        "保留关键话题、决定、冲突或共识以及讨论的进展，删除重复内容，控制在400字以内。\n\n"
+        + sections
+    )
+    completion = client.chat.completions.create(
+        model=llm_model,
+        messages=[
+            {"role": "system", "content": "你是一位总结专家。"},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.2,
+        max_tokens=800,
+        use_cache=True,
+        priority="summary"
+    )
+    return completion.choices[0].message.content.strip()